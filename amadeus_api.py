@@ -6,14 +6,11 @@ import os
 import requests
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from metrics import track_external_call, record_external_error
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Obtener las credenciales de Amadeus
-AMADEUS_API_KEY = os.getenv('AMADEUS_API_KEY')
-AMADEUS_API_SECRET = os.getenv('AMADEUS_API_SECRET')
-
 # URLs de la API de Amadeus
 AMADEUS_AUTH_URL = 'https://test.api.amadeus.com/v1/security/oauth2/token'
 AMADEUS_FLIGHT_OFFERS_URL = 'https://test.api.amadeus.com/v2/shopping/flight-offers'
@@ -27,8 +24,9 @@ class AmadeusAPI:
         """
         Inicializa la API de Amadeus.
         """
-        self.api_key = AMADEUS_API_KEY
-        self.api_secret = AMADEUS_API_SECRET
+        # Obtener las credenciales de Amadeus
+        self.api_key = os.getenv('AMADEUS_API_KEY')
+        self.api_secret = os.getenv('AMADEUS_API_SECRET')
         self.access_token = None
         self.token_expires = None
     
@@ -54,7 +52,8 @@ class AmadeusAPI:
             'client_secret': self.api_secret
         }
         
-        response = requests.post(AMADEUS_AUTH_URL, headers=headers, data=data)
+        with track_external_call('amadeus', 'token'):
+            response = requests.post(AMADEUS_AUTH_URL, headers=headers, data=data)
         
         if response.status_code == 200:
             token_data = response.json()
@@ -63,6 +62,7 @@ class AmadeusAPI:
             self.token_expires = datetime.now() + timedelta(seconds=token_data['expires_in'] - 60)
             return self.access_token
         else:
+            record_external_error('amadeus', 'token')
             raise Exception(f"Error al obtener el token de acceso: {response.text}")
     
     def search_flights(self, origin, destination, departure_date, return_date=None, adults=1, max_results=5):
@@ -103,11 +103,13 @@ class AmadeusAPI:
             params['returnDate'] = return_date
         
         # Realizar la solicitud
-        response = requests.get(AMADEUS_FLIGHT_OFFERS_URL, headers=headers, params=params)
+        with track_external_call('amadeus', 'flight_offers'):
+            response = requests.get(AMADEUS_FLIGHT_OFFERS_URL, headers=headers, params=params)
         
         if response.status_code == 200:
             return response.json()['data']
         else:
+            record_external_error('amadeus', 'flight_offers')
             error_message = f"Error al buscar vuelos: {response.text}"
             print(error_message)
             return []
@@ -235,5 +237,17 @@ class AmadeusAPI:
         except:
             return duration_str
 
-# Crear una instancia de la API de Amadeus
-amadeus_api = AmadeusAPI()
+# Instancia compartida de la API de Amadeus, creada en el primer uso
+_amadeus_api = None
+
+def get_amadeus_api():
+    """
+    Obtiene la instancia compartida de la API de Amadeus, creándola si es necesario.
+    
+    Returns:
+        AmadeusAPI: Instancia compartida
+    """
+    global _amadeus_api
+    if _amadeus_api is None:
+        _amadeus_api = AmadeusAPI()
+    return _amadeus_api
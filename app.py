@@ -1,17 +1,33 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, redirect, url_for, flash, session, make_response
+from flask import Flask, request, jsonify, render_template, send_from_directory, redirect, url_for, flash, session, make_response, Response, stream_with_context
+import io
 import os
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import functools
+import hmac
 from dotenv import load_dotenv
 from datetime import datetime
 from message_handler import MessageHandler
-from tours_db import get_all_tours, get_tour_by_id, add_tour, update_tour, delete_tour
-from user_db import verify_user, create_session, verify_session, invalidate_session, get_all_users, change_password, create_user, get_user_by_id, update_user, delete_user
+from conversation_export import export_conversations, EXPORT_FORMATS, EXPORT_MIMETYPES, EXPORT_EXTENSIONS
+from timestamps import to_epoch_ms
+from outbound_dispatcher import OutboundDispatcher, OUTBOUND_WORKERS
+from message_splitter import split_message
+from metrics import (REGISTRY, render_metrics, register_gauge, timed, track_external_call, record_external_error,
+                     WEBHOOK_SECONDS)
+from delivery_status import parse_whatsapp_statuses, parse_telnyx_event
+from campaigns import CampaignRunner, CAMPAIGN_CHANNELS, CAMPAIGN_MESSAGE_TYPES, RECIPIENT_STATES
+from tours_db import get_all_tours, get_tour_by_id, add_tour, update_tour, delete_tour, import_tours, export_tours, iter_tours_from_csv, iter_tours_from_json
+from user_db import verify_user, create_session, verify_session, invalidate_session, get_all_users, change_password, create_user, get_user_by_id, update_user, delete_user, login_throttle, PasswordHasherBusy, start_session_sweeper
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Registro de la aplicación; con LOG_LEVEL=DEBUG se registran también los datos de cada webhook
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
 # Configuración para mensajes flash y sesiones
@@ -23,6 +39,9 @@ app.config['PERMANENT_SESSION_LIFETIME'] = 86400  # Sesión expira en 24 horas (
 # Inicializar el manejador de mensajes
 message_handler = MessageHandler()
 
+# Eliminar periódicamente las sesiones expiradas en segundo plano
+start_session_sweeper()
+
 # Obtener las variables de entorno
 VERIFY_TOKEN = os.getenv('VERIFY_TOKEN', 'token_predeterminado')
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
@@ -32,6 +51,15 @@ WHATSAPP_PHONE_ID = os.getenv('WHATSAPP_PHONE_ID')
 TELNYX_API_KEY = os.getenv('TELNYX_API_KEY')
 TELNYX_PHONE_NUMBER = os.getenv('TELNYX_PHONE_NUMBER')
 
+# Token para leer /metrics sin sesión (Authorization: Bearer <token>); sin él, /metrics solo
+# responde a usuarios con la sesión iniciada
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# Sesión HTTP compartida para las APIs de WhatsApp y Telnyx: reutiliza las
+# conexiones (y su negociación TLS) entre envíos en lugar de abrir una por mensaje
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=OUTBOUND_WORKERS))
+
 # Decorador para proteger rutas que requieren autenticación
 def login_required(f):
     @functools.wraps(f)
@@ -93,8 +121,24 @@ def login():
         password = request.form.get('password')
         remember = request.form.get('remember') == 'on'
         
+        # Limitar intentos por IP y por usuario antes de calcular ningún hash
+        retry_after = login_throttle.check(username, request.remote_addr)
+        if retry_after:
+            flash(f'Demasiados intentos de inicio de sesión. Intente de nuevo en {retry_after} segundos', 'danger')
+            response = make_response(render_template('login.html'), 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        
         # Verificar credenciales
-        user = verify_user(username, password)
+        try:
+            user = verify_user(username, password)
+        except PasswordHasherBusy:
+            flash('El servicio está ocupado. Intente de nuevo en unos segundos', 'warning')
+            response = make_response(render_template('login.html'), 503)
+            response.headers['Retry-After'] = '5'
+            return response
+        
+        login_throttle.record_result(username, user is not None)
         
         if user:
             # Crear sesión
@@ -170,7 +214,13 @@ def change_password_route():
             return redirect(url_for('change_password_route'))
         
         # Cambiar contraseña
-        if change_password(session['user']['id'], current_password, new_password):
+        try:
+            password_changed = change_password(session['user']['id'], current_password, new_password)
+        except PasswordHasherBusy:
+            flash('El servicio está ocupado. Intente de nuevo en unos segundos', 'warning')
+            return redirect(url_for('change_password_route'))
+        
+        if password_changed:
             flash('Contraseña cambiada correctamente. Por favor, inicie sesión nuevamente', 'success')
             return redirect(url_for('logout'))
         else:
@@ -265,14 +315,100 @@ def remove_tour(tour_id):
     
     return redirect(url_for('admin_tours'))
 
+@app.route('/admin/tours/export')
+@login_required
+@role_required('staff')
+def export_tours_route():
+    """Exportar el catálogo de tours en CSV o JSON Lines"""
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ('csv', 'json'):
+        flash('Formato de exportación no válido', 'danger')
+        return redirect(url_for('admin_tours'))
+    
+    extension = 'jsonl' if export_format == 'json' else 'csv'
+    mimetype = 'application/x-ndjson' if export_format == 'json' else 'text/csv'
+    return Response(
+        stream_with_context(export_tours(export_format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=tours_{datetime.now().strftime("%Y%m%d")}.{extension}'}
+    )
+
+@app.route('/admin/tours/import', methods=['POST'])
+@login_required
+@role_required('staff')
+def import_tours_route():
+    """Importar tours de forma masiva desde un archivo CSV o JSON"""
+    uploaded_file = request.files.get('file')
+    if not uploaded_file or not uploaded_file.filename:
+        flash('Debe seleccionar un archivo para importar', 'danger')
+        return redirect(url_for('admin_tours'))
+    
+    dry_run = request.form.get('dry_run') == 'on'
+    is_json = uploaded_file.filename.lower().endswith(('.json', '.jsonl', '.ndjson'))
+    reader = iter_tours_from_json if is_json else iter_tours_from_csv
+    
+    try:
+        stream = io.TextIOWrapper(uploaded_file.stream, encoding='utf-8-sig', newline='')
+        report = import_tours(reader(stream), dry_run=dry_run)
+    except Exception as e:
+        flash(f'Error al importar tours: {str(e)}', 'danger')
+        return redirect(url_for('admin_tours'))
+    
+    prefix = 'Simulación: ' if dry_run else 'Importación completada: '
+    flash(
+        f"{prefix}{report['created']} nuevos, {report['updated']} actualizados, "
+        f"{report['unchanged']} sin cambios, {len(report['errors'])} con errores",
+        'warning' if report['errors'] else 'success'
+    )
+    if dry_run:
+        for change in report['changes'][:20]:
+            if change['action'] == 'update':
+                flash(f"{change['id']}: se actualizarán {', '.join(change['fields'])}", 'info')
+            else:
+                flash(f"{change['id'] or 'Nuevo tour'}: se creará", 'info')
+    for error in report['errors'][:10]:
+        flash(f"Fila {error['row']}: {'; '.join(error['errors'])}", 'danger')
+    
+    return redirect(url_for('admin_tours'))
+
 @app.route('/api/conversations')
 @login_required
 def get_conversations():
-    """Endpoint para obtener todas las conversaciones"""
+    """
+    Endpoint para obtener todas las conversaciones (opcionalmente filtradas por etiqueta, estado o canal).
+    
+    Por defecto devuelve solo el resumen de cada conversación (último mensaje,
+    contadores y mensajes sin leer) sin leer los archivos de mensajes. Con
+    full=true incluye todos los mensajes de cada conversación.
+    """
     include_archived = request.args.get('include_archived', 'false').lower() == 'true'
-    conversations = message_handler.get_conversations(include_archived=include_archived)
+    filters = {
+        'tag': request.args.get('tag') or None,
+        'status': request.args.get('status') or None,
+        'source': request.args.get('source') or None
+    }
+    if request.args.get('full', 'false').lower() == 'true':
+        conversations = message_handler.get_conversations(include_archived=include_archived, **filters)
+    else:
+        conversations = message_handler.get_conversation_summaries(include_archived=include_archived, **filters)
     return jsonify({"conversations": conversations})
 
+@app.route('/api/search')
+@login_required
+def search_messages():
+    """Buscar texto en el historial de mensajes de todas las conversaciones"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Se requiere un texto de búsqueda (q)'}), 400
+    
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    phone_number = request.args.get('phone_number')
+    if phone_number:
+        phone_number = message_handler.normalize_phone_number(phone_number)
+    
+    return jsonify(message_handler.search_index.search(query, page=page, per_page=per_page, phone_number=phone_number))
+
 @app.route('/api/conversation/<phone_number>/tags', methods=['GET', 'POST', 'DELETE'])
 @login_required
 def manage_conversation_tags(phone_number):
@@ -343,16 +479,87 @@ def unarchive_conversation(phone_number):
     else:
         return jsonify({'success': False, 'error': 'No se pudo desarchivar la conversación'}), 404
 
+def _date_range_from_args():
+    """
+    Obtiene el rango de fechas (since/until) de los parámetros de la petición.
+    
+    Acepta fechas ISO 8601 o segundos/milisegundos Unix. Una fecha sin hora en
+    `until` incluye el día completo.
+    
+    Returns:
+        tuple: (since_ms, until_ms); None si no se indicó el límite
+    
+    Raises:
+        ValueError: Si alguna fecha no es válida
+    """
+    bounds = []
+    for name in ('since', 'until'):
+        value = request.args.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        ts_ms = to_epoch_ms(value)
+        if ts_ms is None:
+            raise ValueError(f"Fecha no válida en '{name}': {value}")
+        if name == 'until' and len(value) == 10 and value[4] == '-':
+            ts_ms += 24 * 60 * 60 * 1000 - 1
+        bounds.append(ts_ms)
+    return tuple(bounds)
+
+def _stream_export(phone_numbers, export_format, filename):
+    """Construye la respuesta en streaming de una exportación de conversaciones"""
+    try:
+        since_ms, until_ms = _date_range_from_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return Response(
+        stream_with_context(export_conversations(message_handler, phone_numbers, export_format, since_ms, until_ms)),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename={filename}.{EXPORT_EXTENSIONS[export_format]}'}
+    )
+
 @app.route('/api/conversation/<phone_number>/export', methods=['GET'])
 @login_required
 def export_conversation(phone_number):
-    """Exportar una conversación"""
+    """Exportar una conversación (JSON completo, o en streaming con ?format=ndjson|csv|zip)"""
+    export_format = request.args.get('format', 'json').lower()
+    if export_format in EXPORT_FORMATS:
+        phone_number = message_handler.normalize_phone_number(phone_number)
+        if message_handler.get_conversation(phone_number) is None:
+            return jsonify({'error': 'No se pudo exportar la conversación'}), 404
+        return _stream_export([phone_number], export_format, f'conversacion_{phone_number}')
+    
     export_data = message_handler.export_conversation(phone_number)
     if export_data:
         return jsonify(export_data)
     else:
         return jsonify({'error': 'No se pudo exportar la conversación'}), 404
 
+@app.route('/api/conversations/export', methods=['GET'])
+@login_required
+def export_conversations_route():
+    """
+    Exportar varias conversaciones en streaming.
+    
+    Parámetros: format (ndjson, csv o zip), phones (lista separada por comas),
+    tag, status, since, until e include_archived.
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Formato no válido; use {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    phone_numbers = message_handler.get_phone_numbers(
+        include_archived=request.args.get('include_archived', 'false').lower() == 'true',
+        tag=request.args.get('tag') or None,
+        status=request.args.get('status') or None
+    )
+    if request.args.get('phones'):
+        selected = {message_handler.normalize_phone_number(phone) for phone in request.args['phones'].split(',')}
+        phone_numbers = [phone for phone in phone_numbers if phone in selected]
+    
+    return _stream_export(phone_numbers, export_format, f"conversaciones_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+
 @app.route('/api/bots', methods=['GET'])
 @login_required
 def get_bot_blacklist():
@@ -362,7 +569,18 @@ def get_bot_blacklist():
         'settings': {
             'max_responses_per_hour': message_handler.max_responses_per_hour,
             'bot_detection_threshold': message_handler.bot_detection_threshold
-        }
+        },
+        'ingress': message_handler.quarantine.stats()
+    })
+
+@app.route('/api/bots/quarantine', methods=['GET'])
+@login_required
+def get_quarantine():
+    """Últimos mensajes apartados a la cuarentena por el filtro de entrada"""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    return jsonify({
+        'entries': message_handler.quarantine.tail(limit),
+        'stats': message_handler.quarantine.stats()
     })
 
 @app.route('/api/bots/<phone_number>', methods=['DELETE'])
@@ -437,39 +655,94 @@ def update_bot_settings():
 @app.route('/api/bots/analyze', methods=['POST'])
 @login_required
 def analyze_conversations():
-    """Analizar conversaciones existentes para detectar bots"""
-    try:
-        detected_bots = message_handler.analyze_existing_conversations()
-        return jsonify({
-            'success': True,
-            'message': f'Análisis completado: {len(detected_bots)} bots detectados',
-            'detected_bots': detected_bots,
-            'blacklist': list(message_handler.bot_blacklist)
-        })
-    except Exception as e:
+    """
+    Iniciar en segundo plano el análisis de conversaciones existentes para detectar bots.
+    
+    Por defecto solo se analizan los mensajes recibidos desde la última pasada;
+    con `full=true` se analizan todos. El progreso se consulta con GET.
+    """
+    data = request.get_json(silent=True) or {}
+    full = str(data.get('full', request.args.get('full', 'false'))).lower() == 'true'
+    
+    if not message_handler.bot_analysis.start(full=full):
         return jsonify({
             'success': False,
-            'error': f'Error al analizar conversaciones: {str(e)}'
-        }), 500
+            'error': 'Ya hay un análisis en curso',
+            'status': message_handler.bot_analysis.status()
+        }), 409
+    
+    return jsonify({
+        'success': True,
+        'message': 'Análisis iniciado',
+        'status': message_handler.bot_analysis.status()
+    }), 202
+
+@app.route('/api/bots/analyze', methods=['GET'])
+@login_required
+def get_analysis_status():
+    """Consultar el progreso y el resultado del análisis de bots"""
+    status = message_handler.bot_analysis.status()
+    response = {'success': True, 'status': status}
+    if status['state'] == 'completed':
+        response['message'] = f"Análisis completado: {len(status['detected_bots'])} bots detectados"
+        response['detected_bots'] = status['detected_bots']
+        response['blacklist'] = list(message_handler.bot_blacklist)
+    elif status['state'] == 'failed':
+        response['success'] = False
+        response['error'] = f"Error al analizar conversaciones: {status['error']}"
+    return jsonify(response)
 
 @app.route('/api/messages/<phone_number>')
 @login_required
 def get_messages(phone_number):
-    """Endpoint para obtener una conversación específica"""
-    # Buscar la conversación en las conversaciones activas y archivadas
-    conversations = message_handler.get_conversations(include_archived=True)
-    
-    # Normalizar el número de teléfono para la comparación
-    normalized_phone = message_handler.normalize_phone_number(phone_number)
+    """
+    Endpoint para obtener una conversación específica.
     
-    # Buscar la conversación con ese número de teléfono
-    conversation = next((conv for conv in conversations if conv['phone_number'] == normalized_phone), None)
+    Con `limit` devuelve solo los últimos mensajes y un cursor `next_before`
+    para pedir los anteriores con `before` (también admite milisegundos Unix).
+    """
+    # Buscar la conversación en las conversaciones activas y archivadas
+    try:
+        conversation = message_handler.get_conversation(
+            phone_number,
+            before=request.args.get('before'),
+            limit=request.args.get('limit', type=int),
+            with_delivery=True
+        )
+    except ValueError:
+        return jsonify({"error": "Cursor de paginación no válido"}), 400
     
     if conversation:
+        # Abrir la conversación marca sus mensajes como leídos
+        message_handler.mark_conversation_read(phone_number)
         return jsonify(conversation)
     else:
         return jsonify({"error": "Conversación no encontrada"}), 404
 
+@app.route('/api/messages/status/<path:message_id>')
+@login_required
+def get_message_status(message_id):
+    """Estado de entrega de un mensaje enviado (por el ID devuelto por la API)"""
+    status = message_handler.delivery_status.get_status(message_id)
+    if status is None:
+        return jsonify({'success': False, 'error': 'Sin estado de entrega para este mensaje'}), 404
+    return jsonify({'success': True, 'status': status})
+
+@app.route('/api/delivery/metrics')
+@login_required
+def get_delivery_metrics():
+    """
+    Métricas de entrega de los mensajes enviados en las últimas `hours` horas
+    (por defecto 24): mensajes por estado, tasa de fallos y latencias de envío
+    a entrega y a lectura (p50/p90/p99, en milisegundos). Se puede filtrar por `channel`.
+    """
+    hours = min(max(request.args.get('hours', 24, type=float), 0), 24 * 90)
+    channel = request.args.get('channel') or None
+    since_ms = int((datetime.now().timestamp() - hours * 3600) * 1000)
+    metrics = message_handler.delivery_status.get_metrics(since_ms, channel)
+    metrics.update({'hours': hours, 'channel': channel})
+    return jsonify(metrics)
+
 @app.route('/api/send-message', methods=['POST'])
 @login_required
 def api_send_message():
@@ -483,10 +756,8 @@ def api_send_message():
     message = data['message']
     
     try:
-        # Generar una respuesta usando el manejador de mensajes
-        message_handler.save_message(phone_number, "sent", "text", message)
-        
-        # Enviar el mensaje a través de la API de WhatsApp
+        # Poner el mensaje en la cola de envío de WhatsApp; se guarda en la
+        # conversación cuando se envía
         result = send_whatsapp_message(phone_number, message)
         
         return jsonify({"success": True, "result": result})
@@ -494,6 +765,7 @@ def api_send_message():
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/webhook', methods=['GET', 'POST'])
+@timed(WEBHOOK_SECONDS, 'whatsapp')
 def webhook():
     if request.method == 'GET':
         # Verificación del webhook de WhatsApp
@@ -503,7 +775,7 @@ def webhook():
         
         # Verificar que el token coincida con nuestro token de verificación
         if mode == 'subscribe' and token == VERIFY_TOKEN:
-            print('WEBHOOK_VERIFICADO')
+            logger.info('WEBHOOK_VERIFICADO')
             return challenge, 200
         else:
             return 'Verificación fallida', 403
@@ -511,7 +783,7 @@ def webhook():
     elif request.method == 'POST':
         # Recibir mensajes de WhatsApp
         data = request.json
-        print(f"Datos recibidos: {data}")
+        logger.debug("Datos recibidos: %s", data)
         
         try:
             # Verificar si hay entradas en el webhook
@@ -523,6 +795,10 @@ def webhook():
                 if 'changes' in entry and entry['changes']:
                     change = entry['changes'][0]
                     
+                    # Avisos de estado de entrega de los mensajes enviados (se aplican por lotes)
+                    if 'value' in change and 'statuses' in change['value']:
+                        message_handler.delivery_status.add_events(parse_whatsapp_statuses(change['value']))
+                    
                     # Verificar si el cambio es en el valor
                     if 'value' in change and 'messages' in change['value']:
                         messages = change['value']['messages']
@@ -537,7 +813,7 @@ def webhook():
                             if 'text' in message:
                                 # Mensaje de texto
                                 text = message['text']['body']
-                                print(f"Mensaje de texto recibido de {from_number}: {text}")
+                                logger.info("Mensaje de texto recibido de %s: %s", from_number, text)
                                 
                                 # Procesamos el mensaje y generamos una respuesta usando el MessageHandler
                                 response = message_handler.process_message(from_number, "text", text, message_id, timestamp)
@@ -545,58 +821,92 @@ def webhook():
                                 if response:
                                     send_whatsapp_message(from_number, response)
                                 else:
-                                    print(f"No se envía respuesta a {from_number} (posible bot)")
+                                    logger.info("No se envía respuesta a %s (posible bot)", from_number)
                             
                             elif 'image' in message:
                                 # Mensaje de imagen
                                 image_id = message['image']['id']
-                                print(f"Imagen recibida de {from_number}, ID: {image_id}")
+                                logger.info("Imagen recibida de %s, ID: %s", from_number, image_id)
                                 # Procesamos el mensaje de imagen
                                 response = message_handler.process_message(from_number, "image", image_id, message_id, timestamp)
-                                # Enviamos la respuesta
-                                send_whatsapp_message(from_number, response)
+                                # Enviamos la respuesta (no hay respuesta si el mensaje se filtró)
+                                if response:
+                                    send_whatsapp_message(from_number, response)
                             
                             elif 'audio' in message:
                                 # Mensaje de audio
                                 audio_id = message['audio']['id']
-                                print(f"Audio recibido de {from_number}, ID: {audio_id}")
+                                logger.info("Audio recibido de %s, ID: %s", from_number, audio_id)
                                 # Procesamos el mensaje de audio
                                 response = message_handler.process_message(from_number, "audio", audio_id, message_id, timestamp)
-                                # Enviamos la respuesta
-                                send_whatsapp_message(from_number, response)
+                                # Enviamos la respuesta (no hay respuesta si el mensaje se filtró)
+                                if response:
+                                    send_whatsapp_message(from_number, response)
                             
                             elif 'document' in message:
                                 # Documento
                                 document_id = message['document']['id']
-                                print(f"Documento recibido de {from_number}, ID: {document_id}")
+                                logger.info("Documento recibido de %s, ID: %s", from_number, document_id)
                                 # Procesamos el mensaje de documento
                                 response = message_handler.process_message(from_number, "document", document_id, message_id, timestamp)
-                                # Enviamos la respuesta
-                                send_whatsapp_message(from_number, response)
+                                # Enviamos la respuesta (no hay respuesta si el mensaje se filtró)
+                                if response:
+                                    send_whatsapp_message(from_number, response)
                             
                             else:
                                 # Otro tipo de mensaje
-                                print(f"Mensaje de tipo desconocido recibido de {from_number}")
+                                logger.info("Mensaje de tipo desconocido recibido de %s", from_number)
                                 # Procesamos el mensaje desconocido
                                 response = message_handler.process_message(from_number, "unknown", "Contenido desconocido", message_id, timestamp)
-                                # Enviamos la respuesta
-                                send_whatsapp_message(from_number, response)
+                                # Enviamos la respuesta (no hay respuesta si el mensaje se filtró)
+                                if response:
+                                    send_whatsapp_message(from_number, response)
             
             return 'OK', 200
         except Exception as e:
-            print(f"Error al procesar el mensaje: {str(e)}")
+            logger.exception("Error al procesar el mensaje: %s", e)
             return 'Error interno', 500
 
 def send_whatsapp_message(to_number, message_text):
     """
-    Envía un mensaje de WhatsApp utilizando la API de WhatsApp Business
+    Pone en la cola de salida un mensaje de texto de WhatsApp.
+    
+    El despachador lo envía respetando el orden por destinatario y el límite de
+    frecuencia de la cuenta, lo reintenta si la API lo rechaza temporalmente y
+    lo guarda en la conversación con el ID devuelto por la API. Un texto de más
+    de 4096 caracteres se divide por secciones y líneas en varios mensajes, que
+    se envían en orden.
     
     Args:
         to_number (str): Número de teléfono del destinatario en formato internacional sin el '+'
         message_text (str): Texto del mensaje a enviar
     
     Returns:
-        dict: Respuesta de la API de WhatsApp
+        dict: ID en la cola del primer mensaje y de todas las partes
+    """
+    phone_number = message_handler.normalize_phone_number(to_number)
+    parts = []
+    for part in split_message(message_text, 'whatsapp'):
+        payload = {
+            "type": "text",
+            "text": {
+                "body": part
+            }
+        }
+        parts.append((payload, part))
+    queue_ids = outbound_dispatcher.enqueue_parts('whatsapp', phone_number, parts)
+    return {"queued": True, "queue_id": queue_ids[0], "queue_ids": queue_ids}
+
+def post_whatsapp_message(to_number, payload):
+    """
+    Envía un mensaje a la API de WhatsApp Business (lo usa el despachador).
+    
+    Args:
+        to_number (str): Número de teléfono del destinatario
+        payload (dict): Cuerpo del mensaje sin el destinatario
+    
+    Returns:
+        tuple: (código HTTP, respuesta JSON de la API)
     """
     url = f"https://graph.facebook.com/v17.0/{WHATSAPP_PHONE_ID}/messages"
     
@@ -608,21 +918,254 @@ def send_whatsapp_message(to_number, message_text):
     data = {
         "messaging_product": "whatsapp",
         "recipient_type": "individual",
-        "to": to_number,
-        "type": "text",
-        "text": {
-            "body": message_text
-        }
+        "to": to_number
     }
+    data.update(payload)
     
+    with track_external_call('graph', 'send_message'):
+        response = http_session.post(url, headers=headers, data=json.dumps(data), timeout=30)
+    if response.status_code >= 400:
+        record_external_error('graph', 'send_message')
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data))
         response_data = response.json()
-        print(f"Mensaje enviado: {response_data}")
-        return response_data
-    except Exception as e:
-        print(f"Error al enviar mensaje: {str(e)}")
-        return {"error": str(e)}
+    except ValueError:
+        response_data = {}
+    logger.debug("Respuesta de WhatsApp (%s): %s", response.status_code, response_data)
+    return response.status_code, response_data
+
+def post_sms_message(to_number, payload):
+    """
+    Envía un SMS a la API de Telnyx (lo usa el despachador).
+    
+    Args:
+        to_number (str): Número de teléfono normalizado del destinatario
+        payload (dict): {'text': texto del mensaje}
+    
+    Returns:
+        tuple: (código HTTP, respuesta JSON de la API)
+    """
+    url = "https://api.telnyx.com/v2/messages"
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Authorization": f"Bearer {TELNYX_API_KEY}"
+    }
+    data = {
+        "from": TELNYX_PHONE_NUMBER,
+        "to": to_number if to_number.startswith('+') else f"+{to_number}",
+        "text": payload['text']
+    }
+    
+    with track_external_call('telnyx', 'send_message'):
+        response = http_session.post(url, json=data, headers=headers, timeout=30)
+    if response.status_code >= 400:
+        record_external_error('telnyx', 'send_message')
+    try:
+        response_data = response.json()
+    except ValueError:
+        response_data = {}
+    
+    # Verificar si hay errores de 10DLC
+    errors = response_data.get('errors') or (response_data.get('data') or {}).get('errors') or []
+    if any(str(error.get('code')) == '40010' for error in errors):
+        logger.error(
+            "Error 10DLC: El número %s no está registrado en 10DLC. Para enviar SMS a números "
+            "de EE.UU., debes registrar tu número en 10DLC o usar un número Toll-Free "
+            "(https://developers.telnyx.com/docs/overview/errors/40010)", TELNYX_PHONE_NUMBER
+        )
+    return response.status_code, response_data
+
+def _save_outbound_sent(message, message_id):
+    """Guarda en la conversación un mensaje enviado por el despachador"""
+    message_handler.save_message(
+        message['phone_number'], "sent", "text", message['content'],
+        message_id=message_id, source=message['channel']
+    )
+    message_handler.delivery_status.record_sent(message_id, message['phone_number'], message['channel'])
+
+def _save_outbound_dead(message, error):
+    """Guarda en la conversación un mensaje que no se pudo enviar, con el error"""
+    message_handler.save_message(
+        message['phone_number'], "sent", "text", f"{message['content']}\n\n[Error: {error}]",
+        source=message['channel']
+    )
+
+# Despachador de la cola de mensajes salientes
+outbound_dispatcher = OutboundDispatcher(
+    message_handler.outbound_queue,
+    {'whatsapp': post_whatsapp_message, 'sms': post_sms_message},
+    on_sent=_save_outbound_sent,
+    on_dead=_save_outbound_dead
+)
+outbound_dispatcher.start()
+
+# Ejecutor de campañas; reanuda las que estaban en curso antes de un reinicio
+campaign_runner = CampaignRunner(message_handler.campaigns, outbound_dispatcher, message_handler)
+campaign_runner.start()
+
+# Cada worker guarda sus contadores en data/metrics para que /metrics devuelva la suma de todos
+REGISTRY.share(os.getenv('METRICS_DIR', os.path.join(message_handler.data_dir, 'metrics')))
+
+# Métricas de nivel, calculadas al leer /metrics
+register_gauge(
+    'outbound_queue_messages', 'Mensajes de la cola de salida por estado',
+    lambda: {(state,): count for state, count in message_handler.outbound_queue.get_stats().items()},
+    ('state',)
+)
+register_gauge(
+    'delivery_status_buffered_events', 'Avisos de estado de entrega pendientes de aplicar',
+    message_handler.delivery_status.buffered
+)
+register_gauge(
+    'quarantine_buffered_entries', 'Entradas del registro de cuarentena pendientes de escribir',
+    lambda: message_handler.quarantine.stats()['pending']
+)
+register_gauge(
+    'campaigns_running', 'Campañas en curso',
+    lambda: len(message_handler.campaigns.get_running())
+)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas de la aplicación en formato de Prometheus (con METRICS_TOKEN o una sesión iniciada)"""
+    authorized = METRICS_TOKEN and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {METRICS_TOKEN}'.encode()
+    )
+    if not authorized:
+        session_token = request.cookies.get('session_token')
+        authorized = bool(session_token and verify_session(session_token))
+    if not authorized:
+        return 'No autorizado', 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/outbound', methods=['GET'])
+@login_required
+def get_outbound_status():
+    """Estado de la cola de mensajes salientes y últimos mensajes fallidos"""
+    return jsonify({
+        'stats': message_handler.outbound_queue.get_stats(),
+        'dead': message_handler.outbound_queue.get_dead(request.args.get('limit', 100, type=int))
+    })
+
+@app.route('/api/outbound/<int:queue_id>/retry', methods=['POST'])
+@login_required
+def retry_outbound_message(queue_id):
+    """Volver a poner en cola un mensaje saliente fallido"""
+    if message_handler.outbound_queue.requeue(queue_id):
+        outbound_dispatcher.wake()
+        return jsonify({'success': True, 'message': 'Mensaje puesto de nuevo en cola'})
+    return jsonify({'success': False, 'error': 'Mensaje fallido no encontrado'}), 404
+
+@app.route('/api/campaigns', methods=['GET'])
+@login_required
+def list_campaigns():
+    """Listar las campañas con el número de destinatarios por estado"""
+    return jsonify({'campaigns': message_handler.campaigns.list()})
+
+@app.route('/api/campaigns', methods=['POST'])
+@login_required
+def create_campaign():
+    """
+    Crear una campaña de envío masivo.
+    
+    La audiencia se resuelve al crearla a partir de `audience` (tag, status,
+    include_archived y/o phones); los números en la lista negra se excluyen.
+    Con `start: true` la campaña empieza a enviarse de inmediato.
+    """
+    data = request.get_json(silent=True)
+    if not data or not data.get('name'):
+        return jsonify({'success': False, 'error': 'Nombre de campaña no proporcionado'}), 400
+    
+    channel = data.get('channel', 'whatsapp')
+    message_type = data.get('type', 'text')
+    if channel not in CAMPAIGN_CHANNELS or message_type not in CAMPAIGN_MESSAGE_TYPES:
+        return jsonify({'success': False, 'error': 'Canal o tipo de mensaje no válido'}), 400
+    if message_type == 'template':
+        template = data.get('template') or {}
+        if channel != 'whatsapp' or not template.get('name'):
+            return jsonify({'success': False, 'error': 'Las plantillas requieren el canal whatsapp y un nombre'}), 400
+        content = {
+            'name': template['name'],
+            'language': template.get('language', 'es'),
+            'components': template.get('components')
+        }
+    else:
+        if not data.get('text'):
+            return jsonify({'success': False, 'error': 'Texto del mensaje no proporcionado'}), 400
+        # Cada destinatario recibe un solo mensaje: el texto debe caber en el límite del canal
+        parts = split_message(data['text'], channel)
+        if len(parts) > 1:
+            return jsonify({
+                'success': False,
+                'error': f'El texto es demasiado largo para un solo mensaje ({len(parts)} partes)'
+            }), 400
+        content = {'text': parts[0]}
+    
+    audience = data.get('audience') or {}
+    phone_numbers = message_handler.get_phone_numbers(
+        include_archived=bool(audience.get('include_archived')),
+        tag=audience.get('tag') or None,
+        status=audience.get('status') or None
+    )
+    if audience.get('phones'):
+        selected = {message_handler.normalize_phone_number(phone) for phone in audience['phones']}
+        if audience.get('tag') or audience.get('status'):
+            phone_numbers = [phone for phone in phone_numbers if phone in selected]
+        else:
+            phone_numbers = sorted(selected)
+    phone_numbers = [phone for phone in phone_numbers if phone not in message_handler.bot_blacklist]
+    if not phone_numbers:
+        return jsonify({'success': False, 'error': 'La audiencia no tiene destinatarios'}), 400
+    
+    campaign_id = message_handler.campaigns.create(
+        data['name'], channel, message_type, content, audience, phone_numbers,
+        created_by=session.get('user', {}).get('username')
+    )
+    if data.get('start'):
+        message_handler.campaigns.set_state(campaign_id, 'running', ('draft',))
+        campaign_runner.wake()
+    
+    return jsonify({'success': True, 'campaign': message_handler.campaigns.get(campaign_id)}), 201
+
+@app.route('/api/campaigns/<int:campaign_id>', methods=['GET'])
+@login_required
+def get_campaign(campaign_id):
+    """Obtener una campaña y sus destinatarios (filtrables por `state`, paginados)"""
+    campaign = message_handler.campaigns.get(campaign_id)
+    if campaign is None:
+        return jsonify({'success': False, 'error': 'Campaña no encontrada'}), 404
+    
+    state = request.args.get('state') or None
+    if state is not None and state not in RECIPIENT_STATES:
+        return jsonify({'success': False, 'error': 'Estado no válido'}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    campaign['recipient_list'] = message_handler.campaigns.get_recipients(campaign_id, state, limit, offset)
+    return jsonify({'success': True, 'campaign': campaign})
+
+# Transiciones permitidas por acción: (nuevo estado, estados de origen)
+CAMPAIGN_ACTIONS = {
+    'start': ('running', ('draft', 'paused')),
+    'pause': ('paused', ('running',)),
+    'cancel': ('cancelled', ('draft', 'running', 'paused')),
+}
+
+@app.route('/api/campaigns/<int:campaign_id>/<action>', methods=['POST'])
+@login_required
+def change_campaign_state(campaign_id, action):
+    """Iniciar o reanudar (start), pausar (pause) o cancelar (cancel) una campaña"""
+    if action not in CAMPAIGN_ACTIONS:
+        return jsonify({'success': False, 'error': 'Acción no válida'}), 404
+    
+    state, allowed_from = CAMPAIGN_ACTIONS[action]
+    if not message_handler.campaigns.set_state(campaign_id, state, allowed_from):
+        campaign = message_handler.campaigns.get(campaign_id)
+        if campaign is None:
+            return jsonify({'success': False, 'error': 'Campaña no encontrada'}), 404
+        return jsonify({'success': False, 'error': f"No se puede aplicar '{action}' a una campaña en estado '{campaign['state']}'"}), 409
+    
+    campaign_runner.apply_state(campaign_id, state)
+    return jsonify({'success': True, 'campaign': message_handler.campaigns.get(campaign_id)})
 
 # Rutas para administración de usuarios (solo admin)
 @app.route('/admin/users')
@@ -657,7 +1200,11 @@ def new_user():
             return redirect(url_for('new_user'))
         
         # Crear usuario
-        user_id = create_user(username, password, email, role)
+        try:
+            user_id = create_user(username, password, email, role)
+        except PasswordHasherBusy:
+            flash('El servicio está ocupado. Intente de nuevo en unos segundos', 'warning')
+            return redirect(url_for('new_user'))
         
         if user_id:
             flash(f'Usuario {username} creado correctamente', 'success')
@@ -733,81 +1280,26 @@ def remove_user(user_id):
 # Función para enviar mensajes SMS usando Telnyx
 def send_sms_message(to_number, message_text):
     """
-    Envía un mensaje SMS utilizando la API de Telnyx
+    Pone en la cola de salida un mensaje SMS.
+    
+    Igual que send_whatsapp_message: el despachador lo envía a Telnyx con
+    post_sms_message respetando el orden por destinatario y el límite de
+    frecuencia del canal, lo reintenta si la API lo rechaza temporalmente y lo
+    guarda en la conversación con el ID devuelto por la API. Un texto que ocupa
+    más de SMS_MAX_SEGMENTS segmentos se divide por secciones y líneas en varios
+    SMS, que se envían en orden.
     
     Args:
         to_number (str): Número de teléfono del destinatario en formato internacional
         message_text (str): Texto del mensaje a enviar
     
     Returns:
-        dict: Respuesta de la API de Telnyx
+        dict: ID en la cola del primer mensaje y de todas las partes
     """
-    url = "https://api.telnyx.com/v2/messages"
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Authorization": f"Bearer {TELNYX_API_KEY}"
-    }
-    
-    payload = {
-        "from": TELNYX_PHONE_NUMBER,
-        "to": to_number,
-        "text": message_text,
-        "media_urls": []
-    }
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        response_data = response.json()
-        
-        # Verificar si hay errores de 10DLC
-        if 'data' in response_data and 'errors' in response_data['data']:
-            for error in response_data['data']['errors']:
-                if error.get('code') == '40010':
-                    print(f"Error 10DLC: El número {TELNYX_PHONE_NUMBER} no está registrado en 10DLC")
-                    print("Para enviar SMS a números de EE.UU., debes registrar tu número en 10DLC o usar un número Toll-Free")
-                    print("Más información: https://developers.telnyx.com/docs/overview/errors/40010")
-        
-        # Guardar el mensaje en el sistema incluso si hay error de entrega
-        # para mantener un registro de los intentos
-        message_id = response_data.get('data', {}).get('id', '')
-        
-        # Determinar si hubo error de entrega
-        delivery_status = "error"
-        error_message = ""
-        
-        if 'data' in response_data and 'errors' in response_data['data'] and response_data['data']['errors']:
-            error_obj = response_data['data']['errors'][0]
-            error_message = f"Error: {error_obj.get('title')} - {error_obj.get('detail')}"
-            delivery_status = "error"
-        elif 'data' in response_data and 'to' in response_data['data'] and response_data['data']['to']:
-            status = response_data['data']['to'][0].get('status', '')
-            if status in ['queued', 'sending', 'sent', 'delivered']:
-                delivery_status = "sent"
-            else:
-                delivery_status = "error"
-                error_message = f"Estado de entrega: {status}"
-        
-        # Añadir información de error al mensaje si existe
-        content = message_text
-        if error_message:
-            content += f"\n\n[{error_message}]"
-        
-        # Guardar el mensaje enviado en el sistema
-        message_handler.save_message(
-            to_number, 
-            "sent", 
-            "text", 
-            content,
-            message_id=message_id,
-            timestamp=int(datetime.now().timestamp()),
-            source="sms"  # Identificar como SMS
-        )
-        
-        return response_data
-    except Exception as e:
-        print(f"Error enviando SMS: {str(e)}")
-        raise
+    phone_number = message_handler.normalize_phone_number(to_number)
+    parts = [({"text": part}, part) for part in split_message(message_text, 'sms')]
+    queue_ids = outbound_dispatcher.enqueue_parts('sms', phone_number, parts)
+    return {"queued": True, "queue_id": queue_ids[0], "queue_ids": queue_ids}
 
 # Endpoint para enviar SMS desde el panel de administración
 @app.route('/api/send-sms', methods=['POST'])
@@ -817,11 +1309,16 @@ def send_sms_api():
     Endpoint para enviar mensajes SMS desde el panel de administración.
     """
     data = request.json
+    
+    if not data or 'phone_number' not in data or 'message' not in data:
+        return jsonify({"success": False, "error": "Datos inválidos"}), 400
+    
     phone_number = data['phone_number']
     message = data['message']
     
     try:
-        # Enviar el mensaje a través de la API de Telnyx
+        # Poner el mensaje en la cola de envío de SMS; se guarda en la
+        # conversación cuando se envía
         result = send_sms_message(phone_number, message)
         
         return jsonify({"success": True, "result": result})
@@ -830,6 +1327,7 @@ def send_sms_api():
 
 # Webhook para recibir mensajes SMS de Telnyx
 @app.route('/webhook/sms', methods=['POST'])
+@timed(WEBHOOK_SECONDS, 'sms')
 def sms_webhook():
     """
     Webhook para recibir mensajes SMS de Telnyx.
@@ -837,7 +1335,7 @@ def sms_webhook():
     """
     # Obtener los datos del webhook
     data = request.json
-    print(f"Datos SMS recibidos: {data}")
+    logger.debug("Datos SMS recibidos: %s", data)
     
     try:
         # Verificar si es un mensaje entrante
@@ -859,28 +1357,33 @@ def sms_webhook():
             else:
                 timestamp = int(datetime.now().timestamp())
             
-            # Guardar el mensaje en el sistema
-            message_handler.save_message(
-                from_number, 
-                "received", 
-                "text", 
-                message_content,
-                timestamp=timestamp,
-                message_id=message_id,
-                source="sms"  # Identificar como SMS
-            )
+            # Guardar el mensaje en el sistema (salvo que el número esté en la lista negra
+            # y la política lo aparte a la cuarentena o lo descarte)
+            normalized_number = message_handler.normalize_phone_number(from_number)
+            if message_handler.screen_incoming(normalized_number, "text", message_content, message_id, timestamp,
+                                               source="sms", check_rate_limit=False):
+                message_handler.save_message(
+                    from_number, 
+                    "received", 
+                    "text", 
+                    message_content,
+                    timestamp=timestamp,
+                    message_id=message_id,
+                    source="sms"  # Identificar como SMS
+                )
             
             # No enviamos respuesta automática para mensajes SMS
             # Solo registramos que se recibió el mensaje
-            print(f"Mensaje SMS recibido de {from_number}: {message_content}")
+            logger.info("Mensaje SMS recibido de %s: %s", from_number, message_content)
             
             return '', 200  # Respuesta vacía con código 200
         
-        # Otros tipos de eventos (confirmaciones de entrega, etc.)
+        # Confirmaciones de envío y entrega (se aplican por lotes)
+        message_handler.delivery_status.add_events(parse_telnyx_event(data.get('data', {})))
         return '', 200
         
     except Exception as e:
-        print(f"Error procesando webhook SMS: {str(e)}")
+        logger.exception("Error procesando webhook SMS: %s", e)
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
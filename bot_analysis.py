@@ -0,0 +1,248 @@
+"""
+Análisis de bots en segundo plano sobre las conversaciones guardadas.
+
+El trabajo recorre las conversaciones una a una a partir de los resúmenes de
+metadata_store, de modo que nunca hay más de unas pocas en memoria, y reparte el
+análisis de cada una (huellas SimHash y ritmo de envío, ver bot_detection) en un
+pool de procesos. Para cada conversación se guarda cuántos mensajes recibidos
+se han analizado ya: las pasadas siguientes saltan las conversaciones sin
+mensajes nuevos sin leerlas y, en las demás, solo analizan los mensajes nuevos
+(más los anteriores necesarios para llenar el boceto). Las conversaciones
+archivadas compactadas se leen del segmento y se analizan con las mismas reglas.
+La lista negra, las etiquetas y las marcas se guardan una sola vez al terminar.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import conversation_archive
+from bot_detection import scan_messages, BOT_SIMHASH_DISTANCE
+from sender_state import MESSAGE_HISTORY_SIZE
+from timestamps import message_ts_ms
+
+# Procesos del pool de análisis (con 1 se analiza en el propio hilo del trabajo)
+BOT_ANALYSIS_WORKERS = int(os.getenv('BOT_ANALYSIS_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Conversaciones enviadas al pool y pendientes de resultado, por proceso
+_PENDING_PER_WORKER = 4
+
+def _analyze_received(phone_number, received, repeat_threshold, history_size, max_distance):
+    """Analiza los mensajes recibidos de una conversación (se ejecuta en el pool de procesos)"""
+    return phone_number, scan_messages(received, repeat_threshold, history_size, max_distance)
+
+class BotAnalysisJob:
+    """
+    Trabajo de análisis de bots con progreso consultable.
+
+    Solo puede haber una pasada en curso por proceso.
+    """
+
+    def __init__(self, message_handler, workers=BOT_ANALYSIS_WORKERS):
+        """
+        Args:
+            message_handler (MessageHandler): Gestor de conversaciones
+            workers (int): Procesos del pool de análisis
+        """
+        self.message_handler = message_handler
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._thread = None
+        self._status = {
+            'state': 'idle',
+            'full': False,
+            'started_at': None,
+            'finished_at': None,
+            'total': 0,
+            'processed': 0,
+            'skipped': 0,
+            'detected_bots': [],
+            'error': None
+        }
+
+    def status(self):
+        """
+        Estado de la última pasada.
+
+        Returns:
+            dict: Estado ('idle', 'running', 'completed' o 'failed'), progreso y bots detectados
+        """
+        with self._lock:
+            status = dict(self._status)
+            status['detected_bots'] = list(status['detected_bots'])
+            return status
+
+    def _update(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def _begin(self, full):
+        """Marca el inicio de una pasada; devuelve False si ya hay una en curso"""
+        with self._lock:
+            if self._status['state'] == 'running':
+                return False
+            self._status.update({
+                'state': 'running',
+                'full': full,
+                'started_at': time.time(),
+                'finished_at': None,
+                'total': 0,
+                'processed': 0,
+                'skipped': 0,
+                'detected_bots': [],
+                'error': None
+            })
+            return True
+
+    def start(self, full=False):
+        """
+        Inicia una pasada en un hilo en segundo plano.
+
+        Args:
+            full (bool): Analizar todos los mensajes e ignorar las marcas de pasadas anteriores
+
+        Returns:
+            bool: False si ya había una pasada en curso
+        """
+        if not self._begin(full):
+            return False
+        self._thread = threading.Thread(target=self._run, args=(full,), name='bot-analysis', daemon=True)
+        self._thread.start()
+        return True
+
+    def run(self, full=False):
+        """
+        Ejecuta una pasada en el hilo actual.
+
+        Returns:
+            list: Bots detectados, o None si ya había una pasada en curso
+        """
+        if not self._begin(full):
+            return None
+        self._run(full)
+        status = self.status()
+        if status['state'] == 'failed':
+            raise RuntimeError(status['error'])
+        return status['detected_bots']
+
+    def _run(self, full):
+        print("Analizando conversaciones existentes para detectar bots...")
+        try:
+            detected_bots = self._analyze(full)
+        except Exception as e:
+            print(f"Error en el análisis de bots: {e}")
+            self._update(state='failed', error=str(e), finished_at=time.time())
+            return
+        print(f"Análisis completado: {len(detected_bots)} bots detectados")
+        self._update(state='completed', finished_at=time.time())
+
+    def _iter_work(self, summaries, marks, full):
+        """
+        Lee una a una las conversaciones con mensajes recibidos nuevos.
+
+        Yields:
+            tuple: (teléfono, recibidos analizados al terminar, pares (contenido, llegada) a analizar)
+        """
+        handler = self.message_handler
+        for summary in summaries:
+            phone_number = summary['phone_number']
+            analyzed = 0 if full else marks.get(phone_number, 0)
+            if summary['received_count'] == analyzed or phone_number in handler.bot_blacklist:
+                self._update_skipped()
+                continue
+
+            base_dir = handler.archived_dir if summary['archived'] else handler.conversations_dir
+            conversation = next(handler._iter_conversations(base_dir, [phone_number]), None)
+            if conversation is None:
+                self._update_skipped()
+                continue
+
+            messages = conversation['messages']
+            if conversation.get('archive_header') is not None:
+                # Archivada compactada: la cabecera solo trae el último mensaje
+                _, messages = conversation_archive.read_segment(
+                    conversation_archive.segment_path(base_dir, phone_number)
+                )
+                if messages is None:
+                    self._update_skipped()
+                    continue
+
+            received = [msg for msg in messages if msg.get('direction') == 'received']
+            if analyzed > len(received):
+                analyzed = 0
+            # Los mensajes nuevos, precedidos de los anteriores necesarios para llenar el boceto
+            start = max(analyzed - (MESSAGE_HISTORY_SIZE - 1), 0)
+            yield phone_number, len(received), [
+                (msg.get('content'), message_ts_ms(msg, 0) / 1000) for msg in received[start:]
+            ]
+
+    def _update_skipped(self):
+        with self._lock:
+            self._status['processed'] += 1
+            self._status['skipped'] += 1
+
+    def _record(self, detected_bots, phone_number, verdict):
+        """Registra el resultado de una conversación"""
+        with self._lock:
+            self._status['processed'] += 1
+            if verdict is None:
+                return
+            message = verdict['message'] if isinstance(verdict['message'], str) else str(verdict['message'])
+            bot = {
+                'phone_number': phone_number,
+                'message': message,
+                'repetitions': verdict['near_duplicates'],
+                'reason': verdict['reason']
+            }
+            detected_bots.append(bot)
+            self._status['detected_bots'].append(bot)
+        print(f"Bot detectado: {phone_number} ({bot['reason']}) - Mensaje '{message[:30]}...' "
+              f"repetido {bot['repetitions']} veces")
+
+    def _analyze(self, full):
+        handler = self.message_handler
+        threshold = handler.bot_detection_threshold
+        summaries = handler.metadata_store.get_all_summaries()
+        marks = {} if full else handler.metadata_store.get_analysis_marks()
+        self._update(total=len(summaries))
+
+        detected_bots = []
+        new_marks = {}
+        pool = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        pending = set()
+        try:
+            for phone_number, received_count, received in self._iter_work(summaries, marks, full):
+                new_marks[phone_number] = received_count
+
+                if len(received) < threshold:
+                    self._record(detected_bots, phone_number, None)
+                    continue
+
+                args = (phone_number, received, threshold, MESSAGE_HISTORY_SIZE, BOT_SIMHASH_DISTANCE)
+                if pool is None:
+                    self._record(detected_bots, *_analyze_received(*args))
+                    continue
+
+                # Limitar las conversaciones en vuelo para no cargarlas todas en memoria
+                if len(pending) >= self.workers * _PENDING_PER_WORKER:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._record(detected_bots, *future.result())
+                pending.add(pool.submit(_analyze_received, *args))
+
+            for future in pending:
+                self._record(detected_bots, *future.result())
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+        # Guardar lista negra, etiquetas y marcas una sola vez
+        if detected_bots:
+            phone_numbers = [bot['phone_number'] for bot in detected_bots]
+            handler.bot_blacklist.update(phone_numbers)
+            handler.save_bot_blacklist()
+            handler.tag_conversations(phone_numbers, "Bot")
+        if new_marks:
+            handler.metadata_store.set_analysis_marks(new_marks)
+        return detected_bots
@@ -0,0 +1,231 @@
+"""
+Detección de bots por mensajes casi duplicados y ritmo de envío.
+
+Cada mensaje recibido se reduce a una huella SimHash de 64 bits calculada sobre
+el texto normalizado (minúsculas, sin acentos, emojis ni signos), de modo que un
+cambio pequeño en un texto largo solo altera unos pocos bits. Dos mensajes se
+consideran el mismo cuando sus huellas difieren en BOT_SIMHASH_DISTANCE bits o
+menos.
+
+Los números distinguen los mensajes cortos: "detalles tour T001" y "detalles
+tour T002" son consultas distintas, así que en ellos la huella se combina con
+un hash de los números y dos mensajes con números distintos nunca se parecen.
+Solo en los textos largos (BOT_LONG_TEXT_CHARS caracteres o más, como las
+cadenas de spam) los números se sustituyen por 0, para que las variantes de un
+mismo texto con otro importe o código cuenten como repeticiones. Los mensajes
+demasiado cortos ("ok", "hola", un comando) no tienen huella: se repiten en
+cualquier conversación normal y no cuentan como casi duplicados.
+
+El estado por número es un boceto de tamaño fijo con los pares (huella, hora de
+llegada) de sus últimos mensajes, así que evaluar un mensaje nuevo cuesta lo
+mismo sea cual sea el historial. Además de las repeticiones se mira el ritmo:
+un número que envía muchos mensajes a intervalos casi idénticos y cortos durante
+al menos BOT_MIN_CADENCE_SPAN segundos se considera automatizado (varias fotos
+enviadas en el mismo segundo no cuentan como ritmo). Las mismas funciones se usan al recibir cada mensaje y
+al analizar conversaciones guardadas.
+"""
+
+import hashlib
+import os
+import re
+import unicodedata
+from collections import deque
+from statistics import mean, pstdev
+
+# Máxima distancia de Hamming entre huellas para considerar dos mensajes iguales
+BOT_SIMHASH_DISTANCE = int(os.getenv('BOT_SIMHASH_DISTANCE', '6'))
+
+# Intervalos necesarios para evaluar el ritmo de envío
+BOT_MIN_INTERVALS = int(os.getenv('BOT_MIN_INTERVALS', '5'))
+
+# Coeficiente de variación máximo de los intervalos para considerar el ritmo mecánico
+BOT_INTERVAL_CV = float(os.getenv('BOT_INTERVAL_CV', '0.1'))
+
+# Intervalo medio máximo (segundos) para considerar el ritmo mecánico
+BOT_MAX_MEAN_INTERVAL = float(os.getenv('BOT_MAX_MEAN_INTERVAL', '60'))
+
+# Segundos mínimos entre el primer y el último mensaje para evaluar el ritmo de envío
+BOT_MIN_CADENCE_SPAN = float(os.getenv('BOT_MIN_CADENCE_SPAN', '15'))
+
+# Caracteres y palabras mínimos del texto normalizado para que un mensaje cuente como casi duplicado
+BOT_MIN_DUPLICATE_CHARS = int(os.getenv('BOT_MIN_DUPLICATE_CHARS', '12'))
+BOT_MIN_DUPLICATE_WORDS = int(os.getenv('BOT_MIN_DUPLICATE_WORDS', '3'))
+
+# Caracteres del texto normalizado a partir de los cuales se ignoran los números
+BOT_LONG_TEXT_CHARS = int(os.getenv('BOT_LONG_TEXT_CHARS', '80'))
+
+# Caracteres del texto normalizado que se usan para la huella
+_MAX_FINGERPRINT_CHARS = 1024
+
+_DIGITS = re.compile(r'\d+')
+_NON_WORD = re.compile(r'[^a-z0-9]+')
+
+def normalize_text(content):
+    """
+    Normaliza el texto de un mensaje para comparar mensajes casi iguales.
+
+    Args:
+        content: Contenido del mensaje
+
+    Returns:
+        str: Texto en minúsculas, sin acentos, emojis ni signos
+    """
+    text = content if isinstance(content, str) else repr(content)
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    return _NON_WORD.sub(' ', text).strip()
+
+def _shingles(text):
+    """Trigramas de caracteres del texto (o el texto entero si es más corto)"""
+    if len(text) < 3:
+        return [text]
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode('ascii'), digest_size=8).digest(), 'big')
+
+def simhash(text):
+    """
+    Huella SimHash de 64 bits de un texto ya normalizado.
+
+    Args:
+        text (str): Texto normalizado
+
+    Returns:
+        int: Huella de 64 bits
+    """
+    weights = [0] * 64
+    for shingle in _shingles(text[:_MAX_FINGERPRINT_CHARS]):
+        value = _hash64(shingle)
+        for bit in range(64):
+            if value >> bit & 1:
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+def message_fingerprint(content):
+    """
+    Huella de un mensaje para la detección de casi duplicados.
+
+    Args:
+        content: Contenido del mensaje
+
+    Returns:
+        int: Huella SimHash de 64 bits del texto normalizado, o None si el
+             mensaje es demasiado corto para contar como casi duplicado
+    """
+    text = normalize_text(content)
+    if len(text) < BOT_MIN_DUPLICATE_CHARS or len(text.split()) < BOT_MIN_DUPLICATE_WORDS:
+        return None
+    if len(text) >= BOT_LONG_TEXT_CHARS:
+        return simhash(_DIGITS.sub('0', text))
+
+    fingerprint = simhash(text)
+    numbers = _DIGITS.findall(text)
+    if numbers:
+        # Con números distintos la huella cambia por completo (unos 32 bits de media)
+        fingerprint ^= _hash64(' '.join(numbers))
+    return fingerprint
+
+def hamming_distance(a, b):
+    """Número de bits distintos entre dos huellas"""
+    return bin(a ^ b).count('1')
+
+def count_near_duplicates(fingerprints, fingerprint, max_distance=BOT_SIMHASH_DISTANCE):
+    """
+    Cuenta las huellas que están a max_distance bits o menos de una huella dada.
+
+    Args:
+        fingerprints (iterable): Huellas con las que comparar (None no cuenta)
+        fingerprint (int): Huella de referencia
+        max_distance (int): Distancia de Hamming máxima
+
+    Returns:
+        int: Número de huellas casi iguales (incluida la propia si está en la lista)
+    """
+    return sum(1 for other in fingerprints
+               if other is not None and hamming_distance(other, fingerprint) <= max_distance)
+
+def interval_features(arrivals):
+    """
+    Calcula las características de ritmo de una secuencia de llegadas.
+
+    Args:
+        arrivals (list): Horas de llegada en segundos Unix, en orden
+
+    Returns:
+        dict: Número de intervalos, intervalo medio (segundos), coeficiente de
+              variación (None si todos los mensajes llegaron a la vez) y segundos
+              entre la primera y la última llegada
+    """
+    intervals = [max(b - a, 0) for a, b in zip(arrivals, arrivals[1:])]
+    if not intervals:
+        return {'intervals': 0, 'mean_interval': None, 'interval_cv': None, 'span': 0}
+    average = mean(intervals)
+    cv = pstdev(intervals) / average if average > 0 else None
+    return {'intervals': len(intervals), 'mean_interval': average, 'interval_cv': cv, 'span': sum(intervals)}
+
+def evaluate_sketch(entries, repeat_threshold, max_distance=BOT_SIMHASH_DISTANCE):
+    """
+    Evalúa el boceto de un número tras recibir su último mensaje.
+
+    Args:
+        entries (list): Pares (huella, hora de llegada en segundos) de los últimos mensajes, en orden
+        repeat_threshold (int): Mensajes casi iguales necesarios para considerar bot
+        max_distance (int): Distancia de Hamming máxima entre mensajes casi iguales
+
+    Returns:
+        dict: 'is_bot', 'reason' ('repetition', 'cadence' o None), 'near_duplicates'
+              y las características de ritmo
+    """
+    verdict = {'is_bot': False, 'reason': None, 'near_duplicates': 0}
+    if not entries:
+        verdict.update(interval_features([]))
+        return verdict
+
+    latest_fingerprint = entries[-1][0]
+    if latest_fingerprint is not None:
+        verdict['near_duplicates'] = count_near_duplicates(
+            (fingerprint for fingerprint, _ in entries), latest_fingerprint, max_distance
+        )
+    verdict.update(interval_features([arrival for _, arrival in entries]))
+
+    if verdict['near_duplicates'] >= repeat_threshold:
+        verdict['is_bot'] = True
+        verdict['reason'] = 'repetition'
+    elif (verdict['intervals'] >= BOT_MIN_INTERVALS
+          and verdict['span'] >= BOT_MIN_CADENCE_SPAN
+          and 0 < verdict['mean_interval'] <= BOT_MAX_MEAN_INTERVAL
+          and verdict['interval_cv'] <= BOT_INTERVAL_CV):
+        verdict['is_bot'] = True
+        verdict['reason'] = 'cadence'
+    return verdict
+
+def scan_messages(messages, repeat_threshold, history_size, max_distance=BOT_SIMHASH_DISTANCE):
+    """
+    Recorre mensajes guardados con el mismo boceto que se usa al recibirlos.
+
+    Args:
+        messages (iterable): Pares (contenido, hora de llegada en segundos) de los mensajes recibidos, en orden
+        repeat_threshold (int): Mensajes casi iguales necesarios para considerar bot
+        history_size (int): Tamaño del boceto (mensajes recientes por número)
+        max_distance (int): Distancia de Hamming máxima entre mensajes casi iguales
+
+    Returns:
+        dict: Primera evaluación positiva con el mensaje que la provocó en 'message',
+              o None si no se detecta un bot
+    """
+    sketch = deque(maxlen=history_size)
+    for content, arrival in messages:
+        sketch.append((message_fingerprint(content), arrival))
+        verdict = evaluate_sketch(list(sketch), repeat_threshold, max_distance)
+        if verdict['is_bot']:
+            verdict['message'] = content
+            return verdict
+    return None
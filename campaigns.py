@@ -0,0 +1,433 @@
+"""
+Campañas de envío masivo (texto o plantilla de WhatsApp, o SMS).
+
+La audiencia se resuelve a partir de los metadatos de las conversaciones
+(etiqueta, estado y, opcionalmente, una lista de teléfonos) y se guarda al crear
+la campaña, junto con el estado de entrega de cada destinatario, en SQLite
+(data/campaigns.db). El ejecutor pone los mensajes en la cola de salida por
+tandas, con un máximo de mensajes en vuelo por campaña para no retrasar las
+respuestas a las conversaciones en curso; el ritmo por canal, los reintentos y
+el orden por destinatario los aplica el despachador de la cola.
+
+Como el estado de cada destinatario está en disco y cada mensaje se encola con
+una clave de idempotencia, una campaña interrumpida por un reinicio continúa
+donde se quedó sin enviar dos veces el mismo mensaje. Las claves de una campaña
+comparten el prefijo campaign:<id>:, con el que la cola retiene sus mensajes
+mientras está en pausa y los descarta al cancelarla.
+"""
+
+import json
+import os
+import threading
+import time
+
+from db import get_connection, transaction, register_migrations, ensure_schema
+
+# Mensajes en vuelo (encolados y aún sin enviar) por campaña
+CAMPAIGN_MAX_IN_FLIGHT = int(os.getenv('CAMPAIGN_MAX_IN_FLIGHT', '50'))
+
+# Segundos entre dos pasadas del ejecutor
+CAMPAIGN_POLL_INTERVAL = 1.0
+
+# Canales y tipos de mensaje admitidos
+CAMPAIGN_CHANNELS = ('whatsapp', 'sms')
+CAMPAIGN_MESSAGE_TYPES = ('text', 'template')
+
+# Estados de una campaña y de cada destinatario
+CAMPAIGN_STATES = ('draft', 'running', 'paused', 'completed', 'cancelled')
+RECIPIENT_STATES = ('pending', 'queued', 'sent', 'failed', 'skipped', 'cancelled')
+
+def campaign_dedupe_prefix(campaign_id):
+    """Prefijo de las claves de idempotencia de los mensajes de una campaña"""
+    return f"campaign:{campaign_id}:"
+
+class CampaignStore:
+    """
+    Campañas y estado de entrega por destinatario sobre SQLite.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite de campañas
+        """
+        self.db_path = db_path
+        register_migrations(db_path, [
+            (1, "Campañas y destinatarios", self._migration_create_tables),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea las tablas de campañas y destinatarios"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            content TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'draft',
+            created_by TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            campaign_id INTEGER NOT NULL,
+            phone_number TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            queue_id INTEGER,
+            message_id TEXT,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (campaign_id, phone_number)
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_campaign_recipients_state ON campaign_recipients (campaign_id, state)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_campaigns_state ON campaigns (state)')
+
+    @staticmethod
+    def _campaign_to_dict(row):
+        campaign = dict(row)
+        campaign['content'] = json.loads(campaign['content'])
+        campaign['audience'] = json.loads(campaign['audience'])
+        return campaign
+
+    def create(self, name, channel, message_type, content, audience, phone_numbers, created_by=None):
+        """
+        Crea una campaña en borrador con su lista de destinatarios.
+
+        Args:
+            name (str): Nombre de la campaña
+            channel (str): 'whatsapp' o 'sms'
+            message_type (str): 'text' o 'template'
+            content (dict): {'text': ...} o {'name': ..., 'language': ...} para plantillas
+            audience (dict): Criterios con los que se resolvió la audiencia
+            phone_numbers (iterable): Teléfonos normalizados de la audiencia
+            created_by (str, optional): Usuario que crea la campaña
+
+        Returns:
+            int: ID de la campaña
+        """
+        now = time.time()
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute('''
+            INSERT INTO campaigns (name, channel, message_type, content, audience, created_by, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (name, channel, message_type, json.dumps(content, ensure_ascii=False),
+                  json.dumps(audience, ensure_ascii=False), created_by, now))
+            campaign_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT OR IGNORE INTO campaign_recipients (campaign_id, phone_number, updated_at) VALUES (?, ?, ?)',
+                [(campaign_id, phone_number, now) for phone_number in phone_numbers]
+            )
+        return campaign_id
+
+    def get(self, campaign_id):
+        """
+        Obtiene una campaña con el número de destinatarios por estado.
+
+        Returns:
+            dict: Campaña, o None si no existe
+        """
+        conn = get_connection(self.db_path)
+        row = conn.execute('SELECT * FROM campaigns WHERE id = ?', (campaign_id,)).fetchone()
+        if row is None:
+            return None
+        campaign = self._campaign_to_dict(row)
+        campaign['recipients'] = self.count_by_state(campaign_id)
+        return campaign
+
+    def list(self):
+        """
+        Obtiene todas las campañas, de la más reciente a la más antigua.
+
+        Returns:
+            list: Campañas con el número de destinatarios por estado
+        """
+        conn = get_connection(self.db_path)
+        counts = {}
+        for row in conn.execute(
+            'SELECT campaign_id, state, COUNT(*) AS count FROM campaign_recipients GROUP BY campaign_id, state'
+        ):
+            counts.setdefault(row['campaign_id'], {})[row['state']] = row['count']
+
+        campaigns = []
+        for row in conn.execute('SELECT * FROM campaigns ORDER BY id DESC'):
+            campaign = self._campaign_to_dict(row)
+            campaign['recipients'] = counts.get(campaign['id'], {})
+            campaigns.append(campaign)
+        return campaigns
+
+    def count_by_state(self, campaign_id):
+        """Número de destinatarios de una campaña por estado"""
+        cursor = get_connection(self.db_path).execute(
+            'SELECT state, COUNT(*) AS count FROM campaign_recipients WHERE campaign_id = ? GROUP BY state',
+            (campaign_id,)
+        )
+        return {row['state']: row['count'] for row in cursor}
+
+    def get_recipients(self, campaign_id, state=None, limit=100, offset=0):
+        """
+        Destinatarios de una campaña, opcionalmente filtrados por estado.
+
+        Returns:
+            list: Destinatarios con su estado de entrega
+        """
+        query = 'SELECT * FROM campaign_recipients WHERE campaign_id = ?'
+        params = [campaign_id]
+        if state:
+            query += ' AND state = ?'
+            params.append(state)
+        query += ' ORDER BY phone_number LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+        return [dict(row) for row in get_connection(self.db_path).execute(query, params)]
+
+    def set_state(self, campaign_id, state, allowed_from):
+        """
+        Cambia el estado de una campaña si está en uno de los estados permitidos.
+
+        Args:
+            campaign_id (int): ID de la campaña
+            state (str): Nuevo estado
+            allowed_from (tuple): Estados desde los que se permite el cambio
+
+        Returns:
+            bool: True si se cambió el estado
+        """
+        now = time.time()
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute(
+                f"UPDATE campaigns SET state = ?, "
+                f"started_at = CASE WHEN ? = 'running' AND started_at IS NULL THEN ? ELSE started_at END, "
+                f"finished_at = CASE WHEN ? IN ('completed', 'cancelled') THEN ? ELSE finished_at END "
+                f"WHERE id = ? AND state IN ({','.join('?' * len(allowed_from))})",
+                (state, state, now, state, now, campaign_id, *allowed_from)
+            )
+            return cursor.rowcount > 0
+
+    def get_running(self):
+        """Campañas en curso"""
+        cursor = get_connection(self.db_path).execute("SELECT * FROM campaigns WHERE state = 'running' ORDER BY id")
+        return [self._campaign_to_dict(row) for row in cursor]
+
+    def get_in_flight(self, campaign_id):
+        """
+        Destinatarios encolados cuyo envío aún no ha terminado.
+
+        Returns:
+            dict: {ID en la cola: teléfono}
+        """
+        cursor = get_connection(self.db_path).execute(
+            "SELECT phone_number, queue_id FROM campaign_recipients WHERE campaign_id = ? AND state = 'queued'",
+            (campaign_id,)
+        )
+        return {row['queue_id']: row['phone_number'] for row in cursor}
+
+    def get_pending(self, campaign_id, limit):
+        """Siguientes destinatarios sin encolar"""
+        cursor = get_connection(self.db_path).execute(
+            "SELECT phone_number FROM campaign_recipients WHERE campaign_id = ? AND state = 'pending' "
+            "ORDER BY phone_number LIMIT ?",
+            (campaign_id, limit)
+        )
+        return [row['phone_number'] for row in cursor]
+
+    def update_recipients(self, campaign_id, updates):
+        """
+        Actualiza en una sola transacción el estado de varios destinatarios.
+
+        Args:
+            campaign_id (int): ID de la campaña
+            updates (list): Tuplas (teléfono, estado, ID en la cola, ID del mensaje, error)
+        """
+        if not updates:
+            return
+        now = time.time()
+        with transaction(self.db_path) as conn:
+            # Un destinatario cancelado no cambia aunque una pasada en curso lo haya encolado
+            conn.executemany('''
+            UPDATE campaign_recipients
+            SET state = ?, queue_id = COALESCE(?, queue_id), message_id = ?, error = ?, updated_at = ?
+            WHERE campaign_id = ? AND phone_number = ? AND state != 'cancelled'
+            ''', [
+                (state, queue_id, message_id, error, now, campaign_id, phone_number)
+                for phone_number, state, queue_id, message_id, error in updates
+            ])
+
+    def cancel_recipients(self, campaign_id, phone_numbers):
+        """
+        Marca como cancelados los destinatarios sin encolar y los encolados cuyo mensaje se canceló.
+
+        Args:
+            campaign_id (int): ID de la campaña
+            phone_numbers (iterable): Teléfonos con el mensaje cancelado en la cola
+
+        Returns:
+            int: Destinatarios cancelados
+        """
+        now = time.time()
+        with transaction(self.db_path) as conn:
+            cancelled = conn.execute(
+                "UPDATE campaign_recipients SET state = 'cancelled', updated_at = ? "
+                "WHERE campaign_id = ? AND state = 'pending'",
+                (now, campaign_id)
+            ).rowcount
+            for phone_number in phone_numbers:
+                cancelled += conn.execute(
+                    "UPDATE campaign_recipients SET state = 'cancelled', updated_at = ? "
+                    "WHERE campaign_id = ? AND phone_number = ? AND state = 'queued'",
+                    (now, campaign_id, phone_number)
+                ).rowcount
+        return cancelled
+
+def build_payload(campaign):
+    """
+    Cuerpo del mensaje de una campaña para la API del canal y texto que se guarda en la conversación.
+
+    Returns:
+        tuple: (payload, contenido)
+    """
+    content = campaign['content']
+    if campaign['message_type'] == 'template':
+        payload = {
+            'type': 'template',
+            'template': {
+                'name': content['name'],
+                'language': {'code': content.get('language', 'es')}
+            }
+        }
+        if content.get('components'):
+            payload['template']['components'] = content['components']
+        return payload, f"[Plantilla: {content['name']}]"
+
+    if campaign['channel'] == 'sms':
+        return {'text': content['text']}, content['text']
+    return {'type': 'text', 'text': {'body': content['text']}}, content['text']
+
+class CampaignRunner:
+    """
+    Ejecutor en segundo plano de las campañas en curso.
+    """
+
+    def __init__(self, store, dispatcher, message_handler, max_in_flight=CAMPAIGN_MAX_IN_FLIGHT):
+        """
+        Args:
+            store (CampaignStore): Almacén de campañas
+            dispatcher (OutboundDispatcher): Despachador de la cola de salida
+            message_handler (MessageHandler): Gestor de conversaciones (lista negra)
+            max_in_flight (int): Mensajes en vuelo por campaña
+        """
+        self.store = store
+        self.dispatcher = dispatcher
+        self.message_handler = message_handler
+        self.max_in_flight = max_in_flight
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Inicia (una sola vez por proceso) el hilo del ejecutor; reanuda las campañas en curso"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='campaign-runner', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Avisa al ejecutor de que una campaña ha cambiado de estado"""
+        self._wakeup.set()
+
+    def apply_state(self, campaign_id, state):
+        """
+        Aplica a la cola de salida el nuevo estado de una campaña.
+
+        En pausa, sus mensajes encolados y aún sin enviar quedan retenidos; al
+        reanudarla vuelven a la cola, y al cancelarla se descartan y sus
+        destinatarios pasan a 'cancelled'.
+
+        Args:
+            campaign_id (int): ID de la campaña
+            state (str): Estado al que acaba de pasar la campaña
+        """
+        queue = self.dispatcher.queue
+        prefix = campaign_dedupe_prefix(campaign_id)
+        if state == 'paused':
+            queue.hold(prefix)
+        elif state == 'running':
+            if queue.release(prefix):
+                self.dispatcher.wake()
+        elif state == 'cancelled':
+            cancelled = queue.cancel(prefix)
+            self.store.cancel_recipients(campaign_id, cancelled.values())
+        self.wake()
+
+    def _run(self):
+        while True:
+            try:
+                for campaign in self.store.get_running():
+                    self.step(campaign)
+            except Exception as e:
+                print(f"Error en el ejecutor de campañas: {e}")
+            self._wakeup.wait(CAMPAIGN_POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def step(self, campaign):
+        """
+        Avanza una campaña: recoge el resultado de los envíos y encola más destinatarios.
+
+        Args:
+            campaign (dict): Campaña en curso
+
+        Returns:
+            bool: True si la campaña ha terminado
+        """
+        campaign_id = campaign['id']
+        queue = self.dispatcher.queue
+
+        # Recoger el resultado de los mensajes en vuelo
+        in_flight = self.store.get_in_flight(campaign_id)
+        updates = []
+        for queue_id, outbound in queue.get_states(list(in_flight)).items():
+            if outbound['state'] == 'sent':
+                updates.append((in_flight.pop(queue_id), 'sent', None, outbound['message_id'], None))
+            elif outbound['state'] == 'dead':
+                updates.append((in_flight.pop(queue_id), 'failed', None, None, outbound['last_error']))
+            elif outbound['state'] == 'cancelled':
+                updates.append((in_flight.pop(queue_id), 'cancelled', None, None, None))
+        self.store.update_recipients(campaign_id, updates)
+
+        # Encolar más destinatarios hasta el máximo en vuelo
+        free = self.max_in_flight - len(in_flight)
+        pending = self.store.get_pending(campaign_id, free) if free > 0 else []
+        if pending:
+            payload, content = build_payload(campaign)
+            updates = []
+            for phone_number in pending:
+                if phone_number in self.message_handler.bot_blacklist:
+                    updates.append((phone_number, 'skipped', None, None, 'Número en la lista negra'))
+                    continue
+                queue_id = self.dispatcher.enqueue(
+                    campaign['channel'], phone_number, payload, content,
+                    dedupe_key=campaign_dedupe_prefix(campaign_id) + phone_number
+                )
+                updates.append((phone_number, 'queued', queue_id, None, None))
+            self.store.update_recipients(campaign_id, updates)
+            return False
+
+        if not in_flight:
+            self.store.set_state(campaign_id, 'completed', ('running',))
+            print(f"Campaña {campaign_id} completada: {self.store.count_by_state(campaign_id)}")
+            return True
+        return False
@@ -0,0 +1,113 @@
+"""
+Almacenamiento compacto de conversaciones archivadas.
+
+Cada conversación archivada se guarda como un segmento JSON Lines comprimido
+con gzip (archived/<teléfono>.jsonl.gz). La primera línea es una cabecera con
+el resumen de la conversación (número de mensajes, fechas, canal y último
+mensaje), de modo que los listados solo descomprimen esa línea. El resto de líneas son los mensajes, uno
+por línea, y solo se leen al abrir, exportar o desarchivar la conversación.
+"""
+
+import gzip
+import json
+import os
+from datetime import datetime
+
+# Extensión de los segmentos de conversaciones archivadas
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+# Versión del formato de segmento, guardada en la cabecera
+SEGMENT_FORMAT_VERSION = 1
+
+def segment_path(archived_dir, phone_number):
+    """Ruta del segmento de una conversación archivada"""
+    return os.path.join(archived_dir, phone_number + SEGMENT_SUFFIX)
+
+def is_segment(filename):
+    """Indica si un nombre de archivo corresponde a un segmento"""
+    return filename.endswith(SEGMENT_SUFFIX)
+
+def phone_from_segment(filename):
+    """Obtiene el teléfono a partir del nombre de archivo de un segmento"""
+    return filename[:-len(SEGMENT_SUFFIX)]
+
+def build_header(phone_number, messages):
+    """
+    Calcula la cabecera de un segmento.
+
+    Args:
+        phone_number (str): Número de teléfono normalizado
+        messages (list): Mensajes de la conversación
+
+    Returns:
+        dict: Cabecera del segmento
+    """
+    received = [msg for msg in messages if msg.get('direction') == 'received']
+
+    source = "whatsapp"
+    for msg in reversed(messages):
+        if "source" in msg:
+            source = msg["source"]
+            break
+
+    return {
+        'format': SEGMENT_FORMAT_VERSION,
+        'phone_number': phone_number,
+        'message_count': len(messages),
+        'received_count': len(received),
+        'sent_count': len(messages) - len(received),
+        'first_ts': messages[0].get('timestamp') if messages else None,
+        'last_ts': messages[-1].get('timestamp') if messages else None,
+        'source': source,
+        'last_message': messages[-1] if messages else None,
+        'archived_at': datetime.now().isoformat()
+    }
+
+def write_segment(path, phone_number, messages):
+    """
+    Escribe un segmento de forma atómica (archivo temporal y renombrado).
+
+    Args:
+        path (str): Ruta del segmento
+        phone_number (str): Número de teléfono normalizado
+        messages (list): Mensajes de la conversación
+
+    Returns:
+        dict: Cabecera escrita
+    """
+    header = build_header(phone_number, messages)
+    temp_path = path + '.tmp'
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(header, ensure_ascii=False) + '\n')
+        for message in messages:
+            f.write(json.dumps(message, ensure_ascii=False) + '\n')
+    os.replace(temp_path, path)
+    return header
+
+def read_header(path):
+    """
+    Lee solo la cabecera de un segmento.
+
+    Returns:
+        dict: Cabecera, o None si el segmento no se puede leer
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.loads(f.readline())
+    except (OSError, EOFError, json.JSONDecodeError):
+        return None
+
+def read_segment(path):
+    """
+    Lee un segmento completo.
+
+    Returns:
+        tuple: (cabecera, mensajes), o (None, None) si el segmento no se puede leer
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            messages = [json.loads(line) for line in f if line.strip()]
+        return header, messages
+    except (OSError, EOFError, json.JSONDecodeError):
+        return None, None
@@ -0,0 +1,165 @@
+"""
+Exportación en streaming de conversaciones (NDJSON, CSV o ZIP).
+
+Los generadores leen una conversación cada vez y emiten los mensajes a medida
+que se leen, de modo que la memoria usada no depende del número de
+conversaciones exportadas y la respuesta empieza a enviarse de inmediato.
+"""
+
+import csv
+import io
+import json
+import zipfile
+
+from timestamps import message_ts_ms
+
+# Formatos de exportación admitidos
+EXPORT_FORMATS = ('ndjson', 'csv', 'zip')
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'zip': 'application/zip',
+}
+
+EXPORT_EXTENSIONS = {
+    'ndjson': 'jsonl',
+    'csv': 'csv',
+    'zip': 'zip',
+}
+
+# Tamaño a partir del cual se emite lo acumulado
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Columnas del formato CSV
+CSV_COLUMNS = ['phone_number', 'timestamp', 'ts_ms', 'direction', 'type', 'source', 'message_id', 'content']
+
+def iter_messages(message_handler, phone_numbers, since_ms=None, until_ms=None):
+    """
+    Recorre los mensajes de varias conversaciones, una conversación cada vez.
+
+    Args:
+        message_handler (MessageHandler): Gestor de conversaciones
+        phone_numbers (iterable): Teléfonos a exportar
+        since_ms (int, optional): Solo mensajes desde esta fecha (milisegundos Unix)
+        until_ms (int, optional): Solo mensajes hasta esta fecha (milisegundos Unix, inclusive)
+
+    Yields:
+        tuple: (conversación sin mensajes, mensaje)
+    """
+    for phone_number in phone_numbers:
+        conversation = message_handler.get_conversation(phone_number)
+        if conversation is None:
+            continue
+        messages = conversation.pop('messages')
+        for message in messages:
+            if since_ms is not None or until_ms is not None:
+                ts_ms = message_ts_ms(message)
+                if ts_ms is None:
+                    continue
+                if since_ms is not None and ts_ms < since_ms:
+                    continue
+                if until_ms is not None and ts_ms > until_ms:
+                    continue
+            yield conversation, message
+
+def _message_record(conversation, message):
+    """Mensaje con el teléfono de su conversación, para los formatos planos"""
+    record = {'phone_number': conversation['phone_number']}
+    record.update(message)
+    return record
+
+def iter_ndjson(message_handler, phone_numbers, since_ms=None, until_ms=None):
+    """Genera la exportación en JSON Lines: un mensaje por línea"""
+    for conversation, message in iter_messages(message_handler, phone_numbers, since_ms, until_ms):
+        yield json.dumps(_message_record(conversation, message), ensure_ascii=False) + '\n'
+
+def iter_csv(message_handler, phone_numbers, since_ms=None, until_ms=None):
+    """Genera la exportación en CSV: un mensaje por fila"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+
+    for conversation, message in iter_messages(message_handler, phone_numbers, since_ms, until_ms):
+        record = _message_record(conversation, message)
+        if not isinstance(record.get('content'), str):
+            record['content'] = json.dumps(record.get('content'), ensure_ascii=False)
+        writer.writerow(record)
+
+        # Emitir el contenido acumulado por bloques y no fila a fila
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class _ChunkWriter(io.RawIOBase):
+    """Destino no posicionable para zipfile que acumula los bytes escritos"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def drain(self):
+        """Devuelve y vacía los bytes acumulados"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+def iter_zip(message_handler, phone_numbers, since_ms=None, until_ms=None):
+    """
+    Genera un ZIP con un archivo JSON Lines por conversación.
+
+    zipfile escribe en un destino no posicionable (con descriptores de datos),
+    por lo que los datos comprimidos se emiten a medida que se generan.
+    """
+    writer = _ChunkWriter()
+    with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        current_phone = None
+        entry = None
+        for conversation, message in iter_messages(message_handler, phone_numbers, since_ms, until_ms):
+            if conversation['phone_number'] != current_phone:
+                if entry is not None:
+                    entry.close()
+                    yield writer.drain()
+                current_phone = conversation['phone_number']
+                entry = archive.open(f'conversations/{current_phone}.jsonl', 'w')
+            entry.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+            if writer.size >= EXPORT_CHUNK_SIZE:
+                yield writer.drain()
+        if entry is not None:
+            entry.close()
+    yield writer.drain()
+
+EXPORT_GENERATORS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+    'zip': iter_zip,
+}
+
+def export_conversations(message_handler, phone_numbers, export_format='ndjson', since_ms=None, until_ms=None):
+    """
+    Genera la exportación de varias conversaciones en el formato indicado.
+
+    Args:
+        message_handler (MessageHandler): Gestor de conversaciones
+        phone_numbers (iterable): Teléfonos a exportar
+        export_format (str): 'ndjson', 'csv' o 'zip'
+        since_ms (int, optional): Solo mensajes desde esta fecha (milisegundos Unix)
+        until_ms (int, optional): Solo mensajes hasta esta fecha (milisegundos Unix, inclusive)
+
+    Returns:
+        generator: Fragmentos (str, o bytes para 'zip') de la exportación
+    """
+    return EXPORT_GENERATORS[export_format](message_handler, phone_numbers, since_ms, until_ms)
@@ -0,0 +1,85 @@
+"""
+Bloqueos por conversación para escrituras concurrentes.
+
+Los bloqueos se reparten en un número fijo de franjas según el número de
+teléfono: las escrituras a una misma conversación se serializan, mientras que
+conversaciones distintas (en franjas distintas) se escriben en paralelo. Cada
+franja combina un bloqueo de hilo con un bloqueo de archivo (fcntl.flock) para
+coordinar también a varios procesos (por ejemplo, workers de gunicorn).
+"""
+
+import os
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo bloqueos entre hilos del mismo proceso
+    fcntl = None
+
+class ConversationLockManager:
+    """
+    Gestor de bloqueos por conversación repartidos en franjas.
+    """
+
+    def __init__(self, lock_dir, stripes=64):
+        """
+        Args:
+            lock_dir (str): Directorio donde se crean los archivos de bloqueo
+            stripes (int, optional): Número de franjas
+        """
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        os.makedirs(lock_dir, exist_ok=True)
+
+        self._thread_locks = [threading.RLock() for _ in range(stripes)]
+        self._file_descriptors = [None] * stripes
+        self._fd_lock = threading.Lock()
+        # Profundidad de anidamiento por franja en el hilo actual, para que un
+        # bloqueo reentrante no libere el flock del bloqueo exterior
+        self._local = threading.local()
+
+    def stripe_for(self, phone_number):
+        """
+        Devuelve la franja de un número de teléfono.
+
+        Se usa crc32 (y no hash()) para que todos los procesos calculen la misma franja.
+        """
+        return zlib.crc32(phone_number.encode('utf-8')) % self.stripes
+
+    def _get_fd(self, stripe):
+        """Obtiene (abriéndolo si es necesario) el archivo de bloqueo de una franja"""
+        fd = self._file_descriptors[stripe]
+        if fd is None:
+            with self._fd_lock:
+                fd = self._file_descriptors[stripe]
+                if fd is None:
+                    path = os.path.join(self.lock_dir, f'{stripe:03d}.lock')
+                    fd = self._file_descriptors[stripe] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        return fd
+
+    @contextmanager
+    def lock(self, phone_number):
+        """
+        Bloquea una conversación durante el bloque.
+
+        Args:
+            phone_number (str): Número de teléfono normalizado
+        """
+        stripe = self.stripe_for(phone_number)
+        depths = getattr(self._local, 'depths', None)
+        if depths is None:
+            depths = self._local.depths = {}
+
+        with self._thread_locks[stripe]:
+            depth = depths.get(stripe, 0)
+            if depth == 0 and fcntl is not None:
+                fcntl.flock(self._get_fd(stripe), fcntl.LOCK_EX)
+            depths[stripe] = depth + 1
+            try:
+                yield
+            finally:
+                depths[stripe] = depth
+                if depth == 0 and fcntl is not None:
+                    fcntl.flock(self._get_fd(stripe), fcntl.LOCK_UN)
@@ -0,0 +1,200 @@
+"""
+Capa compartida de acceso a las bases de datos SQLite.
+
+Cada hilo mantiene una conexión abierta por base de datos, configurada con WAL,
+synchronous=NORMAL y un tiempo de espera ante bloqueos, de modo que las
+peticiones reutilizan la conexión (y su caché de sentencias preparadas) en lugar
+de abrir una nueva en cada llamada.
+
+El esquema de cada base de datos se define como una lista de migraciones
+numeradas. Los módulos registran sus migraciones al importarse (sin tocar el
+disco) y se aplican de forma perezosa la primera vez que un proceso abre una
+conexión, o de forma explícita con `python migrate.py` durante el despliegue.
+Las versiones aplicadas quedan registradas en la tabla schema_version, por lo
+que en los arranques siguientes la comprobación se reduce a una consulta.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Tiempo máximo de espera (en milisegundos) cuando otra conexión tiene el bloqueo de escritura
+BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+# Número de sentencias preparadas que se conservan por conexión
+STATEMENT_CACHE_SIZE = 256
+
+# Conexiones abiertas por hilo, indexadas por ruta de base de datos
+_local = threading.local()
+
+# Migraciones registradas por base de datos: {ruta: [(versión, descripción, función), ...]}
+_migrations = {}
+
+# Bases de datos cuyo esquema ya se verificó en este proceso
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+def _connect(db_path):
+    """
+    Abre y configura una nueva conexión a la base de datos.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+
+    Returns:
+        sqlite3.Connection: Conexión configurada
+    """
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    return conn
+
+def get_connection(db_path):
+    """
+    Obtiene la conexión del hilo actual para una base de datos, abriéndola si es necesario.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+
+    Returns:
+        sqlite3.Connection: Conexión reutilizable del hilo actual
+    """
+    conn = _get_thread_connection(db_path)
+    if db_path not in _migrated:
+        ensure_schema(db_path, conn)
+    return conn
+
+def _get_thread_connection(db_path):
+    """Obtiene la conexión del hilo actual sin verificar el esquema"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_path)
+    if conn is None:
+        conn = connections[db_path] = _connect(db_path)
+    return conn
+
+@contextmanager
+def transaction(db_path):
+    """
+    Ejecuta un bloque dentro de una transacción sobre la conexión del hilo actual.
+
+    Confirma los cambios al salir del bloque y los revierte si se produce una
+    excepción, para que la conexión compartida nunca quede con una transacción
+    abierta.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+
+    Yields:
+        sqlite3.Connection: Conexión del hilo actual
+    """
+    conn = get_connection(db_path)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def close_connections():
+    """Cierra todas las conexiones abiertas por el hilo actual"""
+    connections = getattr(_local, 'connections', None)
+    if not connections:
+        return
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+def register_migrations(db_path, migrations):
+    """
+    Registra las migraciones de una base de datos sin aplicarlas.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+        migrations (list): Tuplas (versión, descripción, función) en orden; cada
+            función recibe la conexión y se ejecuta dentro de una transacción
+    """
+    _migrations[db_path] = sorted(migrations, key=lambda migration: migration[0])
+
+def ensure_schema(db_path, conn=None):
+    """
+    Aplica una sola vez por proceso las migraciones pendientes de una base de datos.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+        conn (sqlite3.Connection, optional): Conexión a utilizar
+
+    Returns:
+        list: Versiones aplicadas en esta llamada
+    """
+    if db_path in _migrated:
+        return []
+
+    with _migrate_lock:
+        if db_path in _migrated:
+            return []
+        applied = migrate(db_path, conn or _get_thread_connection(db_path))
+        _migrated.add(db_path)
+        return applied
+
+def get_schema_version(conn):
+    """Devuelve la versión de esquema aplicada en una conexión (0 si no hay ninguna)"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+def migrate(db_path, conn):
+    """
+    Aplica las migraciones registradas que aún no figuran en schema_version.
+
+    Cada migración se ejecuta en su propia transacción con BEGIN IMMEDIATE, de
+    modo que si varios procesos arrancan a la vez solo uno la aplica.
+
+    Args:
+        db_path (str): Ruta al archivo SQLite
+        conn (sqlite3.Connection): Conexión a utilizar
+
+    Returns:
+        list: Versiones aplicadas
+    """
+    migrations = _migrations.get(db_path, [])
+    if not migrations or get_schema_version(conn) >= migrations[-1][0]:
+        return []
+
+    applied = []
+    for version, description, apply in migrations:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Volver a leer la versión con el bloqueo tomado por si otro proceso se adelantó
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(
+                'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                (version, description, datetime.now().isoformat())
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        print(f"Migración aplicada en {os.path.basename(db_path)}: {version} - {description}")
+        applied.append(version)
+
+    return applied
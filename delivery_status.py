@@ -0,0 +1,457 @@
+"""
+Estado de entrega de los mensajes enviados (enviado, entregado, leído o fallido).
+
+Los avisos de estado de WhatsApp ('statuses' del webhook) y de Telnyx
+('message.sent' y 'message.finalized') llegan en gran número, así que no se
+escriben uno a uno: se acumulan en memoria y se aplican por lotes, en una sola
+transacción, a una tabla indexada por el ID del mensaje (data/delivery.db). Los
+archivos de conversación no se reescriben; el estado se une a los mensajes al
+leerlos.
+
+Los avisos pueden llegar desordenados, por lo que cada mensaje conserva el
+estado más avanzado recibido y la primera fecha de cada estado. Con la fecha
+de envío y la de entrega (o lectura) se calculan las latencias de entrega.
+
+Las lecturas no escriben: el estado de un mensaje combina la fila guardada con
+los avisos aún en memoria, y las métricas se calculan sobre lo ya aplicado
+(como mucho flush_interval segundos por detrás).
+"""
+
+import threading
+import time
+
+from db import get_connection, transaction, register_migrations, ensure_schema
+from timestamps import to_epoch_ms
+from metrics import STORAGE_SECONDS
+
+# Orden de los estados: uno posterior nunca se sustituye por uno anterior
+STATE_RANKS = {
+    'sent': 1,
+    'delivered': 2,
+    'read': 3,
+    'failed': 4,
+}
+
+# Columna con la fecha de cada estado
+STATE_TIME_COLUMNS = {
+    'sent': 'sent_at_ms',
+    'delivered': 'delivered_at_ms',
+    'read': 'read_at_ms',
+    'failed': 'failed_at_ms',
+}
+
+# Estados finales de Telnyx (message.finalized) y su equivalente
+TELNYX_FINAL_STATES = {
+    'delivered': 'delivered',
+    'delivery_failed': 'failed',
+    'sending_failed': 'failed',
+    'delivery_unconfirmed': 'sent',
+}
+
+# Avisos acumulados que provocan una escritura inmediata
+STATUS_BATCH_SIZE = 500
+
+# Segundos máximos que un aviso espera en memoria antes de aplicarse
+STATUS_FLUSH_INTERVAL = 0.5
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def parse_whatsapp_statuses(value):
+    """
+    Convierte los avisos de estado de un cambio del webhook de WhatsApp.
+
+    Args:
+        value (dict): 'value' de un cambio del webhook
+
+    Returns:
+        list: Avisos (dict con message_id, phone_number, channel, state, ts_ms y error)
+    """
+    events = []
+    for status in value.get('statuses', []):
+        state = status.get('status')
+        if state not in STATE_RANKS or not status.get('id'):
+            continue
+        errors = status.get('errors') or []
+        error = None
+        if errors:
+            error = f"{errors[0].get('code', '')} {errors[0].get('title', '')}".strip()
+        events.append({
+            'message_id': status['id'],
+            'phone_number': status.get('recipient_id'),
+            'channel': 'whatsapp',
+            'state': state,
+            'ts_ms': to_epoch_ms(status.get('timestamp')) or _now_ms(),
+            'error': error
+        })
+    return events
+
+def parse_telnyx_event(data):
+    """
+    Convierte un evento message.sent o message.finalized del webhook de Telnyx.
+
+    Args:
+        data (dict): 'data' del webhook
+
+    Returns:
+        list: Avisos (vacía si el evento no es de estado de entrega)
+    """
+    event_type = data.get('event_type')
+    if event_type not in ('message.sent', 'message.finalized'):
+        return []
+    payload = data.get('payload') or {}
+    if not payload.get('id'):
+        return []
+
+    recipient = (payload.get('to') or [{}])[0]
+    if event_type == 'message.sent':
+        state = 'sent'
+        ts_ms = to_epoch_ms(payload.get('sent_at'))
+    else:
+        state = TELNYX_FINAL_STATES.get(recipient.get('status'))
+        if state is None:
+            return []
+        ts_ms = to_epoch_ms(payload.get('completed_at'))
+
+    errors = payload.get('errors') or []
+    error = None
+    if errors:
+        error = f"{errors[0].get('code', '')} {errors[0].get('title', '')}".strip()
+    return [{
+        'message_id': payload['id'],
+        'phone_number': (recipient.get('phone_number') or '').lstrip('+') or None,
+        'channel': 'sms',
+        'state': state,
+        'ts_ms': ts_ms or _now_ms(),
+        'error': error
+    }]
+
+def _percentile(sorted_values, fraction):
+    """Percentil de una lista ordenada (interpolación al valor más cercano por debajo)"""
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def _latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0, 'avg': None, 'p50': None, 'p90': None, 'p99': None}
+    return {
+        'count': len(values),
+        'avg': int(sum(values) / len(values)),
+        'p50': _percentile(values, 0.5),
+        'p90': _percentile(values, 0.9),
+        'p99': _percentile(values, 0.99),
+    }
+
+def _overlay_event(status, event, now):
+    """
+    Aplica a un estado leído de la tabla un aviso aún no guardado, con las mismas
+    reglas que la escritura por lotes.
+
+    Args:
+        status (dict): Fila de message_status (con state_rank), o None si no existe
+        event (dict): Aviso acumulado
+        now (int): Fecha de actualización en milisegundos
+
+    Returns:
+        dict: Estado actualizado
+    """
+    if status is None:
+        status = {
+            'message_id': event['message_id'], 'phone_number': None, 'channel': None,
+            'state': event['state'], 'state_rank': 0, 'error': None,
+            **{column: None for column in STATE_TIME_COLUMNS.values()}
+        }
+    else:
+        status = dict(status)
+    status['phone_number'] = status.get('phone_number') or event.get('phone_number')
+    status['channel'] = status.get('channel') or event.get('channel')
+    rank = STATE_RANKS[event['state']]
+    if rank > status['state_rank']:
+        status['state'] = event['state']
+        status['state_rank'] = rank
+    column = STATE_TIME_COLUMNS[event['state']]
+    if status.get(column) is None:
+        status[column] = event['ts_ms']
+    elif column == 'sent_at_ms':
+        status[column] = min(status[column], event['ts_ms'])
+    if event.get('error'):
+        status['error'] = event['error']
+    status['updated_at_ms'] = now
+    return status
+
+class DeliveryStatusStore:
+    """
+    Estado de entrega por ID de mensaje, con escritura por lotes.
+    """
+
+    def __init__(self, db_path, batch_size=STATUS_BATCH_SIZE, flush_interval=STATUS_FLUSH_INTERVAL):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite
+            batch_size (int): Avisos que provocan una escritura inmediata
+            flush_interval (float): Segundos máximos de espera de un aviso en memoria
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._has_events = threading.Event()
+        self._flusher = None
+        register_migrations(db_path, [
+            (1, "Estado de entrega de los mensajes", self._migration_create_tables),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea la tabla de estados de entrega"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS message_status (
+            message_id TEXT PRIMARY KEY,
+            phone_number TEXT,
+            channel TEXT,
+            state TEXT NOT NULL,
+            state_rank INTEGER NOT NULL,
+            sent_at_ms INTEGER,
+            delivered_at_ms INTEGER,
+            read_at_ms INTEGER,
+            failed_at_ms INTEGER,
+            error TEXT,
+            updated_at_ms INTEGER NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_message_status_sent ON message_status (sent_at_ms)')
+
+    def add_events(self, events):
+        """
+        Acumula avisos de estado; se aplican con el siguiente lote.
+
+        Args:
+            events (list): Avisos de parse_whatsapp_statuses o parse_telnyx_event
+        """
+        if not events:
+            return
+        with self._lock:
+            self._buffer.extend(events)
+            flush_now = len(self._buffer) >= self.batch_size
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_forever, name='delivery-status-flusher', daemon=True)
+                self._flusher.start()
+        if flush_now:
+            self.flush()
+        else:
+            self._has_events.set()
+
+    def buffered(self):
+        """Avisos acumulados pendientes de aplicar"""
+        with self._lock:
+            return len(self._buffer)
+
+    def _flush_forever(self):
+        """Bucle del hilo que aplica los avisos acumulados cada flush_interval segundos"""
+        while True:
+            self._has_events.wait()
+            time.sleep(self.flush_interval)
+            self._has_events.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error al aplicar los estados de entrega: {e}")
+
+    def record_sent(self, message_id, phone_number, channel, sent_at_ms=None):
+        """
+        Registra el envío de un mensaje aceptado por la API (fecha de referencia de las latencias).
+
+        Args:
+            message_id (str): ID devuelto por la API
+            phone_number (str): Número de teléfono normalizado
+            channel (str): 'whatsapp' o 'sms'
+            sent_at_ms (int, optional): Fecha de envío en milisegundos Unix
+        """
+        if not message_id:
+            return
+        self.add_events([{
+            'message_id': message_id,
+            'phone_number': phone_number,
+            'channel': channel,
+            'state': 'sent',
+            'ts_ms': sent_at_ms or _now_ms(),
+            'error': None
+        }])
+
+    def flush(self):
+        """
+        Aplica los avisos acumulados en una sola transacción.
+
+        Returns:
+            int: Avisos aplicados
+        """
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return 0
+
+        now = _now_ms()
+        rows = []
+        for event in events:
+            times = {column: None for column in STATE_TIME_COLUMNS.values()}
+            times[STATE_TIME_COLUMNS[event['state']]] = event['ts_ms']
+            rows.append((
+                event['message_id'], event.get('phone_number'), event.get('channel'),
+                event['state'], STATE_RANKS[event['state']],
+                times['sent_at_ms'], times['delivered_at_ms'], times['read_at_ms'], times['failed_at_ms'],
+                event.get('error'), now
+            ))
+
+        # Un solo escritor por proceso; entre procesos serializa SQLite
+        try:
+            self._apply(rows)
+        except Exception:
+            # Conservar los avisos para el siguiente intento
+            with self._lock:
+                self._buffer[:0] = events
+            raise
+        return len(events)
+
+    def _apply(self, rows):
+        with self._flush_lock, STORAGE_SECONDS.time('delivery_status_flush'), transaction(self.db_path) as conn:
+            conn.executemany('''
+            INSERT INTO message_status (
+                message_id, phone_number, channel, state, state_rank,
+                sent_at_ms, delivered_at_ms, read_at_ms, failed_at_ms, error, updated_at_ms
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(message_id) DO UPDATE SET
+                phone_number = COALESCE(message_status.phone_number, excluded.phone_number),
+                channel = COALESCE(message_status.channel, excluded.channel),
+                state = CASE WHEN excluded.state_rank > message_status.state_rank
+                             THEN excluded.state ELSE message_status.state END,
+                state_rank = MAX(message_status.state_rank, excluded.state_rank),
+                sent_at_ms = MIN(COALESCE(message_status.sent_at_ms, excluded.sent_at_ms),
+                                 COALESCE(excluded.sent_at_ms, message_status.sent_at_ms)),
+                delivered_at_ms = COALESCE(message_status.delivered_at_ms, excluded.delivered_at_ms),
+                read_at_ms = COALESCE(message_status.read_at_ms, excluded.read_at_ms),
+                failed_at_ms = COALESCE(message_status.failed_at_ms, excluded.failed_at_ms),
+                error = COALESCE(excluded.error, message_status.error),
+                updated_at_ms = excluded.updated_at_ms
+            ''', rows)
+
+    def _overlay_pending(self, statuses):
+        """
+        Combina los estados leídos de la tabla con los avisos acumulados de esos mensajes.
+
+        Args:
+            statuses (dict): {ID: fila de message_status o None}; se actualiza en el sitio
+        """
+        with self._lock:
+            pending = [event for event in self._buffer if event['message_id'] in statuses]
+        now = _now_ms()
+        for event in pending:
+            statuses[event['message_id']] = _overlay_event(statuses[event['message_id']], event, now)
+
+    def get_status(self, message_id):
+        """
+        Estado de entrega de un mensaje (incluidos los avisos aún no guardados).
+
+        Returns:
+            dict: Estado y fechas, o None si no hay avisos del mensaje
+        """
+        row = get_connection(self.db_path).execute(
+            'SELECT * FROM message_status WHERE message_id = ?', (message_id,)
+        ).fetchone()
+        statuses = {message_id: dict(row) if row else None}
+        self._overlay_pending(statuses)
+        status = statuses[message_id]
+        if status is None:
+            return None
+        del status['state_rank']
+        return status
+
+    def get_statuses(self, message_ids):
+        """
+        Estado de entrega de varios mensajes (incluidos los avisos aún no guardados).
+
+        Args:
+            message_ids (list): IDs de mensaje
+
+        Returns:
+            dict: {ID: {'state', 'error', 'updated_at_ms'}}
+        """
+        message_ids = [message_id for message_id in message_ids if message_id]
+        if not message_ids:
+            return {}
+        rows = dict.fromkeys(message_ids)
+        conn = get_connection(self.db_path)
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            cursor = conn.execute(
+                f"SELECT * FROM message_status "
+                f"WHERE message_id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for row in cursor:
+                rows[row['message_id']] = dict(row)
+        self._overlay_pending(rows)
+        return {
+            message_id: {
+                'state': row['state'],
+                'error': row['error'],
+                'updated_at_ms': row['updated_at_ms']
+            }
+            for message_id, row in rows.items() if row is not None
+        }
+
+    def get_metrics(self, since_ms, channel=None):
+        """
+        Métricas de entrega de los mensajes enviados desde una fecha.
+
+        Se calculan sobre los avisos ya guardados, sin forzar la escritura del lote
+        en curso.
+
+        Args:
+            since_ms (int): Solo mensajes enviados desde esta fecha (milisegundos Unix)
+            channel (str, optional): Limitar a un canal
+
+        Returns:
+            dict: Mensajes por estado, tasa de fallos y latencias (ms) de envío a entrega y a lectura
+        """
+        query = '''
+        SELECT state, sent_at_ms, delivered_at_ms, read_at_ms
+        FROM message_status WHERE sent_at_ms >= ?
+        '''
+        params = [since_ms]
+        if channel:
+            query += ' AND channel = ?'
+            params.append(channel)
+
+        by_state = {}
+        delivered_latencies = []
+        read_latencies = []
+        for row in get_connection(self.db_path).execute(query, params):
+            by_state[row['state']] = by_state.get(row['state'], 0) + 1
+            if row['delivered_at_ms'] is not None:
+                delivered_latencies.append(max(row['delivered_at_ms'] - row['sent_at_ms'], 0))
+            if row['read_at_ms'] is not None:
+                read_latencies.append(max(row['read_at_ms'] - row['sent_at_ms'], 0))
+
+        total = sum(by_state.values())
+        return {
+            'total': total,
+            'by_state': by_state,
+            'failure_rate': round(by_state.get('failed', 0) / total, 4) if total else None,
+            'latency_ms': {
+                'delivered': _latency_summary(delivered_latencies),
+                'read': _latency_summary(read_latencies),
+            }
+        }
@@ -0,0 +1,176 @@
+"""
+Filtro de entrada para mensajes de números en lista negra o con el límite de respuestas agotado.
+
+Se aplica antes de guardar nada, de modo que una avalancha de spam no cuesta
+la misma E/S que el tráfico real. Según la política configurada para cada
+motivo, el mensaje se guarda como siempre en la conversación ('store'), se
+anota en el registro de cuarentena ('quarantine') o se descarta ('drop'):
+
+    INGRESS_POLICY_BLACKLISTED   (por defecto 'quarantine')
+    INGRESS_POLICY_RATE_LIMITED  (por defecto 'store', para no apartar de la
+                                  bandeja de entrada a clientes que escriben mucho)
+
+El registro de cuarentena es un archivo JSON Lines al que se añaden las
+entradas por lotes (una escritura por lote) y que se rota al superar su tamaño
+máximo, conservando solo una copia anterior.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Políticas posibles para los mensajes filtrados
+INGRESS_POLICIES = ('store', 'quarantine', 'drop')
+
+# Política por motivo de filtrado
+INGRESS_POLICY_BLACKLISTED = os.getenv('INGRESS_POLICY_BLACKLISTED', 'quarantine').lower()
+INGRESS_POLICY_RATE_LIMITED = os.getenv('INGRESS_POLICY_RATE_LIMITED', 'store').lower()
+
+# Tamaño máximo del registro de cuarentena antes de rotarlo (bytes)
+QUARANTINE_MAX_BYTES = int(os.getenv('QUARANTINE_MAX_BYTES', str(10 * 1024 * 1024)))
+
+# Entradas acumuladas que provocan una escritura inmediata
+QUARANTINE_BATCH_SIZE = 100
+
+# Segundos máximos que una entrada espera en memoria antes de escribirse
+QUARANTINE_FLUSH_INTERVAL = 1.0
+
+def ingress_policy(reason):
+    """
+    Política configurada para un motivo de filtrado.
+
+    Args:
+        reason (str): 'blacklisted' o 'rate_limited'
+
+    Returns:
+        str: 'store', 'quarantine' o 'drop'
+    """
+    policy = INGRESS_POLICY_BLACKLISTED if reason == 'blacklisted' else INGRESS_POLICY_RATE_LIMITED
+    if policy not in INGRESS_POLICIES:
+        print(f"Política de entrada desconocida '{policy}', se usa 'quarantine'")
+        return 'quarantine'
+    return policy
+
+class QuarantineLog:
+    """
+    Registro de cuarentena en JSON Lines, escrito por lotes y con tamaño acotado.
+    """
+
+    def __init__(self, path, max_bytes=QUARANTINE_MAX_BYTES, batch_size=QUARANTINE_BATCH_SIZE,
+                 flush_interval=QUARANTINE_FLUSH_INTERVAL):
+        """
+        Args:
+            path (str): Ruta del registro
+            max_bytes (int): Tamaño a partir del cual se rota el registro
+            batch_size (int): Entradas que provocan una escritura inmediata
+            flush_interval (float): Segundos máximos de espera de una entrada en memoria
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.counts = Counter()  # Mensajes filtrados por (motivo, política)
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._timer = None
+        atexit.register(self.flush)
+
+    def record(self, reason, policy):
+        """Cuenta un mensaje filtrado"""
+        with self._lock:
+            self.counts[f'{reason}:{policy}'] += 1
+
+    def add(self, entry):
+        """
+        Añade una entrada al registro (se escribe con el siguiente lote).
+
+        Args:
+            entry (dict): Mensaje en cuarentena
+        """
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.batch_size:
+                flush_now = True
+            else:
+                flush_now = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Escribe las entradas acumuladas en una sola operación"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._buffer:
+                return
+            data = ''.join(self._buffer).encode('utf-8')
+            self._buffer = []
+
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+                with open(self.path, 'ab') as f:
+                    f.write(data)
+            except OSError as e:
+                print(f"Error al escribir el registro de cuarentena: {e}")
+
+    def stats(self):
+        """
+        Contadores de mensajes filtrados y tamaño del registro.
+
+        Returns:
+            dict: Mensajes por motivo y política, entradas pendientes y bytes en disco
+        """
+        with self._lock:
+            pending = len(self._buffer)
+            counts = dict(self.counts)
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {'filtered': counts, 'pending': pending, 'size_bytes': size}
+
+    def tail(self, limit=50):
+        """
+        Últimas entradas escritas en el registro.
+
+        Args:
+            limit (int): Máximo de entradas
+
+        Returns:
+            list: Entradas, de la más antigua a la más reciente
+        """
+        self.flush()
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            # Leer solo el final del archivo
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 256 * limit, 0))
+            lines = f.read().splitlines()[-limit:]
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries
+
+def quarantine_entry(phone_number, reason, msg_type, content, message_id=None, timestamp=None, source='whatsapp'):
+    """Entrada del registro de cuarentena para un mensaje filtrado"""
+    return {
+        'phone_number': phone_number,
+        'reason': reason,
+        'type': msg_type,
+        'content': content,
+        'message_id': message_id,
+        'timestamp': timestamp,
+        'source': source,
+        'quarantined_at': int(time.time() * 1000)
+    }
@@ -1,12 +1,28 @@
 import json
+import logging
 import os
 import re
 import time
 import shutil
+import threading
 from datetime import datetime, timedelta
-from collections import defaultdict, Counter
+from conversation_locks import ConversationLockManager
+from message_search import MessageSearchIndex
+import conversation_archive
+from metadata_store import MetadataStore
+from timestamps import to_epoch_ms, message_ts_ms
+from sender_state import create_sender_state
+from bot_detection import message_fingerprint, evaluate_sketch
+from bot_analysis import BotAnalysisJob
+from ingress_filter import QuarantineLog, ingress_policy, quarantine_entry
+from outbound_dispatcher import OutboundQueue
+from campaigns import CampaignStore
+from delivery_status import DeliveryStatusStore
+from metrics import PROCESS_STAGE_SECONDS, STORAGE_SECONDS, timed
 from tours_db import search_tours, get_tour_by_id, format_tour_info, get_all_tours
-from amadeus_api import amadeus_api
+from amadeus_api import get_amadeus_api
+
+logger = logging.getLogger(__name__)
 
 class MessageHandler:
     """
@@ -26,41 +42,54 @@ class MessageHandler:
         os.makedirs(self.conversations_dir, exist_ok=True)
         os.makedirs(self.archived_dir, exist_ok=True)
         
-        # Cargar o crear archivo de metadatos
-        self.metadata_file = os.path.join(data_dir, 'conversation_metadata.json')
-        self.metadata = self.load_metadata()
+        # Bloqueos por conversación (entre hilos y entre procesos)
+        self.locks = ConversationLockManager(os.path.join(data_dir, 'locks'))
+        
+        # Metadatos de conversaciones (etiquetas, estados y resúmenes) en SQLite; el
+        # antiguo conversation_metadata.json se importa automáticamente la primera vez
+        self.metadata_store = MetadataStore(
+            os.path.join(data_dir, 'conversations.db'),
+            legacy_json_path=os.path.join(data_dir, 'conversation_metadata.json'),
+            conversations_dir=self.conversations_dir,
+            archived_dir=self.archived_dir
+        )
+        
+        # Índice de búsqueda de texto completo sobre los mensajes
+        self.search_index = MessageSearchIndex(
+            os.path.join(data_dir, 'search.db'),
+            [self.conversations_dir, self.archived_dir]
+        )
+        
+        # Hilo que calcula los datos pendientes de las migraciones (resúmenes iniciales
+        # e indexado de los mensajes existentes)
+        self._backfill_thread = None
+        self._backfill_lock = threading.Lock()
         
         # Sistema anti-bot
-        self.message_history = defaultdict(list)  # Historial de mensajes por número
+        # Últimos mensajes y respuestas por número; con ANTI_BOT_BACKEND=sqlite se comparte entre procesos
+        self.sender_state = create_sender_state(data_dir)
         self.bot_blacklist = set()  # Lista negra de números identificados como bots
-        self.response_timestamps = defaultdict(list)  # Timestamps de respuestas por número
         self.max_responses_per_hour = 10  # Máximo de respuestas automáticas por hora
-        self.bot_detection_threshold = 3  # Número de mensajes similares para considerar bot
+        self.bot_detection_threshold = 3  # Número de mensajes casi iguales para considerar bot
         
         # Cargar lista negra si existe
         self.bot_blacklist_file = os.path.join(data_dir, 'bot_blacklist.json')
         self.load_bot_blacklist()
-    
-    def load_metadata(self):
-        """Cargar metadatos de conversaciones o crear si no existe"""
-        if os.path.exists(self.metadata_file):
-            try:
-                with open(self.metadata_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                # Si hay un error al cargar, crear un nuevo archivo
-                pass
         
-        # Estructura inicial de metadatos
-        return {
-            "tags": {},  # Etiquetas por conversación
-            "status": {}  # Estado por conversación
-        }
-    
-    def save_metadata(self):
-        """Guardar metadatos de conversaciones"""
-        with open(self.metadata_file, 'w', encoding='utf-8') as f:
-            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
+        # Análisis de bots sobre las conversaciones guardadas (en segundo plano e incremental)
+        self.bot_analysis = BotAnalysisJob(self)
+        
+        # Registro de cuarentena para los mensajes filtrados a la entrada
+        self.quarantine = QuarantineLog(os.path.join(data_dir, 'quarantine.jsonl'))
+        
+        # Cola persistente de mensajes salientes (la consume el despachador de app.py)
+        self.outbound_queue = OutboundQueue(os.path.join(data_dir, 'outbound.db'))
+        
+        # Campañas de envío masivo y estado de entrega por destinatario
+        self.campaigns = CampaignStore(os.path.join(data_dir, 'campaigns.db'))
+        
+        # Estado de entrega de los mensajes enviados, por ID de mensaje
+        self.delivery_status = DeliveryStatusStore(os.path.join(data_dir, 'delivery.db'))
     
     def load_bot_blacklist(self):
         """Cargar lista negra de bots"""
@@ -94,184 +123,307 @@ class MessageHandler:
         # Normalizar el número de teléfono
         from_number = self.normalize_phone_number(from_number)
         
-        # Verificar si el número está en la lista negra de bots
-        if from_number in self.bot_blacklist:
-            print(f"Mensaje ignorado de número en lista negra: {from_number}")
-            # Guardar el mensaje pero no responder
-            self.save_message(from_number, "received", message_type, message_content, message_id, timestamp)
-            return None
+        # Filtrar números en lista negra o sin respuestas disponibles antes de guardar nada
+        with PROCESS_STAGE_SECONDS.time('screen'):
+            if not self.screen_incoming(from_number, message_type, message_content, message_id, timestamp):
+                return None
         
-        # Verificar límite de frecuencia de respuestas
-        if not self.can_send_response(from_number):
-            print(f"Límite de respuestas excedido para: {from_number}")
-            # Guardar el mensaje pero no responder
+        with PROCESS_STAGE_SECONDS.time('persist'):
+            # Guardar el mensaje en el historial
             self.save_message(from_number, "received", message_type, message_content, message_id, timestamp)
-            return None
-        
-        # Guardar el mensaje en el historial
-        self.save_message(from_number, "received", message_type, message_content, message_id, timestamp)
-        
-        # Actualizar historial para detección de bots
-        self.update_message_history(from_number, message_content)
-        
-        # Verificar si es un bot basado en patrones repetitivos
-        if self.is_bot(from_number):
-            print(f"Bot detectado: {from_number}")
-            self.bot_blacklist.add(from_number)
-            self.save_bot_blacklist()
-            # Añadir etiqueta de bot a la conversación
-            tags = self.get_conversation_tags(from_number)
-            if "Bot" not in tags:
-                tags.append("Bot")
-                self.set_conversation_tags(from_number, tags)
-            return None
+            
+            # Actualizar historial para detección de bots
+            self.update_message_history(from_number, message_content, timestamp)
+        
+        with PROCESS_STAGE_SECONDS.time('bot_check'):
+            # Verificar si es un bot (mensajes casi iguales o ritmo de envío mecánico)
+            if self.is_bot(from_number):
+                logger.warning("Bot detectado: %s", from_number)
+                self.bot_blacklist.add(from_number)
+                self.save_bot_blacklist()
+                # Añadir etiqueta de bot a la conversación
+                tags = self.get_conversation_tags(from_number)
+                if "Bot" not in tags:
+                    tags.append("Bot")
+                    self.set_conversation_tags(from_number, tags)
+                return None
+            
+            # Reservar la respuesta en el control de frecuencia (comprobación y registro
+            # atómicos, también entre procesos con el backend compartido)
+            if not self.sender_state.acquire_response(from_number, self.max_responses_per_hour, 3600):
+                logger.info("Límite de respuestas excedido para: %s", from_number)
+                return None
         
-        # Generar respuesta basada en el tipo de mensaje y contenido
-        response = self.generate_response(from_number, message_type, message_content)
+        # Generar respuesta basada en el tipo de mensaje y contenido; se guarda en
+        # el historial, con el ID devuelto por la API, cuando el despachador la envía
+        with PROCESS_STAGE_SECONDS.time('generate'):
+            return self.generate_response(from_number, message_type, message_content)
+    
+    def screen_incoming(self, phone_number, message_type, message_content, message_id=None, timestamp=None,
+                        source="whatsapp", check_rate_limit=True):
+        """
+        Filtro de entrada: decide qué hacer con un mensaje antes de guardarlo.
         
-        # Registrar timestamp de respuesta para control de frecuencia
-        self.response_timestamps[from_number].append(time.time())
+        Los mensajes de números en lista negra o que han agotado su límite de
+        respuestas se guardan, se anotan en el registro de cuarentena o se
+        descartan según la política configurada (ver ingress_filter).
         
-        # Guardar la respuesta en el historial
-        self.save_message(from_number, "sent", "text", response)
+        Args:
+            phone_number (str): Número de teléfono normalizado
+            check_rate_limit (bool): Comprobar también el límite de respuestas
+            
+        Returns:
+            bool: True si el mensaje debe procesarse con normalidad
+        """
+        if phone_number in self.bot_blacklist:
+            reason = 'blacklisted'
+        elif check_rate_limit and not self.can_send_response(phone_number):
+            reason = 'rate_limited'
+        else:
+            return True
         
-        return response
+        policy = ingress_policy(reason)
+        self.quarantine.record(reason, policy)
+        # El contador de QuarantineLog ya refleja el volumen; el detalle solo en depuración
+        logger.debug("Mensaje filtrado de %s (%s): %s", phone_number, reason, policy)
+        if policy == 'store':
+            # Guardar el mensaje pero no responder
+            self.save_message(phone_number, "received", message_type, message_content, message_id, timestamp, source)
+        elif policy == 'quarantine':
+            self.quarantine.add(quarantine_entry(
+                phone_number, reason, message_type, message_content, message_id, timestamp, source
+            ))
+        return False
     
-    def update_message_history(self, phone_number, message_content):
+    def update_message_history(self, phone_number, message_content, timestamp=None):
         """Actualizar historial de mensajes para detección de bots"""
-        # Mantener solo los últimos 10 mensajes
-        if len(self.message_history[phone_number]) >= 10:
-            self.message_history[phone_number].pop(0)
-        
-        self.message_history[phone_number].append(message_content)
+        # Se guardan solo la huella SimHash y la hora de llegada de los últimos mensajes;
+        # se usa la marca de tiempo del mensaje para que los reintentos del webhook
+        # no parezcan una ráfaga
+        ts_ms = to_epoch_ms(timestamp)
+        arrival = ts_ms / 1000 if ts_ms is not None else time.time()
+        self.sender_state.add_message(phone_number, message_fingerprint(message_content), arrival)
     
     def is_bot(self, phone_number):
-        """Detectar si un número es un bot basado en patrones repetitivos"""
-        if len(self.message_history[phone_number]) < self.bot_detection_threshold:
-            return False
-        
-        # Contar ocurrencias de cada mensaje
-        message_counts = Counter(self.message_history[phone_number])
-        
-        # Si algún mensaje se repite más del umbral, considerar bot
-        most_common = message_counts.most_common(1)
-        if most_common and most_common[0][1] >= self.bot_detection_threshold:
-            return True
-        
-        return False
+        """Detectar si un número es un bot por mensajes casi iguales o ritmo de envío mecánico"""
+        verdict = evaluate_sketch(self.sender_state.recent_messages(phone_number), self.bot_detection_threshold)
+        if verdict['is_bot']:
+            logger.info("Señal de bot para %s: %s (%s mensajes casi iguales, intervalo medio %s)",
+                        phone_number, verdict['reason'], verdict['near_duplicates'], verdict['mean_interval'])
+        return verdict['is_bot']
     
     def can_send_response(self, phone_number):
         """Verificar si se puede enviar una respuesta basado en límites de frecuencia"""
-        # Obtener timestamps de la última hora
-        one_hour_ago = time.time() - 3600
-        recent_responses = [t for t in self.response_timestamps[phone_number] if t > one_hour_ago]
+        # Comprobación previa sin registrar nada; la reserva definitiva se hace en process_message
+        return self.sender_state.under_limit(phone_number, self.max_responses_per_hour, 3600)
+    
+    def analyze_existing_conversations(self, full=True):
+        """
+        Analizar conversaciones existentes para detectar bots (en el hilo actual).
         
-        # Actualizar lista de timestamps recientes
-        self.response_timestamps[phone_number] = recent_responses
+        Para no bloquear una petición, usar bot_analysis.start().
         
-        # Verificar si se excede el límite por hora
-        return len(recent_responses) < self.max_responses_per_hour
+        Args:
+            full (bool): Analizar todos los mensajes y no solo los recibidos desde la última pasada
+            
+        Returns:
+            list: Bots detectados, o None si ya hay un análisis en curso
+        """
+        return self.bot_analysis.run(full=full)
     
-    def analyze_existing_conversations(self):
-        """Analizar conversaciones existentes para detectar bots"""
-        print("Analizando conversaciones existentes para detectar bots...")
-        detected_bots = []
-        
-        # Obtener todas las conversaciones (activas y archivadas)
-        conversations = self.get_conversations(include_archived=True)
+    @timed(STORAGE_SECONDS, 'save_message')
+    def save_message(self, phone_number, direction, msg_type, content, message_id=None, timestamp=None, source="whatsapp"):
+        # Normalizar número de teléfono
+        phone_number = self.normalize_phone_number(phone_number)
         
-        for conversation in conversations:
-            phone_number = conversation['phone_number']
-            messages = conversation['messages']
+        # Crear el índice de búsqueda y los resúmenes antes de escribir, para que
+        # su cálculo inicial a partir del historial no incluya también este mensaje
+        self.search_index.init_db()
+        self.metadata_store.init_db()
+        self._start_backfills()
+        
+        # Serializar las escrituras a esta conversación (lectura-modificación-escritura)
+        with self.locks.lock(phone_number):
+            # Crear directorio para el número si no existe
+            conversation_dir = os.path.join(self.conversations_dir, phone_number)
+            os.makedirs(conversation_dir, exist_ok=True)
             
-            # Saltear si ya está en la lista negra
-            if phone_number in self.bot_blacklist:
-                continue
+            # Archivo de mensajes
+            messages_file = os.path.join(conversation_dir, 'messages.json')
             
-            # Filtrar solo mensajes recibidos
-            received_messages = [msg for msg in messages if msg['direction'] == 'received']
+            # Cargar mensajes existentes o crear lista vacía
+            if os.path.exists(messages_file):
+                with open(messages_file, 'r', encoding='utf-8') as f:
+                    try:
+                        messages = json.load(f)
+                    except json.JSONDecodeError:
+                        messages = []
+            else:
+                messages = []
             
-            # Si hay pocos mensajes, no analizar
-            if len(received_messages) < self.bot_detection_threshold:
-                continue
+            # Crear nuevo mensaje (ts_ms: marca de tiempo canónica en milisegundos Unix)
+            timestamp = timestamp or datetime.now().isoformat()
+            ts_ms = to_epoch_ms(timestamp)
+            message = {
+                "direction": direction,
+                "type": msg_type,
+                "content": content,
+                "timestamp": timestamp,
+                "ts_ms": ts_ms if ts_ms is not None else int(time.time() * 1000),
+                "message_id": message_id,
+                "source": source
+            }
             
-            # Contar ocurrencias de cada mensaje
-            message_contents = [msg['content'] for msg in received_messages]
-            message_counts = Counter(message_contents)
+            # Añadir mensaje a la lista
+            messages.append(message)
             
-            # Verificar si hay mensajes repetidos que superen el umbral
-            most_common = message_counts.most_common(1)
-            if most_common and most_common[0][1] >= self.bot_detection_threshold:
-                bot_message = most_common[0][0]
-                repetitions = most_common[0][1]
-                print(f"Bot detectado: {phone_number} - Mensaje '{bot_message[:30]}...' repetido {repetitions} veces")
-                detected_bots.append({
-                    'phone_number': phone_number,
-                    'message': bot_message,
-                    'repetitions': repetitions
-                })
-                
-                # Añadir a la lista negra
-                self.bot_blacklist.add(phone_number)
-                
-                # Añadir etiqueta de bot a la conversación
-                tags = self.get_conversation_tags(phone_number)
-                if "Bot" not in tags:
-                    tags.append("Bot")
-                    self.set_conversation_tags(phone_number, tags)
+            # Guardar mensajes
+            with open(messages_file, 'w', encoding='utf-8') as f:
+                json.dump(messages, f, ensure_ascii=False, indent=2)
+            
+            # Si es un mensaje nuevo recibido, establecer estado como 'new' si no tiene estado
+            if direction == 'received':
+                self.metadata_store.set_status_if_missing(phone_number, 'new')
+            
+            self.search_index.add_message(phone_number, message)
+            
+            self.metadata_store.record_message(phone_number, message)
+            
+        return message
+    
+    def _start_backfills(self):
+        """Inicia (una vez por proceso) el cálculo en segundo plano de los resúmenes y el índice de búsqueda pendientes"""
+        if self._backfill_thread is not None:
+            return
+        with self._backfill_lock:
+            if self._backfill_thread is None:
+                self._backfill_thread = threading.Thread(
+                    target=self._run_backfills, name='metadata-backfill', daemon=True
+                )
+                self._backfill_thread.start()
+    
+    def _run_backfills(self):
+        try:
+            self.metadata_store.run_backfills(self.locks, names=['conversation_summaries'])
+        except Exception as e:
+            logger.exception("Error al calcular los resúmenes de conversaciones: %s", e)
+        try:
+            self.search_index.init_db()
+            self.search_index.run_backfill(self.locks)
+        except Exception as e:
+            logger.exception("Error al indexar los mensajes existentes para búsqueda: %s", e)
+    
+    def get_conversation_summaries(self, include_archived=False, tag=None, status=None, source=None):
+        """
+        Obtener la bandeja de entrada a partir de los resúmenes, sin leer mensajes
+        
+        Los resúmenes se leen de metadata_store en cada llamada (tabla indexada
+        por fecha del último mensaje), así que incluyen los mensajes guardados
+        por cualquier worker.
         
-        # Guardar la lista negra actualizada
-        self.save_bot_blacklist()
+        Args:
+            include_archived (bool): Incluir conversaciones archivadas
+            tag (str, optional): Solo conversaciones con esta etiqueta
+            status (str, optional): Solo conversaciones con este estado
+            source (str, optional): Solo conversaciones cuyo último mensaje llegó por este canal
         
-        print(f"Análisis completado: {len(detected_bots)} bots detectados")
-        return detected_bots
+        Returns:
+            list: Resúmenes (con etiquetas y estado) del más reciente al más antiguo
+        """
+        self._start_backfills()
+        return self.metadata_store.query_summaries(
+            include_archived=include_archived, tag=tag, status=status, source=source
+        )
     
-    def save_message(self, phone_number, direction, msg_type, content, message_id=None, timestamp=None, source="whatsapp"):
-        # Normalizar número de teléfono
+    def mark_conversation_read(self, phone_number):
+        """Marcar como leídos los mensajes de una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
+        self.metadata_store.mark_read(phone_number)
+    
+    def _iter_conversations(self, base_dir, phone_numbers=None):
+        """
+        Recorrer las conversaciones de un directorio (activas o archivadas).
         
-        # Crear directorio para el número si no existe
-        conversation_dir = os.path.join(self.conversations_dir, phone_number)
-        os.makedirs(conversation_dir, exist_ok=True)
+        Las conversaciones compactadas solo leen la cabecera del segmento: el
+        resultado incluye el último mensaje en 'messages' y el total en
+        'message_count', además de la cabecera en 'archive_header'.
         
-        # Archivo de mensajes
-        messages_file = os.path.join(conversation_dir, 'messages.json')
+        Args:
+            base_dir (str): Directorio de conversaciones
+            phone_numbers (iterable, optional): Limitar a estos teléfonos
         
-        # Cargar mensajes existentes o crear lista vacía
-        if os.path.exists(messages_file):
-            with open(messages_file, 'r', encoding='utf-8') as f:
-                try:
-                    messages = json.load(f)
-                except json.JSONDecodeError:
-                    messages = []
+        Yields:
+            dict: Conversación (sin etiquetas ni estado)
+        """
+        if phone_numbers is None:
+            names = os.listdir(base_dir)
         else:
-            messages = []
-        
-        # Crear nuevo mensaje
-        message = {
-            "direction": direction,
-            "type": msg_type,
-            "content": content,
-            "timestamp": timestamp or datetime.now().isoformat(),
-            "message_id": message_id,
-            "source": source
-        }
-        
-        # Añadir mensaje a la lista
-        messages.append(message)
-        
-        # Guardar mensajes
-        with open(messages_file, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+            names = []
+            for phone_number in phone_numbers:
+                if os.path.exists(conversation_archive.segment_path(base_dir, phone_number)):
+                    names.append(phone_number + conversation_archive.SEGMENT_SUFFIX)
+                else:
+                    names.append(phone_number)
+        
+        archived = base_dir == self.archived_dir
+        for name in names:
+            if conversation_archive.is_segment(name):
+                header = conversation_archive.read_header(os.path.join(base_dir, name))
+                if header is None:
+                    continue
+                yield {
+                    'phone_number': conversation_archive.phone_from_segment(name),
+                    'messages': [header['last_message']] if header['last_message'] else [],
+                    'message_count': header['message_count'],
+                    'source': header['source'],
+                    'archived': archived,
+                    'archive_header': header
+                }
+            else:
+                messages = self._load_messages(os.path.join(base_dir, name))
+                if messages is None:
+                    continue
+                yield {
+                    'phone_number': name,
+                    'messages': messages,
+                    'message_count': len(messages),
+                    'source': self._latest_source(messages),
+                    'archived': archived
+                }
+    
+    def _load_messages(self, conversation_dir):
+        """Cargar los mensajes de un directorio de conversación (None si no hay)"""
+        messages_file = os.path.join(conversation_dir, 'messages.json')
+        if not os.path.exists(messages_file):
+            return None
+        with open(messages_file, 'r', encoding='utf-8') as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return None
+    
+    @staticmethod
+    def _latest_source(messages):
+        """Determinar la fuente más reciente (whatsapp, sms, email)"""
+        for msg in reversed(messages):
+            if "source" in msg:
+                return msg["source"]
+        return "whatsapp"  # valor por defecto
+    
+    def get_conversations(self, include_archived=False, tag=None, status=None, source=None):
+        """
+        Obtener lista de conversaciones
         
-        # Si es un mensaje nuevo recibido, establecer estado como 'new' si no tiene estado
-        if direction == 'received' and phone_number not in self.metadata['status']:
-            self.set_conversation_status(phone_number, 'new')
+        Args:
+            include_archived (bool): Incluir conversaciones archivadas
+            tag (str, optional): Solo conversaciones con esta etiqueta
+            status (str, optional): Solo conversaciones con este estado
+            source (str, optional): Solo conversaciones cuyo último mensaje llegó por este canal
         
-        return message
-    
-    def get_conversations(self, include_archived=False):
-        """Obtener lista de todas las conversaciones"""
+        Returns:
+            list: Conversaciones ordenadas por el último mensaje (más reciente primero);
+                las archivadas compactadas solo incluyen su último mensaje
+        """
         conversations = []
         
         # Directorios a recorrer
@@ -279,195 +431,271 @@ class MessageHandler:
         if include_archived:
             dirs_to_check.append(self.archived_dir)
         
+        # Con filtros, metadata_store decide qué conversaciones leer
+        if tag is not None or status is not None or source is not None:
+            phone_numbers = self.get_phone_numbers(include_archived, tag=tag, status=status, source=source)
+        else:
+            phone_numbers = None
+        
         # Recorrer directorios de conversaciones
         for base_dir in dirs_to_check:
             if not os.path.exists(base_dir):
                 continue
-                
-            for phone_number in os.listdir(base_dir):
-                conversation_dir = os.path.join(base_dir, phone_number)
-                if os.path.isdir(conversation_dir):
-                    messages_file = os.path.join(conversation_dir, 'messages.json')
-                    if os.path.exists(messages_file):
-                        with open(messages_file, 'r', encoding='utf-8') as f:
-                            try:
-                                messages = json.load(f)
-                                # Determinar la fuente más reciente (whatsapp, sms, email)
-                                source = "whatsapp"  # valor por defecto
-                                for msg in reversed(messages):
-                                    if "source" in msg:
-                                        source = msg["source"]
-                                        break
-                                
-                                # Determinar si está archivada
-                                is_archived = base_dir == self.archived_dir
-                                
-                                # Obtener etiquetas y estado
-                                tags = self.get_conversation_tags(phone_number)
-                                status = self.get_conversation_status(phone_number)
-                                
-                                conversations.append({
-                                    'phone_number': phone_number,
-                                    'messages': messages,
-                                    'source': source,
-                                    'archived': is_archived,
-                                    'tags': tags,
-                                    'status': status
-                                })
-                            except json.JSONDecodeError:
-                                pass
-        
-        # Ordenar conversaciones por timestamp del último mensaje (más reciente primero)
-        def get_timestamp_value(conversation):
-            if not conversation['messages']:
-                return 0  # Si no hay mensajes, poner al final
-            
-            # Obtener el timestamp del último mensaje
-            timestamp = conversation['messages'][-1]['timestamp']
             
-            # Convertir el timestamp a un valor numérico para comparación
-            try:
-                # Si es un número entero como string, convertirlo a int
-                if isinstance(timestamp, str) and timestamp.isdigit():
-                    return int(timestamp)
-                # Si es un timestamp ISO, convertirlo a datetime y luego a timestamp
-                elif isinstance(timestamp, str):
-                    from datetime import datetime
-                    try:
-                        dt = datetime.fromisoformat(timestamp)
-                        return dt.timestamp()
-                    except ValueError:
-                        # Si no se puede convertir, usar 0
-                        return 0
-                # Si ya es un número, usarlo directamente
-                elif isinstance(timestamp, (int, float)):
-                    return timestamp
-                else:
-                    return 0
-            except Exception as e:
-                print(f"Error al procesar timestamp: {timestamp}, {e}")
-                return 0
+            for conversation in self._iter_conversations(base_dir, phone_numbers):
+                conversation.pop('archive_header', None)
+                conversation['tags'] = self.get_conversation_tags(conversation['phone_number'])
+                conversation['status'] = self.get_conversation_status(conversation['phone_number'])
+                conversations.append(conversation)
+        
+        # Ordenar conversaciones por la fecha del último mensaje (más reciente primero)
+        def last_ts_ms(conversation):
+            if conversation['messages']:
+                return message_ts_ms(conversation['messages'][-1], default=0)
+            return 0  # Si no hay mensajes, poner al final
         
-        # Ordenar usando la función auxiliar
-        conversations.sort(key=get_timestamp_value, reverse=True)
+        conversations.sort(key=last_ts_ms, reverse=True)
         
         return conversations
     
     def get_conversation_tags(self, phone_number):
         """Obtener etiquetas de una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        return self.metadata['tags'].get(phone_number, [])
+        return self.metadata_store.get_tags(phone_number)
     
     def set_conversation_tags(self, phone_number, tags):
         """Establecer etiquetas para una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        self.metadata['tags'][phone_number] = tags
-        self.save_metadata()
+        self.metadata_store.set_tags(phone_number, tags)
         return tags
     
     def add_conversation_tag(self, phone_number, tag):
         """Añadir una etiqueta a una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        if phone_number not in self.metadata['tags']:
-            self.metadata['tags'][phone_number] = []
-        
-        if tag not in self.metadata['tags'][phone_number]:
-            self.metadata['tags'][phone_number].append(tag)
-            self.save_metadata()
-        
-        return self.metadata['tags'][phone_number]
+        return self.metadata_store.add_tag(phone_number, tag)
+    
+    def tag_conversations(self, phone_numbers, tag):
+        """Añadir una etiqueta a varias conversaciones en una sola escritura"""
+        phone_numbers = [self.normalize_phone_number(phone_number) for phone_number in phone_numbers]
+        self.metadata_store.add_tag_many(phone_numbers, tag)
     
     def remove_conversation_tag(self, phone_number, tag):
         """Eliminar una etiqueta de una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        if phone_number in self.metadata['tags'] and tag in self.metadata['tags'][phone_number]:
-            self.metadata['tags'][phone_number].remove(tag)
-            self.save_metadata()
-        
-        return self.metadata['tags'].get(phone_number, [])
+        return self.metadata_store.remove_tag(phone_number, tag)
     
     def get_conversation_status(self, phone_number):
         """Obtener estado de una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        return self.metadata['status'].get(phone_number, 'new')
+        return self.metadata_store.get_status(phone_number) or 'new'
     
     def set_conversation_status(self, phone_number, status):
         """Establecer estado para una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
-        self.metadata['status'][phone_number] = status
-        self.save_metadata()
+        self.metadata_store.set_status(phone_number, status)
         return status
     
+    def get_phone_numbers(self, include_archived=False, tag=None, status=None, source=None):
+        """
+        Obtener los teléfonos de las conversaciones sin leer sus mensajes
+        
+        Args:
+            include_archived (bool): Incluir conversaciones archivadas
+            tag (str, optional): Solo conversaciones con esta etiqueta
+            status (str, optional): Solo conversaciones con este estado
+            source (str, optional): Solo conversaciones cuyo último mensaje llegó por este canal
+        
+        Returns:
+            list: Teléfonos ordenados
+        """
+        phone_numbers = set(os.listdir(self.conversations_dir))
+        if include_archived:
+            for name in os.listdir(self.archived_dir):
+                if conversation_archive.is_segment(name):
+                    name = conversation_archive.phone_from_segment(name)
+                phone_numbers.add(name)
+        
+        phone_numbers = self.metadata_store.filter_phone_numbers(
+            phone_numbers, tag=tag, status=status, source=source
+        )
+        
+        return sorted(phone_numbers)
+    
+    @staticmethod
+    def parse_page_cursor(value):
+        """
+        Convierte un cursor de paginación en una clave comparable (ts_ms, posición).
+        
+        Args:
+            value (str|int): Cursor 'ts_ms:posición' devuelto en 'next_before', o
+                milisegundos Unix (todos los mensajes anteriores a esa fecha)
+        
+        Returns:
+            tuple: Clave del cursor
+        
+        Raises:
+            ValueError: Si el cursor no es válido
+        """
+        if isinstance(value, int):
+            return value, -1
+        ts_ms, _, position = str(value).partition(':')
+        return int(ts_ms), int(position) if position else -1
+    
+    @timed(STORAGE_SECONDS, 'get_conversation')
+    def get_conversation(self, phone_number, before=None, limit=None, with_delivery=False):
+        """
+        Obtener una conversación completa (activa o archivada), o una página de sus mensajes
+        
+        Las páginas se ordenan por (ts_ms, posición en el historial), de modo que
+        el cursor identifica un único mensaje aunque varios compartan marca de tiempo.
+        
+        Args:
+            phone_number (str): Número de teléfono
+            before (str|int, optional): Cursor 'next_before' de la página anterior, o
+                milisegundos Unix para pedir los mensajes anteriores a esa fecha
+            limit (int, optional): Devolver solo los últimos `limit` mensajes; 'next_before'
+                indica el cursor para pedir la página anterior
+            with_delivery (bool): Añadir a los mensajes enviados su estado de entrega ('delivery')
+        
+        Returns:
+            dict: Conversación con sus mensajes, o None si no existe
+        
+        Raises:
+            ValueError: Si el cursor no es válido
+        """
+        phone_number = self.normalize_phone_number(phone_number)
+        
+        messages = self._load_messages(os.path.join(self.conversations_dir, phone_number))
+        is_archived = messages is None
+        if is_archived:
+            # Archivada como segmento comprimido o, en versiones anteriores, como directorio
+            segment_path = conversation_archive.segment_path(self.archived_dir, phone_number)
+            if os.path.exists(segment_path):
+                _, messages = conversation_archive.read_segment(segment_path)
+            else:
+                messages = self._load_messages(os.path.join(self.archived_dir, phone_number))
+            if messages is None:
+                return None
+        
+        message_count = len(messages)
+        source = self._latest_source(messages)
+        next_before = None
+        if before is not None or limit is not None:
+            keyed = sorted(
+                ((message_ts_ms(msg, default=0), position), msg) for position, msg in enumerate(messages)
+            )
+            if before is not None:
+                cursor = self.parse_page_cursor(before)
+                keyed = [item for item in keyed if item[0] < cursor]
+            if limit is not None and len(keyed) > limit:
+                keyed = keyed[-limit:] if limit > 0 else []
+                if keyed:
+                    next_before = '{}:{}'.format(*keyed[0][0])
+            messages = [msg for _, msg in keyed]
+        
+        if with_delivery:
+            statuses = self.delivery_status.get_statuses(
+                [msg.get('message_id') for msg in messages if msg.get('direction') == 'sent']
+            )
+            for msg in messages:
+                if msg.get('message_id') in statuses:
+                    msg['delivery'] = statuses[msg['message_id']]
+        
+        conversation = {
+            'phone_number': phone_number,
+            'messages': messages,
+            'message_count': message_count,
+            'source': source,
+            'archived': is_archived,
+            'tags': self.get_conversation_tags(phone_number),
+            'status': self.get_conversation_status(phone_number)
+        }
+        if limit is not None:
+            conversation['next_before'] = next_before
+        return conversation
+    
     def archive_conversation(self, phone_number):
-        """Archivar una conversación"""
+        """Archivar una conversación compactándola en un segmento comprimido"""
         phone_number = self.normalize_phone_number(phone_number)
         source_dir = os.path.join(self.conversations_dir, phone_number)
-        target_dir = os.path.join(self.archived_dir, phone_number)
         
-        if os.path.exists(source_dir):
-            # Crear directorio de destino si no existe
-            os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+        # Bloquear la conversación para que no se mueva a mitad de una escritura
+        with self.locks.lock(phone_number):
+            messages = self._load_messages(source_dir)
+            if messages is None:
+                return False
             
-            # Mover directorio de conversación a archivados
-            if os.path.exists(target_dir):
-                shutil.rmtree(target_dir)  # Eliminar directorio de destino si ya existe
+            conversation_archive.write_segment(
+                conversation_archive.segment_path(self.archived_dir, phone_number),
+                phone_number,
+                messages
+            )
             
-            shutil.move(source_dir, target_dir)
+            # Eliminar el directorio activo y el de un archivado anterior, si existe
+            shutil.rmtree(source_dir)
+            old_archive_dir = os.path.join(self.archived_dir, phone_number)
+            if os.path.exists(old_archive_dir):
+                shutil.rmtree(old_archive_dir)
+            
+            self.metadata_store.set_archived(phone_number, True)
             return True
-        
-        return False
     
     def unarchive_conversation(self, phone_number):
         """Desarchivar una conversación"""
         phone_number = self.normalize_phone_number(phone_number)
+        segment_path = conversation_archive.segment_path(self.archived_dir, phone_number)
         source_dir = os.path.join(self.archived_dir, phone_number)
         target_dir = os.path.join(self.conversations_dir, phone_number)
         
-        if os.path.exists(source_dir):
-            # Crear directorio de destino si no existe
-            os.makedirs(os.path.dirname(target_dir), exist_ok=True)
-            
-            # Mover directorio de conversación a activos
-            if os.path.exists(target_dir):
-                shutil.rmtree(target_dir)  # Eliminar directorio de destino si ya existe
+        # Bloquear la conversación para que no se mueva a mitad de una escritura
+        with self.locks.lock(phone_number):
+            if os.path.exists(segment_path):
+                _, messages = conversation_archive.read_segment(segment_path)
+                if messages is None:
+                    return False
+                
+                # Restaurar el formato de conversación activa (combinando con mensajes
+                # recibidos después de archivar, si los hay)
+                active_messages = self._load_messages(target_dir) or []
+                os.makedirs(target_dir, exist_ok=True)
+                messages_file = os.path.join(target_dir, 'messages.json')
+                temp_file = messages_file + '.tmp'
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(messages + active_messages, f, ensure_ascii=False, indent=2)
+                os.replace(temp_file, messages_file)
+                os.remove(segment_path)
+                
+                self.metadata_store.set_archived(phone_number, False)
+                return True
             
-            shutil.move(source_dir, target_dir)
-            return True
+            if os.path.exists(source_dir):
+                # Archivado de una versión anterior: mover el directorio
+                os.makedirs(os.path.dirname(target_dir), exist_ok=True)
+                
+                # Mover directorio de conversación a activos
+                if os.path.exists(target_dir):
+                    shutil.rmtree(target_dir)  # Eliminar directorio de destino si ya existe
+                
+                shutil.move(source_dir, target_dir)
+                
+                self.metadata_store.set_archived(phone_number, False)
+                return True
         
         return False
     
     def export_conversation(self, phone_number):
         """Exportar una conversación a formato JSON"""
-        phone_number = self.normalize_phone_number(phone_number)
-        
-        # Buscar la conversación en activos o archivados
-        conversation_dir = os.path.join(self.conversations_dir, phone_number)
-        is_archived = False
-        
-        if not os.path.exists(conversation_dir):
-            conversation_dir = os.path.join(self.archived_dir, phone_number)
-            is_archived = True
-            
-            if not os.path.exists(conversation_dir):
-                return None  # No se encontró la conversación
-        
-        messages_file = os.path.join(conversation_dir, 'messages.json')
-        if not os.path.exists(messages_file):
-            return None
-        
-        with open(messages_file, 'r', encoding='utf-8') as f:
-            try:
-                messages = json.load(f)
-            except json.JSONDecodeError:
-                return None
+        conversation = self.get_conversation(phone_number)
+        if conversation is None:
+            return None  # No se encontró la conversación
         
         # Crear objeto de exportación
         export_data = {
-            'phone_number': phone_number,
-            'messages': messages,
-            'tags': self.get_conversation_tags(phone_number),
-            'status': self.get_conversation_status(phone_number),
-            'archived': is_archived,
+            'phone_number': conversation['phone_number'],
+            'messages': conversation['messages'],
+            'tags': conversation['tags'],
+            'status': conversation['status'],
+            'archived': conversation['archived'],
             'exported_at': datetime.now().isoformat()
         }
         
@@ -628,6 +856,7 @@ class MessageHandler:
                 
                 try:
                     # Buscar vuelos
+                    amadeus_api = get_amadeus_api()
                     flights = amadeus_api.search_flights(origin, destination, departure_date, return_date)
                     
                     if flights:
@@ -644,7 +873,7 @@ class MessageHandler:
                     else:
                         return f"Lo siento, no encontré vuelos disponibles de {origin} a {destination} para la fecha {departure_date}.\n\nPuedes intentar con otras fechas o destinos, o buscar directamente en nuestro sitio web:\n{quick_search_url}"
                 except Exception as e:
-                    print(f"Error al buscar vuelos: {str(e)}")
+                    logger.exception("Error al buscar vuelos: %s", e)
                     return f"Lo siento, ocurrió un error al buscar vuelos. Por favor, intenta más tarde o visita nuestro sitio web para buscar opciones:\n{quick_search_url}"
             else:
                 # Si no se encontró un patrón específico pero el usuario está interesado en vuelos
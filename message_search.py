@@ -0,0 +1,302 @@
+"""
+Índice de búsqueda de texto completo sobre el historial de mensajes (SQLite FTS5).
+
+Cada mensaje guardado con save_message se añade al índice. Los mensajes que ya
+existían al crear la base de datos no se indexan dentro de la migración (que
+bloquearía la base de datos durante todo el recorrido): la migración anota un
+relleno pendiente y run_backfill lo procesa después, en segundo plano en cada
+proceso o con migrate.py, una conversación cada vez y con su bloqueo. El índice
+vive en su propio archivo (data/search.db) porque puede regenerarse en
+cualquier momento a partir de los archivos de conversaciones.
+"""
+
+import html
+import json
+import os
+import re
+import time
+
+import conversation_archive
+from db import get_connection, transaction, register_migrations, ensure_schema
+from metadata_store import BACKFILL_CLAIM_TIMEOUT_MS
+
+# Resultados por página por defecto y máximos
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Marcadores internos del fragmento; se sustituyen por <mark> después de escapar el HTML
+_SNIPPET_START = '\x02'
+_SNIPPET_END = '\x03'
+
+def build_match_query(query):
+    """
+    Convierte el texto escrito por el usuario en una consulta MATCH de FTS5.
+
+    Cada palabra se busca literalmente (entre comillas, sin operadores FTS5) y
+    la última admite coincidencias por prefijo para buscar mientras se escribe.
+
+    Args:
+        query (str): Texto de búsqueda
+
+    Returns:
+        str: Consulta MATCH, o None si no hay términos
+    """
+    terms = re.findall(r'\w+', query or '')
+    if not terms:
+        return None
+    quoted = ['"' + term + '"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+class MessageSearchIndex:
+    """
+    Índice FTS5 de mensajes por teléfono.
+    """
+
+    def __init__(self, db_path, conversation_dirs):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite del índice
+            conversation_dirs (list): Directorios de conversaciones a indexar en el relleno inicial
+        """
+        self.db_path = db_path
+        self.conversation_dirs = conversation_dirs
+
+        register_migrations(db_path, [
+            (1, "Tabla FTS5 de mensajes", self._migration_create_tables),
+            (2, "Indexar mensajes existentes", self._migration_pending_backfill),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea la tabla virtual de búsqueda"""
+        # Solo el contenido se tokeniza; el resto de columnas se guardan para los resultados
+        conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+            content,
+            phone_number UNINDEXED,
+            timestamp UNINDEXED,
+            direction UNINDEXED,
+            source UNINDEXED,
+            message_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        ''')
+
+    def _migration_pending_backfill(self, conn):
+        """
+        Anota el indexado de los mensajes existentes como relleno pendiente.
+
+        after_rowid separa las filas que ya había de las que se añadan después:
+        el relleno sustituye estas últimas al indexar cada conversación, de modo
+        que los mensajes guardados mientras tanto no quedan duplicados.
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            after_rowid INTEGER NOT NULL,
+            claimed_at INTEGER
+        )
+        ''')
+        conn.execute('''
+        INSERT OR IGNORE INTO pending_backfill (id, after_rowid)
+        SELECT 1, COALESCE(MAX(rowid), 0) FROM messages_fts
+        ''')
+
+    def backfill_pending(self):
+        """Indica si aún falta indexar los mensajes existentes"""
+        conn = get_connection(self.db_path)
+        return conn.execute('SELECT 1 FROM pending_backfill').fetchone() is not None
+
+    def _claim_backfill(self):
+        """Reserva el relleno para este proceso; None si no está pendiente o lo ejecuta otro"""
+        now = int(time.time() * 1000)
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute('''
+            UPDATE pending_backfill SET claimed_at = ?
+            WHERE claimed_at IS NULL OR claimed_at < ?
+            ''', (now, now - BACKFILL_CLAIM_TIMEOUT_MS))
+            if cursor.rowcount != 1:
+                return None
+            return conn.execute('SELECT after_rowid FROM pending_backfill').fetchone()['after_rowid']
+
+    def run_backfill(self, locks):
+        """
+        Indexa los mensajes existentes si el relleno está pendiente, una
+        conversación cada vez, con su bloqueo y en su propia transacción.
+
+        Args:
+            locks (ConversationLockManager): Bloqueos por conversación
+
+        Returns:
+            bool: True si este proceso completó el relleno
+        """
+        after_rowid = self._claim_backfill()
+        if after_rowid is None:
+            return False
+        try:
+            total = self._backfill(locks, after_rowid)
+        except Exception:
+            # Liberar la reserva para que otro proceso (o migrate.py) lo reintente
+            with transaction(self.db_path) as conn:
+                conn.execute('UPDATE pending_backfill SET claimed_at = NULL')
+            raise
+        with transaction(self.db_path) as conn:
+            conn.execute('DELETE FROM pending_backfill')
+        print(f"Mensajes indexados para búsqueda: {total}")
+        return True
+
+    def _backfill(self, locks, after_rowid):
+        """Indexa cada conversación existente sustituyendo sus filas posteriores a after_rowid"""
+        # Una conversación puede tener segmento archivado y mensajes activos a la vez
+        entries = {}
+        for base_dir in self.conversation_dirs:
+            if not os.path.isdir(base_dir):
+                continue
+            for name in os.listdir(base_dir):
+                phone_number = (conversation_archive.phone_from_segment(name)
+                                if conversation_archive.is_segment(name) else name)
+                entries.setdefault(phone_number, []).append((base_dir, name))
+
+        total = 0
+        for phone_number, names in entries.items():
+            with locks.lock(phone_number):
+                rows = []
+                for base_dir, name in names:
+                    _, messages = self._read_conversation(base_dir, name)
+                    for message in messages or []:
+                        row = self._message_to_row(phone_number, message)
+                        if row:
+                            rows.append(row)
+                # Las filas añadidas por save_message desde la migración ya están
+                # en el archivo: se reemplazan para no duplicarlas
+                with transaction(self.db_path) as conn:
+                    conn.execute(
+                        'DELETE FROM messages_fts WHERE rowid > ? AND phone_number = ?',
+                        (after_rowid, phone_number)
+                    )
+                    self._insert_rows(conn, rows)
+                total += len(rows)
+        return total
+
+    @staticmethod
+    def _read_conversation(base_dir, name):
+        """Lee los mensajes de un directorio de conversación o de un segmento archivado"""
+        path = os.path.join(base_dir, name)
+        if conversation_archive.is_segment(name):
+            _, messages = conversation_archive.read_segment(path)
+            return conversation_archive.phone_from_segment(name), messages
+
+        messages_file = os.path.join(path, 'messages.json')
+        if not os.path.exists(messages_file):
+            return name, None
+        with open(messages_file, 'r', encoding='utf-8') as f:
+            try:
+                return name, json.load(f)
+            except json.JSONDecodeError:
+                return name, None
+
+    @staticmethod
+    def _message_to_row(phone_number, message):
+        """Convierte un mensaje guardado en una fila del índice (None si no tiene texto)"""
+        content = message.get('content')
+        if not content:
+            return None
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        return (
+            content,
+            phone_number,
+            message.get('timestamp'),
+            message.get('direction'),
+            message.get('source', 'whatsapp'),
+            message.get('message_id')
+        )
+
+    @staticmethod
+    def _insert_rows(conn, rows):
+        conn.executemany('''
+        INSERT INTO messages_fts (content, phone_number, timestamp, direction, source, message_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    def add_message(self, phone_number, message):
+        """
+        Añade un mensaje al índice.
+
+        Args:
+            phone_number (str): Número de teléfono normalizado
+            message (dict): Mensaje tal como se guarda en messages.json
+        """
+        row = self._message_to_row(phone_number, message)
+        if row is None:
+            return
+        with transaction(self.db_path) as conn:
+            self._insert_rows(conn, [row])
+
+    def search(self, query, page=1, per_page=SEARCH_PAGE_SIZE, phone_number=None):
+        """
+        Busca mensajes que contengan todas las palabras de la consulta, de los
+        más recientes a los más antiguos.
+
+        Args:
+            query (str): Texto de búsqueda
+            page (int): Página (desde 1)
+            per_page (int): Resultados por página
+            phone_number (str, optional): Limitar la búsqueda a una conversación
+
+        Returns:
+            dict: Resultados (teléfono, fecha, dirección, canal y fragmento
+                con HTML escapado y coincidencias entre <mark>), página, si hay
+                más resultados y si aún se están indexando los mensajes existentes
+        """
+        page = max(1, page)
+        per_page = max(1, min(per_page, SEARCH_MAX_PAGE_SIZE))
+        match = build_match_query(query)
+        if match is None:
+            return {'results': [], 'page': page, 'per_page': per_page, 'has_more': False,
+                    'indexing': self.backfill_pending()}
+
+        sql = '''
+        SELECT phone_number, timestamp, direction, source, message_id,
+               snippet(messages_fts, 0, ?, ?, '…', 12) AS snippet
+        FROM messages_fts
+        WHERE messages_fts MATCH ?
+        '''
+        params = [_SNIPPET_START, _SNIPPET_END, match]
+        if phone_number:
+            sql += ' AND phone_number = ?'
+            params.append(phone_number)
+        # Más recientes primero: FTS5 recorre el rowid en orden sin puntuar todas
+        # las coincidencias, a diferencia de ORDER BY rank. Se pide un resultado
+        # extra para saber si hay otra página sin contar el total
+        sql += ' ORDER BY rowid DESC LIMIT ? OFFSET ?'
+        params += [per_page + 1, (page - 1) * per_page]
+
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+        results = []
+        for row in rows[:per_page]:
+            result = dict(row)
+            result['snippet'] = (html.escape(result['snippet'])
+                                 .replace(_SNIPPET_START, '<mark>')
+                                 .replace(_SNIPPET_END, '</mark>'))
+            results.append(result)
+
+        return {
+            'results': results,
+            'page': page,
+            'per_page': per_page,
+            'has_more': len(rows) > per_page,
+            'indexing': self.backfill_pending()
+        }
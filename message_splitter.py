@@ -0,0 +1,184 @@
+"""
+División de los mensajes salientes que superan el límite de tamaño del canal.
+
+Los listados completos de tours o los vuelos con varias escalas pueden pasar de
+los 4096 caracteres que admite el cuerpo de un mensaje de WhatsApp, y en SMS
+cada mensaje se cobra por segmentos: 160 caracteres GSM-7 (153 si el mensaje
+ocupa varios) o solo 70 en UCS-2 (67), que es la codificación que se usa en
+cuanto el texto lleva un carácter fuera del alfabeto GSM-7 (por ejemplo 'á',
+'ó' o un emoji).
+
+El texto se corta por secciones (líneas en blanco), después por líneas, por
+palabras y, solo si una palabra no cabe sola, por caracteres. Cada parte se
+llena tanto como permite el límite del canal; en SMS la codificación se decide
+por parte, de modo que un emoji solo encarece la parte en la que aparece.
+"""
+
+import os
+import unicodedata
+
+# Caracteres del cuerpo de un mensaje de texto de WhatsApp
+WHATSAPP_MAX_CHARS = 4096
+
+# Segmentos máximos de cada parte de un SMS (la operadora los concatena al recibirlos)
+SMS_MAX_SEGMENTS = int(os.getenv('SMS_MAX_SEGMENTS', '4'))
+
+# Sustituir en los SMS los caracteres fuera de GSM-7 ('á' por 'a', comillas
+# tipográficas, etc.) para no pasar a UCS-2, que reduce a menos de la mitad
+# los caracteres por segmento
+SMS_TRANSLITERATE = os.getenv('SMS_TRANSLITERATE', 'false').lower() == 'true'
+
+# Capacidad de un segmento SMS: (mensaje de un solo segmento, cada segmento de un mensaje concatenado)
+GSM7_SEGMENT_SEPTETS = (160, 153)
+UCS2_SEGMENT_UNITS = (70, 67)
+
+# Alfabeto GSM-7 (GSM 03.38): caracteres básicos (1 septeto) y de la tabla de extensión (2 septetos)
+GSM7_BASIC_CHARS = frozenset(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED_CHARS = frozenset("^{}\\[~]|€\f")
+
+# Equivalentes GSM-7 de signos tipográficos habituales
+GSM7_REPLACEMENTS = {
+    '“': '"', '”': '"', '„': '"', '«': '"', '»': '"',
+    '‘': "'", '’': "'", '´': "'", '`': "'",
+    '–': '-', '—': '-', '…': '...', '•': '-', ' ': ' ', '\t': ' ',
+}
+
+# Separadores por los que se corta un texto, de mayor a menor preferencia
+_SEPARATORS = ('\n\n', '\n', ' ')
+
+def gsm7_septets(text):
+    """
+    Septetos que ocupa un texto en GSM-7.
+
+    Args:
+        text (str): Texto
+
+    Returns:
+        int: Septetos, o None si el texto no se puede codificar en GSM-7
+    """
+    septets = 0
+    for char in text:
+        if char in GSM7_BASIC_CHARS:
+            septets += 1
+        elif char in GSM7_EXTENDED_CHARS:
+            septets += 2
+        else:
+            return None
+    return septets
+
+def to_gsm7(text):
+    """
+    Sustituye los caracteres fuera de GSM-7 por su equivalente más cercano
+    (sin tilde, signo tipográfico simple) y elimina los que no tienen ninguno.
+
+    Args:
+        text (str): Texto
+
+    Returns:
+        str: Texto codificable en GSM-7
+    """
+    result = []
+    for char in text:
+        if char in GSM7_BASIC_CHARS or char in GSM7_EXTENDED_CHARS:
+            result.append(char)
+        elif char in GSM7_REPLACEMENTS:
+            result.append(GSM7_REPLACEMENTS[char])
+        else:
+            base = ''.join(c for c in unicodedata.normalize('NFKD', char)
+                           if c in GSM7_BASIC_CHARS or c in GSM7_EXTENDED_CHARS)
+            result.append(base)
+    return ''.join(result)
+
+def _measure(text):
+    """Tamaño de un texto: (caracteres, septetos GSM-7 o None, unidades UTF-16)"""
+    return len(text), gsm7_septets(text), len(text.encode('utf-16-le')) // 2
+
+def _join_sizes(a, b, sep_size):
+    """Tamaño de dos textos unidos por un separador"""
+    septets = None if a[1] is None or b[1] is None else a[1] + sep_size[1] + b[1]
+    return a[0] + sep_size[0] + b[0], septets, a[2] + sep_size[2] + b[2]
+
+def _sms_segments_from_size(size):
+    septets, units = size[1], size[2]
+    if septets is not None:
+        single, multi = GSM7_SEGMENT_SEPTETS
+        length = septets
+    else:
+        single, multi = UCS2_SEGMENT_UNITS
+        length = units
+    if length <= single:
+        return 1
+    return -(-length // multi)
+
+def sms_segments(text):
+    """
+    Codificación y número de segmentos de un SMS.
+
+    Args:
+        text (str): Texto del SMS
+
+    Returns:
+        tuple: ('gsm7' o 'ucs2', segmentos)
+    """
+    size = _measure(text)
+    return ('gsm7' if size[1] is not None else 'ucs2'), _sms_segments_from_size(size)
+
+def _fits_function(channel):
+    if channel == 'sms':
+        return lambda size: _sms_segments_from_size(size) <= SMS_MAX_SEGMENTS
+    return lambda size: size[0] <= WHATSAPP_MAX_CHARS
+
+def _split(text, fits, separators):
+    """Divide un texto en partes que cumplen `fits`, cortando por el primer separador posible"""
+    if not separators:
+        # Ni una palabra cabe sola: cortar por caracteres
+        units = list(text)
+        sep = ''
+    else:
+        sep = separators[0]
+        units = text.split(sep)
+    sep_size = _measure(sep)
+
+    parts = []
+    current, current_size = None, None
+    for unit in units:
+        unit_size = _measure(unit)
+        if current is not None:
+            joined_size = _join_sizes(current_size, unit_size, sep_size)
+            if fits(joined_size):
+                current, current_size = current + sep + unit, joined_size
+                continue
+            parts.append(current)
+            current = None
+        if fits(unit_size):
+            current, current_size = unit, unit_size
+        else:
+            pieces = _split(unit, fits, separators[1:])
+            parts.extend(pieces[:-1])
+            current, current_size = pieces[-1], _measure(pieces[-1])
+    if current is not None:
+        parts.append(current)
+    return parts
+
+def split_message(text, channel='whatsapp'):
+    """
+    Divide un mensaje en las partes necesarias para respetar el límite del canal.
+
+    Args:
+        text (str): Texto del mensaje
+        channel (str): 'whatsapp' o 'sms'
+
+    Returns:
+        list: Partes en orden de envío (una sola si el mensaje cabe entero)
+    """
+    if channel == 'sms' and SMS_TRANSLITERATE:
+        text = to_gsm7(text)
+    fits = _fits_function(channel)
+    if fits(_measure(text)):
+        return [text]
+
+    parts = [part.strip() for part in _split(text, fits, _SEPARATORS)]
+    return [part for part in parts if part]
@@ -0,0 +1,761 @@
+"""
+Almacén de metadatos de conversaciones (etiquetas, estados y resúmenes) sobre SQLite.
+
+Sustituye al archivo conversation_metadata.json, que se reescribía completo en
+cada cambio. Cada operación modifica solo las filas de una conversación dentro
+de una transacción, de modo que una caída a mitad de una escritura no deja el
+almacén corrupto y varios procesos pueden escribir a la vez.
+
+Si existe un conversation_metadata.json de una versión anterior, su contenido
+se importa una sola vez al crear la base de datos. El archivo no se modifica y
+puede eliminarse después de la migración.
+
+El resumen de cada conversación (fecha, canal y vista previa del último
+mensaje, contadores y mensajes sin leer) se actualiza con cada mensaje guardado,
+de modo que la bandeja de entrada se construye sin leer los archivos de mensajes.
+
+Las migraciones solo cambian el esquema. Los datos que hay que calcular a partir
+de los archivos de conversaciones se anotan como rellenos pendientes y se
+procesan fuera de la transacción de migración, una conversación cada vez y con
+su bloqueo: los resúmenes iniciales en segundo plano en cada proceso (o con
+migrate.py) y la reescritura de los mensajes sin ts_ms solo con migrate.py.
+"""
+
+import json
+import os
+import time
+from datetime import datetime
+
+import conversation_archive
+from db import get_connection, transaction, register_migrations, ensure_schema
+from timestamps import message_ts_ms, add_ts_ms
+
+# Longitud máxima de la vista previa del último mensaje en el resumen
+SUMMARY_PREVIEW_LENGTH = 100
+
+# Columnas del resumen de conversación, en el orden de la tabla
+SUMMARY_COLUMNS = (
+    'phone_number', 'last_ts_ms', 'last_timestamp', 'last_source', 'last_direction', 'preview',
+    'message_count', 'received_count', 'sent_count', 'unread_count', 'archived'
+)
+
+# Estado que se asume para las conversaciones sin estado guardado
+DEFAULT_STATUS = 'new'
+
+# Milisegundos tras los que un relleno reservado por un proceso puede retomarlo otro
+BACKFILL_CLAIM_TIMEOUT_MS = 10 * 60 * 1000
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+def _add_pending_backfill(conn, name):
+    """Anota un relleno de datos pendiente (lo ejecuta run_backfills)"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pending_backfills (
+        name TEXT PRIMARY KEY,
+        claimed_at INTEGER
+    )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO pending_backfills (name) VALUES (?)', (name,))
+
+def _preview(message):
+    """Vista previa del contenido de un mensaje"""
+    content = message.get('content')
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False) if content is not None else ''
+    return content[:SUMMARY_PREVIEW_LENGTH]
+
+def build_summary(phone_number, messages, archived=False):
+    """
+    Calcula el resumen de una conversación a partir de todos sus mensajes.
+
+    Los mensajes sin leer se estiman como los recibidos después de la última respuesta.
+
+    Returns:
+        dict: Resumen, o None si la conversación no tiene mensajes
+    """
+    if not messages:
+        return None
+    last = messages[-1]
+    received_count = sum(1 for msg in messages if msg.get('direction') == 'received')
+    unread_count = 0
+    for msg in reversed(messages):
+        if msg.get('direction') != 'received':
+            break
+        unread_count += 1
+
+    source = "whatsapp"
+    for msg in reversed(messages):
+        if "source" in msg:
+            source = msg["source"]
+            break
+
+    return {
+        'phone_number': phone_number,
+        'last_ts_ms': message_ts_ms(last, default=_now_ms()),
+        'last_timestamp': last.get('timestamp'),
+        'last_source': source,
+        'last_direction': last.get('direction'),
+        'preview': _preview(last),
+        'message_count': len(messages),
+        'received_count': received_count,
+        'sent_count': len(messages) - received_count,
+        'unread_count': 0 if archived else unread_count,
+        'archived': 1 if archived else 0,
+    }
+
+class MetadataStore:
+    """
+    Etiquetas, estados y resúmenes de las conversaciones, con actualizaciones por clave.
+    """
+
+    def __init__(self, db_path, legacy_json_path=None, conversations_dir=None, archived_dir=None):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite
+            legacy_json_path (str, optional): Archivo JSON de metadatos a importar
+            conversations_dir (str, optional): Conversaciones activas, para calcular los resúmenes iniciales
+            archived_dir (str, optional): Conversaciones archivadas, para calcular los resúmenes iniciales
+        """
+        self.db_path = db_path
+        self.legacy_json_path = legacy_json_path
+        self.conversations_dir = conversations_dir
+        self.archived_dir = archived_dir
+
+        register_migrations(db_path, [
+            (1, "Tablas de etiquetas y estados de conversaciones", self._migration_create_tables),
+            (2, "Importar conversation_metadata.json", self._migration_import_legacy_json),
+            (3, "Resúmenes de conversaciones", self._migration_create_summaries),
+            (4, "Campo ts_ms en los mensajes guardados", self._migration_message_ts_ms),
+            (5, "Marcas del análisis de bots", self._migration_create_analysis_marks),
+            (6, "Rellenos de datos pendientes", self._migration_create_pending_backfills),
+            (7, "Índice por canal del último mensaje", self._migration_index_last_source),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea las tablas de etiquetas y estados si no existen"""
+        cursor = conn.cursor()
+
+        # Una fila por etiqueta; el rowid conserva el orden en que se añadieron
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_tags (
+            phone_number TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            UNIQUE (phone_number, tag)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_tags_tag ON conversation_tags (tag)')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_status (
+            phone_number TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation_status_status ON conversation_status (status)')
+
+    def _migration_import_legacy_json(self, conn):
+        """Importa las etiquetas y estados del archivo JSON anterior, si existe"""
+        if not self.legacy_json_path or not os.path.exists(self.legacy_json_path):
+            return
+
+        try:
+            with open(self.legacy_json_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"No se pudieron importar los metadatos de {self.legacy_json_path}: {e}")
+            return
+
+        cursor = conn.cursor()
+        now = datetime.now().isoformat()
+        cursor.executemany(
+            'INSERT OR IGNORE INTO conversation_tags (phone_number, tag) VALUES (?, ?)',
+            [(phone_number, tag)
+             for phone_number, tags in metadata.get('tags', {}).items()
+             for tag in tags]
+        )
+        cursor.executemany(
+            'INSERT OR REPLACE INTO conversation_status (phone_number, status, updated_at) VALUES (?, ?, ?)',
+            [(phone_number, status, now) for phone_number, status in metadata.get('status', {}).items()]
+        )
+        print(f"Metadatos importados de {os.path.basename(self.legacy_json_path)}: "
+              f"{len(metadata.get('tags', {}))} conversaciones con etiquetas, "
+              f"{len(metadata.get('status', {}))} con estado")
+
+    def _migration_create_summaries(self, conn):
+        """
+        Crea la tabla de resúmenes.
+
+        Los resúmenes de las conversaciones existentes se calculan después, fuera
+        de la migración (relleno 'conversation_summaries').
+        """
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summary (
+            phone_number TEXT PRIMARY KEY,
+            last_ts_ms INTEGER NOT NULL,
+            last_timestamp TEXT,
+            last_source TEXT NOT NULL,
+            last_direction TEXT,
+            preview TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            received_count INTEGER NOT NULL,
+            sent_count INTEGER NOT NULL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            archived INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_conversation_summary_last_ts ON conversation_summary (last_ts_ms)')
+        _add_pending_backfill(conn, 'conversation_summaries')
+
+    def _migration_message_ts_ms(self, conn):
+        """
+        Anota la reescritura de los mensajes guardados sin campo ts_ms.
+
+        Los archivos no se tocan aquí: los lectores convierten la marca de tiempo
+        original de los mensajes sin ts_ms, y migrate.py los reescribe después
+        (relleno 'message_ts_ms'), una conversación cada vez y con su bloqueo.
+        """
+        _add_pending_backfill(conn, 'message_ts_ms')
+
+    def _migration_create_analysis_marks(self, conn):
+        """Crea la tabla con los mensajes recibidos ya analizados de cada conversación"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS bot_analysis_marks (
+            phone_number TEXT PRIMARY KEY,
+            analyzed_received INTEGER NOT NULL,
+            analyzed_at INTEGER NOT NULL
+        )
+        ''')
+
+    def _migration_create_pending_backfills(self, conn):
+        """Crea la tabla de rellenos pendientes en las bases de datos anteriores a ella"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS pending_backfills (
+            name TEXT PRIMARY KEY,
+            claimed_at INTEGER
+        )
+        ''')
+
+    def _migration_index_last_source(self, conn):
+        """Crea el índice para filtrar la bandeja de entrada por canal"""
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_summary_last_source ON conversation_summary (last_source)')
+
+    def pending_backfills(self):
+        """
+        Rellenos de datos pendientes.
+
+        Returns:
+            list: Nombres de los rellenos
+        """
+        cursor = get_connection(self.db_path).execute('SELECT name FROM pending_backfills ORDER BY name')
+        return [row['name'] for row in cursor]
+
+    def _claim_backfill(self, name):
+        """Reserva un relleno para este proceso; False si no está pendiente o lo ejecuta otro"""
+        now = _now_ms()
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute('''
+            UPDATE pending_backfills SET claimed_at = ?
+            WHERE name = ? AND (claimed_at IS NULL OR claimed_at < ?)
+            ''', (now, name, now - BACKFILL_CLAIM_TIMEOUT_MS))
+            return cursor.rowcount == 1
+
+    def run_backfills(self, locks, names=None):
+        """
+        Ejecuta los rellenos de datos pendientes, una conversación cada vez y con
+        su bloqueo, sin mantener abierta ninguna transacción larga.
+
+        Args:
+            locks (ConversationLockManager): Bloqueos por conversación
+            names (list, optional): Limitar a estos rellenos
+
+        Returns:
+            list: Rellenos completados
+        """
+        backfills = {
+            'conversation_summaries': self._backfill_summaries,
+            'message_ts_ms': self._backfill_message_ts_ms,
+        }
+        completed = []
+        for name in self.pending_backfills():
+            if name not in backfills or (names is not None and name not in names):
+                continue
+            if not self._claim_backfill(name):
+                continue
+            try:
+                backfills[name](locks)
+            except Exception:
+                # Liberar la reserva para que otro proceso (o migrate.py) lo reintente
+                with transaction(self.db_path) as conn:
+                    conn.execute('UPDATE pending_backfills SET claimed_at = NULL WHERE name = ?', (name,))
+                raise
+            with transaction(self.db_path) as conn:
+                conn.execute('DELETE FROM pending_backfills WHERE name = ?', (name,))
+            completed.append(name)
+        return completed
+
+    def _iter_conversation_entries(self):
+        """Recorre las conversaciones en disco: (teléfono, directorio base, nombre, archivada)"""
+        for base_dir, archived in ((self.archived_dir, True), (self.conversations_dir, False)):
+            if not base_dir or not os.path.isdir(base_dir):
+                continue
+            for name in os.listdir(base_dir):
+                if conversation_archive.is_segment(name):
+                    yield conversation_archive.phone_from_segment(name), base_dir, name, True
+                else:
+                    yield name, base_dir, name, archived
+
+    def _backfill_summaries(self, locks):
+        """Calcula el resumen de cada conversación existente"""
+        placeholders = ', '.join('?' for _ in SUMMARY_COLUMNS)
+        count = 0
+        for phone_number, base_dir, name, archived in self._iter_conversation_entries():
+            with locks.lock(phone_number):
+                path = os.path.join(base_dir, name)
+                if conversation_archive.is_segment(name):
+                    if not os.path.exists(path):
+                        continue
+                    summary = self._summary_from_header(conversation_archive.read_header(path))
+                else:
+                    messages_file = os.path.join(path, 'messages.json')
+                    if not os.path.exists(messages_file):
+                        continue
+                    with open(messages_file, 'r', encoding='utf-8') as f:
+                        try:
+                            summary = build_summary(phone_number, json.load(f), archived)
+                        except json.JSONDecodeError:
+                            continue
+                if not summary:
+                    continue
+                # Bajo el bloqueo de la conversación ningún mensaje nuevo puede
+                # actualizar el resumen a la vez, así que se sustituye completo,
+                # salvo los no leídos si ya existía (pueden haberse marcado como leídos)
+                with transaction(self.db_path) as conn:
+                    conn.execute(
+                        f'INSERT INTO conversation_summary ({", ".join(SUMMARY_COLUMNS)}) '
+                        f'VALUES ({placeholders}) ON CONFLICT(phone_number) DO UPDATE SET '
+                        + ', '.join(f'{column} = excluded.{column}' for column in SUMMARY_COLUMNS
+                                    if column not in ('phone_number', 'unread_count')),
+                        tuple(summary[column] for column in SUMMARY_COLUMNS)
+                    )
+                count += 1
+        print(f"Resúmenes de conversaciones calculados: {count}")
+
+    def _backfill_message_ts_ms(self, locks):
+        """
+        Añade el campo ts_ms a los mensajes ya guardados.
+
+        Cada archivo se reescribe de forma atómica (archivo temporal y renombrado)
+        con el bloqueo de su conversación, para no perder un mensaje guardado a la vez.
+        """
+        updated = 0
+        for phone_number, base_dir, name, _ in self._iter_conversation_entries():
+            path = os.path.join(base_dir, name)
+            with locks.lock(phone_number):
+                if conversation_archive.is_segment(name):
+                    if not os.path.exists(path):
+                        continue
+                    _, messages = conversation_archive.read_segment(path)
+                    if messages is not None and add_ts_ms(messages):
+                        conversation_archive.write_segment(path, phone_number, messages)
+                        updated += 1
+                    continue
+
+                messages_file = os.path.join(path, 'messages.json')
+                if not os.path.exists(messages_file):
+                    continue
+                with open(messages_file, 'r', encoding='utf-8') as f:
+                    try:
+                        messages = json.load(f)
+                    except json.JSONDecodeError:
+                        continue
+                if add_ts_ms(messages):
+                    temp_file = messages_file + '.tmp'
+                    with open(temp_file, 'w', encoding='utf-8') as f:
+                        json.dump(messages, f, ensure_ascii=False, indent=2)
+                    os.replace(temp_file, messages_file)
+                    updated += 1
+        print(f"Conversaciones actualizadas con ts_ms: {updated}")
+
+    @staticmethod
+    def _summary_from_header(header):
+        """Resumen de una conversación archivada a partir de la cabecera de su segmento"""
+        if not header or not header.get('last_message'):
+            return None
+        last = header['last_message']
+        return {
+            'phone_number': header['phone_number'],
+            'last_ts_ms': message_ts_ms(last, default=_now_ms()),
+            'last_timestamp': last.get('timestamp'),
+            'last_source': header['source'],
+            'last_direction': last.get('direction'),
+            'preview': _preview(last),
+            'message_count': header['message_count'],
+            'received_count': header['received_count'],
+            'sent_count': header['sent_count'],
+            'unread_count': 0,
+            'archived': 1,
+        }
+
+    def get_tags(self, phone_number):
+        """
+        Obtiene las etiquetas de una conversación.
+
+        Args:
+            phone_number (str): Número de teléfono normalizado
+
+        Returns:
+            list: Etiquetas en el orden en que se añadieron
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute(
+            'SELECT tag FROM conversation_tags WHERE phone_number = ? ORDER BY rowid',
+            (phone_number,)
+        )
+        return [row['tag'] for row in cursor.fetchall()]
+
+    def set_tags(self, phone_number, tags):
+        """
+        Reemplaza las etiquetas de una conversación.
+
+        Args:
+            phone_number (str): Número de teléfono normalizado
+            tags (list): Nuevas etiquetas
+
+        Returns:
+            list: Etiquetas guardadas
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute('DELETE FROM conversation_tags WHERE phone_number = ?', (phone_number,))
+            conn.executemany(
+                'INSERT OR IGNORE INTO conversation_tags (phone_number, tag) VALUES (?, ?)',
+                [(phone_number, tag) for tag in tags]
+            )
+        return self.get_tags(phone_number)
+
+    def add_tag(self, phone_number, tag):
+        """
+        Añade una etiqueta a una conversación (sin duplicarla).
+
+        Returns:
+            list: Etiquetas de la conversación
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO conversation_tags (phone_number, tag) VALUES (?, ?)',
+                (phone_number, tag)
+            )
+        return self.get_tags(phone_number)
+
+    def add_tag_many(self, phone_numbers, tag):
+        """
+        Añade una etiqueta a varias conversaciones en una sola transacción.
+
+        Args:
+            phone_numbers (iterable): Teléfonos normalizados
+            tag (str): Etiqueta
+        """
+        with transaction(self.db_path) as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO conversation_tags (phone_number, tag) VALUES (?, ?)',
+                [(phone_number, tag) for phone_number in phone_numbers]
+            )
+
+    def remove_tag(self, phone_number, tag):
+        """
+        Elimina una etiqueta de una conversación.
+
+        Returns:
+            list: Etiquetas de la conversación
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                'DELETE FROM conversation_tags WHERE phone_number = ? AND tag = ?',
+                (phone_number, tag)
+            )
+        return self.get_tags(phone_number)
+
+    def get_all_tags(self):
+        """
+        Obtiene las etiquetas de todas las conversaciones.
+
+        Returns:
+            dict: {teléfono: [etiquetas]}
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT phone_number, tag FROM conversation_tags ORDER BY rowid')
+        tags = {}
+        for row in cursor:
+            tags.setdefault(row['phone_number'], []).append(row['tag'])
+        return tags
+
+    def get_all_statuses(self):
+        """
+        Obtiene el estado de todas las conversaciones que tienen uno.
+
+        Returns:
+            dict: {teléfono: estado}
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT phone_number, status FROM conversation_status')
+        return {row['phone_number']: row['status'] for row in cursor}
+
+    def get_status(self, phone_number):
+        """
+        Obtiene el estado de una conversación.
+
+        Returns:
+            str: Estado, o None si la conversación no tiene estado
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT status FROM conversation_status WHERE phone_number = ?', (phone_number,))
+        row = cursor.fetchone()
+        return row['status'] if row else None
+
+    def set_status(self, phone_number, status):
+        """
+        Establece el estado de una conversación.
+
+        Returns:
+            str: Estado guardado
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            INSERT INTO conversation_status (phone_number, status, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(phone_number) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+            ''', (phone_number, status, datetime.now().isoformat()))
+        return status
+
+    def set_status_if_missing(self, phone_number, status):
+        """
+        Establece el estado de una conversación solo si aún no tiene ninguno.
+
+        Returns:
+            bool: True si se estableció el estado
+        """
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO conversation_status (phone_number, status, updated_at) VALUES (?, ?, ?)',
+                (phone_number, status, datetime.now().isoformat())
+            )
+            return cursor.rowcount > 0
+
+    def record_message(self, phone_number, message):
+        """
+        Actualiza el resumen de una conversación con un mensaje nuevo.
+
+        Los datos del último mensaje solo se reemplazan si el mensaje no es más
+        antiguo que el último registrado.
+
+        Args:
+            phone_number (str): Número de teléfono normalizado
+            message (dict): Mensaje guardado
+
+        Returns:
+            dict: Resumen actualizado
+        """
+        received = 1 if message.get('direction') == 'received' else 0
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            INSERT INTO conversation_summary (
+                phone_number, last_ts_ms, last_timestamp, last_source, last_direction, preview,
+                message_count, received_count, sent_count, unread_count, archived
+            ) VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, 0)
+            ON CONFLICT(phone_number) DO UPDATE SET
+                last_timestamp = CASE WHEN excluded.last_ts_ms >= last_ts_ms THEN excluded.last_timestamp ELSE last_timestamp END,
+                last_source = CASE WHEN excluded.last_ts_ms >= last_ts_ms THEN excluded.last_source ELSE last_source END,
+                last_direction = CASE WHEN excluded.last_ts_ms >= last_ts_ms THEN excluded.last_direction ELSE last_direction END,
+                preview = CASE WHEN excluded.last_ts_ms >= last_ts_ms THEN excluded.preview ELSE preview END,
+                last_ts_ms = MAX(last_ts_ms, excluded.last_ts_ms),
+                message_count = message_count + 1,
+                received_count = received_count + excluded.received_count,
+                sent_count = sent_count + excluded.sent_count,
+                unread_count = unread_count + excluded.unread_count,
+                archived = 0
+            ''', (
+                phone_number, message_ts_ms(message, default=_now_ms()), message.get('timestamp'),
+                message.get('source', 'whatsapp'), message.get('direction'), _preview(message),
+                received, 1 - received, received
+            ))
+        return self.get_summary(phone_number)
+
+    def set_archived(self, phone_number, archived):
+        """Marca el resumen de una conversación como archivado o activo"""
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                'UPDATE conversation_summary SET archived = ? WHERE phone_number = ?',
+                (1 if archived else 0, phone_number)
+            )
+
+    def mark_read(self, phone_number):
+        """Pone a cero los mensajes sin leer de una conversación"""
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                'UPDATE conversation_summary SET unread_count = 0 WHERE phone_number = ? AND unread_count > 0',
+                (phone_number,)
+            )
+
+    def get_summary(self, phone_number):
+        """
+        Obtiene el resumen de una conversación.
+
+        Returns:
+            dict: Resumen, o None si la conversación no tiene mensajes
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT * FROM conversation_summary WHERE phone_number = ?', (phone_number,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+    def get_all_summaries(self):
+        """
+        Obtiene los resúmenes de todas las conversaciones.
+
+        Returns:
+            list: Resúmenes del más antiguo al más reciente
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT * FROM conversation_summary ORDER BY last_ts_ms')
+        return [dict(row) for row in cursor]
+
+    def query_summaries(self, include_archived=False, tag=None, status=None, source=None):
+        """
+        Obtiene la bandeja de entrada: resúmenes con etiquetas y estado, del más reciente al más antiguo.
+
+        Se lee siempre de la base de datos (con los índices por last_ts_ms, etiqueta,
+        estado y canal), de modo que refleja los cambios hechos por cualquier proceso.
+
+        Args:
+            include_archived (bool): Incluir conversaciones archivadas
+            tag (str, optional): Solo conversaciones con esta etiqueta
+            status (str, optional): Solo conversaciones con este estado
+            source (str, optional): Solo conversaciones cuyo último mensaje llegó por este canal
+
+        Returns:
+            list: Resúmenes con 'tags' y 'status' ('new' si no tiene estado)
+        """
+        conditions, params = self._filter_conditions('s.phone_number', tag, status)
+        if not include_archived:
+            conditions.append('s.archived = 0')
+        if source is not None:
+            conditions.append('s.last_source = ?')
+            params.append(source)
+
+        query = '''
+        SELECT s.*, COALESCE(st.status, ?) AS status
+        FROM conversation_summary AS s
+        LEFT JOIN conversation_status AS st ON st.phone_number = s.phone_number
+        '''
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY s.last_ts_ms DESC'
+
+        conn = get_connection(self.db_path)
+        summaries = [dict(row) for row in conn.execute(query, [DEFAULT_STATUS] + params)]
+        tags = self.get_all_tags()
+        for summary in summaries:
+            summary['archived'] = bool(summary['archived'])
+            summary['tags'] = tags.get(summary['phone_number'], [])
+        return summaries
+
+    def filter_phone_numbers(self, phone_numbers, tag=None, status=None, source=None):
+        """
+        Filtra teléfonos por etiqueta, estado y canal del último mensaje.
+
+        Args:
+            phone_numbers (iterable): Teléfonos candidatos
+            tag (str, optional): Solo conversaciones con esta etiqueta
+            status (str, optional): Solo conversaciones con este estado
+            source (str, optional): Solo conversaciones cuyo último mensaje llegó por este canal
+
+        Returns:
+            set: Teléfonos que cumplen todos los filtros
+        """
+        conditions, params = self._filter_conditions('c.phone_number', tag, status)
+        if source is not None:
+            conditions.append(
+                'EXISTS (SELECT 1 FROM conversation_summary AS s '
+                'WHERE s.phone_number = c.phone_number AND s.last_source = ?)'
+            )
+            params.append(source)
+
+        phone_numbers = set(phone_numbers)
+        if not conditions or not phone_numbers:
+            return phone_numbers
+
+        conn = get_connection(self.db_path)
+        matched = set()
+        candidates = list(phone_numbers)
+        # Consultar por lotes para no superar el límite de parámetros de SQLite
+        for start in range(0, len(candidates), 500):
+            batch = candidates[start:start + 500]
+            values = ', '.join('(?)' for _ in batch)
+            query = (
+                f'WITH c(phone_number) AS (VALUES {values}) '
+                f'SELECT c.phone_number FROM c WHERE {" AND ".join(conditions)}'
+            )
+            matched.update(row['phone_number'] for row in conn.execute(query, batch + params))
+        return matched
+
+    @staticmethod
+    def _filter_conditions(phone_column, tag=None, status=None):
+        """
+        Condiciones SQL de los filtros por etiqueta y estado sobre una columna de teléfonos.
+
+        Returns:
+            tuple: (lista de condiciones, lista de parámetros)
+        """
+        conditions = []
+        params = []
+        if tag is not None:
+            conditions.append(
+                'EXISTS (SELECT 1 FROM conversation_tags AS t '
+                f'WHERE t.phone_number = {phone_column} AND t.tag = ?)'
+            )
+            params.append(tag)
+        if status is not None:
+            # Las conversaciones sin estado guardado cuentan como DEFAULT_STATUS
+            conditions.append(
+                'COALESCE((SELECT st2.status FROM conversation_status AS st2 '
+                f'WHERE st2.phone_number = {phone_column}), ?) = ?'
+            )
+            params.extend([DEFAULT_STATUS, status])
+        return conditions, params
+
+    def get_analysis_marks(self):
+        """
+        Obtiene cuántos mensajes recibidos de cada conversación se han analizado ya.
+
+        Returns:
+            dict: {teléfono: mensajes recibidos analizados}
+        """
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute('SELECT phone_number, analyzed_received FROM bot_analysis_marks')
+        return {row['phone_number']: row['analyzed_received'] for row in cursor}
+
+    def set_analysis_marks(self, marks):
+        """
+        Guarda en una sola transacción los mensajes recibidos analizados por conversación.
+
+        Args:
+            marks (dict): {teléfono: mensajes recibidos analizados}
+        """
+        now = _now_ms()
+        with transaction(self.db_path) as conn:
+            conn.executemany('''
+            INSERT INTO bot_analysis_marks (phone_number, analyzed_received, analyzed_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(phone_number) DO UPDATE SET
+                analyzed_received = excluded.analyzed_received,
+                analyzed_at = excluded.analyzed_at
+            ''', [(phone_number, count, now) for phone_number, count in marks.items()])
@@ -0,0 +1,375 @@
+"""
+Métricas de la aplicación en formato de exposición de Prometheus (/metrics).
+
+Los contadores e histogramas se escriben sin bloqueos: cada hilo acumula sus
+valores en su propio diccionario y solo al leer las métricas se suman los de
+todos los hilos. Los valores de los hilos que ya terminaron se traspasan a un
+acumulado común cuando se crea un hilo nuevo, para que la lista de hilos no
+crezca con cada petición.
+
+Las métricas de nivel (mensajes en cola, avisos pendientes, etc.) se calculan
+al leerlas mediante funciones registradas con register_gauge.
+
+Con varios workers de gunicorn cada proceso tiene sus propios valores y /metrics
+lo responde uno cualquiera. Con REGISTRY.share(directorio), cada proceso guarda
+sus valores en <directorio>/<pid>.json cada SHARE_INTERVAL segundos y al leer
+las métricas se suman los de todos los procesos. Los archivos de los procesos
+que ya terminaron se conservan para que los contadores no retrocedan.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Límites de los intervalos de los histogramas de duración (segundos)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Segundos entre escrituras de los valores de cada proceso en el directorio compartido
+SHARE_INTERVAL = float(os.getenv('METRICS_SHARE_INTERVAL', '10'))
+
+class _Registry:
+    """Métricas registradas y valores por hilo"""
+
+    def __init__(self):
+        self.metrics = []
+        self.gauges = []
+        self._local = threading.local()
+        self._shards = []  # (hilo, valores del hilo)
+        self._retired = {}  # Valores de los hilos que ya terminaron
+        self._lock = threading.Lock()
+        self.share_dir = None
+        self._writer_pid = None  # Proceso en el que corre el hilo que guarda los valores
+
+    def shard(self):
+        """Valores del hilo actual: {(nombre, etiquetas): lista de valores}"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            pass
+        shard = self._local.shard = {}
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    _merge(self._retired, values)
+            alive.append((threading.current_thread(), shard))
+            self._shards = alive
+        if self.share_dir and self._writer_pid != os.getpid():
+            self._start_writer()
+        return shard
+
+    def collect(self):
+        """Suma de los valores de todos los hilos"""
+        with self._lock:
+            totals = {key: list(values) for key, values in self._retired.items()}
+            for _, values in self._shards:
+                _merge(totals, values.copy())
+        return totals
+
+    def share(self, directory):
+        """
+        Comparte los valores de este proceso con los demás workers a través de un directorio.
+
+        Args:
+            directory (str): Directorio común a todos los procesos
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.share_dir = directory
+
+    def _start_writer(self):
+        """Inicia (una vez por proceso, también tras un fork) el hilo que guarda los valores"""
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        threading.Thread(target=self._write_loop, name='metrics-share', daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            time.sleep(SHARE_INTERVAL)
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"Error al guardar las métricas del proceso: {e}")
+
+    def write_snapshot(self, totals=None):
+        """Guarda los valores de este proceso en el directorio compartido"""
+        if totals is None:
+            totals = self.collect()
+        path = os.path.join(self.share_dir, f'{os.getpid()}.json')
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump([[name, list(labelvalues), values] for (name, labelvalues), values in totals.items()], f)
+        os.replace(temp_path, path)
+
+    def collect_all(self):
+        """
+        Suma de los valores de este proceso y, si se comparten, de los demás procesos.
+
+        Returns:
+            dict: {(nombre, etiquetas): lista de valores}
+        """
+        totals = self.collect()
+        if not self.share_dir:
+            return totals
+        own_file = f'{os.getpid()}.json'
+        try:
+            self.write_snapshot(totals)
+            names = os.listdir(self.share_dir)
+        except OSError as e:
+            print(f"Error al leer las métricas de los demás procesos: {e}")
+            return totals
+        combined = {key: list(values) for key, values in totals.items()}
+        for name in names:
+            if name == own_file or not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.share_dir, name), 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                continue
+            _merge(combined, {(metric, tuple(labelvalues)): values for metric, labelvalues, values in entries})
+        return combined
+
+def _merge(target, source):
+    for key, values in source.items():
+        current = target.get(key)
+        if current is None:
+            target[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                current[i] += value
+
+REGISTRY = _Registry()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Counter:
+    """
+    Contador acumulado, opcionalmente con etiquetas.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Args:
+            name (str): Nombre de la métrica (terminado en _total)
+            documentation (str): Descripción
+            labelnames (tuple): Nombres de las etiquetas
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.metrics.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        Incrementa el contador.
+
+        Args:
+            *labelvalues: Valores de las etiquetas, en el orden de labelnames
+            amount (float): Incremento
+        """
+        shard = REGISTRY.shard()
+        key = (self.name, labelvalues)
+        values = shard.get(key)
+        if values is None:
+            shard[key] = [amount]
+        else:
+            values[0] += amount
+
+    def render(self, totals):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for (name, labelvalues), values in sorted(totals.items(), key=lambda item: item[0][1]):
+            if name == self.name:
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(values[0])}')
+        return lines
+
+class Histogram:
+    """
+    Histograma de duraciones (u otros valores), opcionalmente con etiquetas.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name (str): Nombre de la métrica
+            documentation (str): Descripción
+            labelnames (tuple): Nombres de las etiquetas
+            buckets (tuple): Límites superiores de los intervalos, en orden creciente
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        REGISTRY.metrics.append(self)
+
+    def observe(self, value, *labelvalues):
+        """
+        Registra un valor.
+
+        Args:
+            value (float): Valor observado (segundos, en los histogramas de duración)
+            *labelvalues: Valores de las etiquetas, en el orden de labelnames
+        """
+        shard = REGISTRY.shard()
+        key = (self.name, labelvalues)
+        values = shard.get(key)
+        if values is None:
+            # Un contador por intervalo (el último es +Inf) y la suma de los valores
+            values = shard[key] = [0] * (len(self.buckets) + 2)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Mide la duración del bloque `with`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self, totals):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        bounds = self.buckets + (float('inf'),)
+        for (name, labelvalues), values in sorted(totals.items(), key=lambda item: item[0][1]):
+            if name != self.name:
+                continue
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_format_value(values[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+def timed(histogram, *labelvalues):
+    """Decorador que mide la duración de cada llamada a una función en un histograma"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(*labelvalues):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def register_gauge(name, documentation, function, labelnames=()):
+    """
+    Registra una métrica de nivel que se calcula al leer las métricas.
+
+    Args:
+        name (str): Nombre de la métrica
+        documentation (str): Descripción
+        function (callable): Devuelve el valor o, con etiquetas, {tupla de valores de etiquetas: valor}
+        labelnames (tuple): Nombres de las etiquetas
+    """
+    REGISTRY.gauges.append((name, documentation, function, tuple(labelnames)))
+
+def render_metrics():
+    """
+    Todas las métricas en formato de texto de Prometheus.
+
+    Returns:
+        str: Texto de exposición (versión 0.0.4)
+    """
+    totals = REGISTRY.collect_all()
+    lines = []
+    for metric in REGISTRY.metrics:
+        lines.extend(metric.render(totals))
+
+    for name, documentation, function, labelnames in REGISTRY.gauges:
+        try:
+            value = function()
+        except Exception as e:
+            print(f"Error al calcular la métrica {name}: {e}")
+            continue
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} gauge')
+        if labelnames:
+            for labelvalues, labelled_value in sorted(value.items()):
+                lines.append(f'{name}{_format_labels(labelnames, labelvalues)} {_format_value(labelled_value)}')
+        elif value is not None:
+            lines.append(f'{name} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+# Métricas de la aplicación
+
+WEBHOOK_SECONDS = Histogram(
+    'webhook_request_duration_seconds',
+    'Tiempo desde la recepción de un webhook hasta su respuesta',
+    ('channel',)
+)
+
+PROCESS_STAGE_SECONDS = Histogram(
+    'process_message_stage_duration_seconds',
+    'Duración de cada etapa del procesamiento de un mensaje entrante',
+    ('stage',)
+)
+
+EXTERNAL_API_SECONDS = Histogram(
+    'external_api_request_duration_seconds',
+    'Duración de las llamadas a APIs externas (Graph de WhatsApp, Telnyx, Amadeus y envíos del despachador por canal)',
+    ('api', 'operation')
+)
+
+EXTERNAL_API_ERRORS = Counter(
+    'external_api_errors_total',
+    'Llamadas a APIs externas fallidas (error de red o respuesta HTTP de error)',
+    ('api', 'operation')
+)
+
+STORAGE_SECONDS = Histogram(
+    'storage_operation_duration_seconds',
+    'Duración de las lecturas y escrituras de conversaciones y estados',
+    ('operation',)
+)
+
+CACHE_REQUESTS = Counter(
+    'cache_requests_total',
+    'Consultas a las cachés en memoria por resultado (hit o miss)',
+    ('cache', 'result')
+)
+
+@contextmanager
+def track_external_call(api, operation):
+    """
+    Mide una llamada a una API externa y cuenta los errores de red.
+
+    El bloque puede llamar a record_external_error para contar una respuesta de error.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_API_ERRORS.inc(api, operation)
+        raise
+    finally:
+        EXTERNAL_API_SECONDS.observe(time.perf_counter() - start, api, operation)
+
+def record_external_error(api, operation):
+    """Cuenta una respuesta de error de una API externa"""
+    EXTERNAL_API_ERRORS.inc(api, operation)
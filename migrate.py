@@ -0,0 +1,49 @@
+"""
+Aplica las migraciones pendientes de todas las bases de datos de la aplicación.
+
+Se ejecuta una vez por despliegue, antes de arrancar los workers:
+    python migrate.py
+"""
+
+import os
+
+import tours_db
+import user_db
+from db import get_connection, get_schema_version
+from message_handler import MessageHandler
+
+def main():
+    message_handler = MessageHandler()
+    databases = [
+        (tours_db.DB_PATH, tours_db.init_db),
+        (user_db.DB_PATH, user_db.init_db),
+        (message_handler.metadata_store.db_path, message_handler.metadata_store.init_db),
+        (message_handler.search_index.db_path, message_handler.search_index.init_db),
+        (message_handler.outbound_queue.db_path, message_handler.outbound_queue.init_db),
+        (message_handler.campaigns.db_path, message_handler.campaigns.init_db),
+        (message_handler.delivery_status.db_path, message_handler.delivery_status.init_db),
+    ]
+    # El estado anti-bot solo tiene base de datos con el backend compartido
+    if hasattr(message_handler.sender_state, 'init_db'):
+        databases.append((message_handler.sender_state.db_path, message_handler.sender_state.init_db))
+    for db_path, init_db in databases:
+        applied = init_db()
+        version = get_schema_version(get_connection(db_path))
+        status = f"{len(applied)} migraciones aplicadas" if applied else "sin cambios"
+        print(f"{os.path.basename(db_path)}: versión {version} ({status})")
+    
+    # Datos que las migraciones dejan pendientes de calcular a partir de los archivos
+    # de conversaciones; se procesan una conversación cada vez, con su bloqueo
+    completed = message_handler.metadata_store.run_backfills(message_handler.locks)
+    if message_handler.search_index.run_backfill(message_handler.locks):
+        completed.append('search_index')
+    if completed:
+        print(f"Rellenos de datos completados: {', '.join(completed)}")
+    pending = message_handler.metadata_store.pending_backfills()
+    if message_handler.search_index.backfill_pending():
+        pending.append('search_index')
+    if pending:
+        print(f"Rellenos en curso en otro proceso: {', '.join(pending)}")
+
+if __name__ == '__main__':
+    main()
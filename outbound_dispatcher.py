@@ -0,0 +1,814 @@
+"""
+Cola persistente de mensajes salientes y despachador con control de frecuencia.
+
+Los mensajes se guardan en SQLite (data/outbound.db) antes de enviarse, así
+que un reinicio o un error de la API no los pierde. El despachador solo toma el
+mensaje más antiguo pendiente de cada destinatario, de modo que los mensajes a
+un mismo número se entregan en orden (FIFO) aunque haya varios hilos enviando.
+Las partes de un texto dividido forman un grupo: si una parte se da por
+fallida, las siguientes pasan con ella a la cola de fallidos, y al reintentarla
+se vuelven a poner en cola todas juntas y en orden.
+
+Los mensajes cuya clave de idempotencia empieza por un prefijo retenido (los de
+una campaña en pausa) quedan en estado 'held' y no se envían hasta que se
+libera el prefijo; al cancelar el prefijo pasan a 'cancelled'. Los mensajes
+retenidos no bloquean al resto de mensajes del mismo destinatario.
+
+El ritmo de cada canal se limita con un cubo de fichas ajustado al nivel de
+rendimiento de la cuenta de WhatsApp Business (WHATSAPP_MESSAGES_PER_SECOND) o
+del número de Telnyx (SMS_MESSAGES_PER_SECOND). El cubo se guarda en la misma
+base de datos que la cola, así que el límite se cumple entre todos los
+procesos (workers de gunicorn) y no se multiplica por su número.
+Los errores temporales (HTTP 429, límites de frecuencia de la Graph API como el
+código 130429, errores 5xx o de red) se reintentan con espera exponencial y
+aleatoria; los errores permanentes, o agotar OUTBOUND_MAX_ATTEMPTS, envían el
+mensaje a la cola de mensajes fallidos ('dead'), desde donde puede reintentarse
+a mano.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db import get_connection, transaction, register_migrations, ensure_schema
+from metrics import EXTERNAL_API_SECONDS
+
+# Mensajes por segundo permitidos por el nivel de rendimiento de la cuenta de WhatsApp
+WHATSAPP_MESSAGES_PER_SECOND = float(os.getenv('WHATSAPP_MESSAGES_PER_SECOND', '80'))
+
+# Mensajes por segundo permitidos por el número de Telnyx (SMS)
+SMS_MESSAGES_PER_SECOND = float(os.getenv('SMS_MESSAGES_PER_SECOND', '1'))
+
+# Ritmo máximo de envío por canal
+CHANNEL_RATES = {
+    'whatsapp': WHATSAPP_MESSAGES_PER_SECOND,
+    'sms': SMS_MESSAGES_PER_SECOND,
+}
+
+# Hilos que envían mensajes en paralelo
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+
+# Intentos antes de dar un mensaje por fallido
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', '8'))
+
+# Espera base y máxima entre reintentos (segundos)
+OUTBOUND_RETRY_BASE = 2.0
+OUTBOUND_RETRY_MAX = 600.0
+
+# Segundos tras los que un mensaje tomado por un despachador que dejó de
+# responder vuelve a estar pendiente
+OUTBOUND_CLAIM_LEASE = 300
+
+# Códigos de error de la Graph API que indican un límite de frecuencia de la cuenta
+WHATSAPP_RATE_LIMIT_CODES = {4, 80007, 130429, 131048}
+
+# Códigos de error temporales: servicio no disponible, error desconocido o
+# límite de mensajes a un mismo destinatario (131056), que no frena al resto
+WHATSAPP_TRANSIENT_CODES = {1, 2, 131000, 131016, 131056}
+
+class TokenBucket:
+    """
+    Cubo de fichas de un canal, compartido por todos los hilos y procesos que
+    usan la misma cola (el estado se guarda en la tabla rate_buckets).
+    """
+
+    def __init__(self, queue, channel, rate, capacity=None):
+        """
+        Args:
+            queue (OutboundQueue): Cola en cuya base de datos se guarda el cubo
+            channel (str): Canal de envío
+            rate (float): Fichas por segundo
+            capacity (float, optional): Fichas máximas acumuladas (por defecto, un segundo de envíos)
+        """
+        self.queue = queue
+        self.channel = channel
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+
+    def try_acquire(self):
+        """
+        Consume una ficha si hay alguna disponible.
+
+        Returns:
+            float: 0 si se consumió una ficha; si no, segundos hasta que haya una
+        """
+        return self.queue.take_token(self.channel, self.rate, self.capacity)
+
+    def pause(self, seconds):
+        """Detiene los envíos durante unos segundos (tras un aviso de límite de frecuencia)"""
+        self.queue.pause_channel(self.channel, seconds)
+
+def classify_whatsapp_response(status_code, body):
+    """
+    Clasifica la respuesta de la Graph API a un envío.
+
+    Args:
+        status_code (int): Código HTTP
+        body (dict): Cuerpo JSON de la respuesta
+
+    Returns:
+        tuple: ('sent', wamid), ('retry', error) o ('fail', error); con
+               ('rate_limited', error) si además hay que frenar todos los envíos
+    """
+    body = body if isinstance(body, dict) else {}
+    if 200 <= status_code < 300 and body.get('messages'):
+        return 'sent', body['messages'][0].get('id')
+
+    error = body.get('error') or {}
+    code = error.get('code')
+    description = f"{status_code} {code or ''} {error.get('message', '')}".strip()
+
+    if status_code == 429 or code in WHATSAPP_RATE_LIMIT_CODES:
+        return 'rate_limited', description
+    if status_code >= 500 or code in WHATSAPP_TRANSIENT_CODES:
+        return 'retry', description
+    return 'fail', description
+
+def classify_telnyx_response(status_code, body):
+    """
+    Clasifica la respuesta de la API de Telnyx a un envío de SMS.
+
+    Returns:
+        tuple: Igual que classify_whatsapp_response
+    """
+    body = body if isinstance(body, dict) else {}
+    data = body.get('data') or {}
+    if 200 <= status_code < 300 and data.get('id') and not data.get('errors'):
+        return 'sent', data['id']
+
+    errors = body.get('errors') or data.get('errors') or [{}]
+    description = f"{status_code} {errors[0].get('code', '')} {errors[0].get('title', '')}".strip()
+
+    if status_code == 429:
+        return 'rate_limited', description
+    if status_code >= 500:
+        return 'retry', description
+    return 'fail', description
+
+# Clasificador de respuestas por canal
+RESPONSE_CLASSIFIERS = {
+    'whatsapp': classify_whatsapp_response,
+    'sms': classify_telnyx_response,
+}
+
+def retry_delay(attempts):
+    """
+    Espera antes del siguiente intento: exponencial, acotada y con una parte aleatoria.
+
+    Args:
+        attempts (int): Intentos realizados
+
+    Returns:
+        float: Segundos de espera
+    """
+    delay = min(OUTBOUND_RETRY_MAX, OUTBOUND_RETRY_BASE * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class OutboundQueue:
+    """
+    Cola persistente de mensajes salientes sobre SQLite.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite de la cola
+        """
+        self.db_path = db_path
+        register_migrations(db_path, [
+            (1, "Cola de mensajes salientes", self._migration_create_tables),
+            (2, "Clave de idempotencia de los mensajes salientes", self._migration_add_dedupe_key),
+            (3, "Cubos de fichas compartidos y grupos de partes", self._migration_buckets_and_groups),
+            (4, "Prefijos retenidos o cancelados", self._migration_create_holds),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea la tabla de mensajes salientes y sus índices"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            phone_number TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            content TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            created_at REAL NOT NULL,
+            sent_at REAL,
+            message_id TEXT,
+            last_error TEXT
+        )
+        ''')
+        # Cabeza de la cola de cada destinatario (mensajes aún no terminados)
+        conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbound_open ON outbound_messages (phone_number, id)
+        WHERE state IN ('pending', 'sending')
+        ''')
+        conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbound_due ON outbound_messages (next_attempt_at)
+        WHERE state = 'pending'
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_outbound_state ON outbound_messages (state)')
+
+    def _migration_add_dedupe_key(self, conn):
+        """Añade una clave opcional que impide encolar dos veces el mismo mensaje"""
+        conn.execute('ALTER TABLE outbound_messages ADD COLUMN dedupe_key TEXT')
+        conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS idx_outbound_dedupe ON outbound_messages (dedupe_key) '
+            'WHERE dedupe_key IS NOT NULL'
+        )
+
+    def _migration_buckets_and_groups(self, conn):
+        """Crea la tabla de cubos de fichas por canal y la columna de grupo de partes"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            channel TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            paused_until REAL NOT NULL DEFAULT 0
+        )
+        ''')
+        # ID de la primera parte de un texto dividido (NULL en los mensajes de una sola parte)
+        conn.execute('ALTER TABLE outbound_messages ADD COLUMN group_id INTEGER')
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_outbound_group ON outbound_messages (group_id) '
+            'WHERE group_id IS NOT NULL'
+        )
+
+    def _migration_create_holds(self, conn):
+        """Crea la tabla de prefijos de clave de idempotencia retenidos o cancelados"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbound_holds (
+            prefix TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+
+    @staticmethod
+    def _row_to_dict(row):
+        message = dict(row)
+        message['payload'] = json.loads(message['payload'])
+        return message
+
+    def enqueue(self, channel, phone_number, payload, content, dedupe_key=None):
+        """
+        Añade un mensaje a la cola.
+
+        Args:
+            channel (str): Canal de envío ('whatsapp' o 'sms')
+            phone_number (str): Número de teléfono normalizado
+            payload (dict): Cuerpo del mensaje para la API del canal (sin el destinatario)
+            content (str): Texto que se guarda en la conversación al enviarlo
+            dedupe_key (str, optional): Clave única; si ya hay un mensaje con ella no se añade otro
+
+        Returns:
+            int: ID del mensaje en la cola (el existente si la clave ya estaba)
+        """
+        now = time.time()
+        conn = get_connection(self.db_path)
+        # La consulta del prefijo retenido y la inserción, en la misma transacción que hold y cancel
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            state = 'pending'
+            if dedupe_key is not None:
+                hold = conn.execute(
+                    'SELECT state FROM outbound_holds WHERE substr(?, 1, length(prefix)) = prefix',
+                    (dedupe_key,)
+                ).fetchone()
+                if hold is not None:
+                    state = hold['state']
+            cursor = conn.execute('''
+            INSERT OR IGNORE INTO outbound_messages
+                (channel, phone_number, payload, content, state, next_attempt_at, created_at, dedupe_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (channel, phone_number, json.dumps(payload, ensure_ascii=False), content, state, now, now,
+                  dedupe_key))
+            if cursor.rowcount:
+                queue_id = cursor.lastrowid
+            else:
+                queue_id = conn.execute(
+                    'SELECT id FROM outbound_messages WHERE dedupe_key = ?', (dedupe_key,)
+                ).fetchone()['id']
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return queue_id
+
+    def enqueue_parts(self, channel, phone_number, parts):
+        """
+        Añade a la cola las partes de un texto dividido, como un solo grupo.
+
+        Args:
+            channel (str): Canal de envío ('whatsapp' o 'sms')
+            phone_number (str): Número de teléfono normalizado
+            parts (list): Pares (payload, contenido) en orden de envío
+
+        Returns:
+            list: IDs de las partes en la cola
+        """
+        if len(parts) == 1:
+            return [self.enqueue(channel, phone_number, *parts[0])]
+        now = time.time()
+        queue_ids = []
+        with transaction(self.db_path) as conn:
+            for payload, content in parts:
+                cursor = conn.execute('''
+                INSERT INTO outbound_messages
+                    (channel, phone_number, payload, content, next_attempt_at, created_at, group_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (channel, phone_number, json.dumps(payload, ensure_ascii=False), content, now, now,
+                      queue_ids[0] if queue_ids else None))
+                queue_ids.append(cursor.lastrowid)
+            conn.execute('UPDATE outbound_messages SET group_id = ? WHERE id = ?', (queue_ids[0], queue_ids[0]))
+        return queue_ids
+
+    def claim_due(self, limit, now=None):
+        """
+        Toma los mensajes listos para enviar, como mucho uno por destinatario.
+
+        Solo se toma un mensaje si es el más antiguo sin terminar de su
+        destinatario, lo que garantiza el orden por número.
+
+        Args:
+            limit (int): Máximo de mensajes
+
+        Returns:
+            list: Mensajes tomados (estado 'sending')
+        """
+        now = time.time() if now is None else now
+        conn = get_connection(self.db_path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('''
+            SELECT * FROM outbound_messages AS o
+            WHERE state = 'pending' AND next_attempt_at <= ?
+              AND id = (
+                SELECT MIN(id) FROM outbound_messages
+                WHERE phone_number = o.phone_number AND state IN ('pending', 'sending')
+              )
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany(
+                "UPDATE outbound_messages SET state = 'sending', claimed_at = ? WHERE id = ?",
+                [(now, row['id']) for row in rows]
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return [self._row_to_dict(row) for row in rows]
+
+    def take_token(self, channel, rate, capacity, now=None):
+        """
+        Consume una ficha del cubo compartido de un canal.
+
+        La lectura y la actualización del cubo se hacen en una transacción
+        BEGIN IMMEDIATE, de modo que dos procesos no pueden gastar la misma ficha.
+
+        Args:
+            channel (str): Canal de envío
+            rate (float): Fichas por segundo
+            capacity (float): Fichas máximas acumuladas
+
+        Returns:
+            float: 0 si se consumió una ficha; si no, segundos hasta que haya una
+        """
+        now = time.time() if now is None else now
+        conn = get_connection(self.db_path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated_at, paused_until FROM rate_buckets WHERE channel = ?', (channel,)
+            ).fetchone()
+            if row is None:
+                tokens, updated_at, paused_until = capacity, now, 0.0
+            else:
+                tokens, updated_at, paused_until = row['tokens'], row['updated_at'], row['paused_until']
+
+            if now < paused_until:
+                conn.commit()
+                return paused_until - now
+            tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_buckets (channel, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?)',
+                (channel, tokens, now, paused_until)
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return wait
+
+    def pause_channel(self, channel, seconds):
+        """Vacía el cubo de un canal y detiene sus envíos durante unos segundos"""
+        paused_until = time.time() + seconds
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            INSERT INTO rate_buckets (channel, tokens, updated_at, paused_until) VALUES (?, 0, ?, ?)
+            ON CONFLICT (channel) DO UPDATE SET
+                tokens = 0,
+                paused_until = MAX(paused_until, excluded.paused_until),
+                updated_at = MAX(paused_until, excluded.paused_until)
+            ''', (channel, paused_until, paused_until))
+
+    def next_due_at(self):
+        """Momento del próximo intento pendiente, o None si la cola está vacía"""
+        row = get_connection(self.db_path).execute(
+            "SELECT MIN(next_attempt_at) FROM outbound_messages WHERE state = 'pending'"
+        ).fetchone()
+        return row[0]
+
+    def mark_sent(self, queue_id, message_id):
+        """Marca un mensaje como enviado y guarda el ID devuelto por la API"""
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            UPDATE outbound_messages
+            SET state = 'sent', sent_at = ?, message_id = ?, attempts = attempts + 1, last_error = NULL
+            WHERE id = ?
+            ''', (time.time(), message_id, queue_id))
+
+    def mark_retry(self, queue_id, error, delay):
+        """Devuelve un mensaje a la cola para reintentarlo tras una espera"""
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            UPDATE outbound_messages
+            SET state = 'pending', attempts = attempts + 1, next_attempt_at = ?, claimed_at = NULL, last_error = ?
+            WHERE id = ?
+            ''', (time.time() + delay, error, queue_id))
+
+    def defer(self, queue_id, delay):
+        """Devuelve un mensaje a la cola sin contar un intento (canal sin fichas disponibles)"""
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            UPDATE outbound_messages SET state = 'pending', next_attempt_at = ?, claimed_at = NULL
+            WHERE id = ?
+            ''', (time.time() + delay, queue_id))
+
+    def mark_dead(self, queue_id, error):
+        """
+        Envía un mensaje a la cola de fallidos, junto con las partes siguientes de su grupo.
+
+        Returns:
+            list: Partes siguientes que se dieron por fallidas con el mensaje
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute('''
+            UPDATE outbound_messages
+            SET state = 'dead', attempts = attempts + 1, claimed_at = NULL, last_error = ?
+            WHERE id = ?
+            ''', (error, queue_id))
+            # Sin la parte fallida el resto del texto no tiene sentido ni debe adelantarse
+            following = conn.execute('''
+            SELECT * FROM outbound_messages
+            WHERE group_id = (SELECT group_id FROM outbound_messages WHERE id = ?)
+              AND id > ? AND state = 'pending'
+            ORDER BY id
+            ''', (queue_id, queue_id)).fetchall()
+            following = [self._row_to_dict(row) for row in following]
+            for part in following:
+                part['state'] = 'dead'
+                part['last_error'] = f"No enviada: falló la parte anterior ({queue_id})"
+            conn.executemany(
+                'UPDATE outbound_messages SET state = ?, last_error = ? WHERE id = ?',
+                [(part['state'], part['last_error'], part['id']) for part in following]
+            )
+        return following
+
+    def release_stale(self, lease=OUTBOUND_CLAIM_LEASE):
+        """
+        Devuelve a la cola los mensajes tomados hace demasiado tiempo (despachador caído).
+
+        Returns:
+            int: Mensajes devueltos
+        """
+        with transaction(self.db_path) as conn:
+            cursor = conn.execute(
+                "UPDATE outbound_messages SET state = 'pending', claimed_at = NULL "
+                "WHERE state = 'sending' AND claimed_at < ?",
+                (time.time() - lease,)
+            )
+            return cursor.rowcount
+
+    def requeue(self, queue_id):
+        """
+        Vuelve a poner en cola un mensaje fallido (con todas las partes fallidas de su grupo).
+
+        Returns:
+            bool: True si el mensaje existía y estaba fallido
+        """
+        with transaction(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT group_id FROM outbound_messages WHERE id = ? AND state = 'dead'", (queue_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            # El grupo vuelve entero para que sus partes se envíen en orden
+            conn.execute('''
+            UPDATE outbound_messages
+            SET state = 'pending', attempts = 0, next_attempt_at = ?, last_error = NULL
+            WHERE state = 'dead' AND (id = ? OR group_id = ?)
+            ''', (time.time(), queue_id, row['group_id']))
+            return True
+
+    @staticmethod
+    def _prefix_range(prefix):
+        """Límites [desde, hasta) de las claves que empiezan por un prefijo (usa el índice de dedupe_key)"""
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def hold(self, prefix):
+        """
+        Retiene los mensajes pendientes cuya clave empieza por un prefijo, y los que se encolen después.
+
+        Returns:
+            int: Mensajes retenidos
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO outbound_holds (prefix, state, created_at) VALUES (?, 'held', ?)",
+                (prefix, time.time())
+            )
+            cursor = conn.execute(
+                "UPDATE outbound_messages SET state = 'held' "
+                "WHERE state = 'pending' AND dedupe_key >= ? AND dedupe_key < ?",
+                self._prefix_range(prefix)
+            )
+            return cursor.rowcount
+
+    def release(self, prefix):
+        """
+        Devuelve a la cola los mensajes retenidos con un prefijo.
+
+        Returns:
+            int: Mensajes devueltos a la cola
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute("DELETE FROM outbound_holds WHERE prefix = ? AND state = 'held'", (prefix,))
+            cursor = conn.execute(
+                "UPDATE outbound_messages SET state = 'pending' "
+                "WHERE state = 'held' AND dedupe_key >= ? AND dedupe_key < ?",
+                self._prefix_range(prefix)
+            )
+            return cursor.rowcount
+
+    def cancel(self, prefix):
+        """
+        Cancela los mensajes pendientes o retenidos con un prefijo, y los que se encolen después.
+
+        Returns:
+            dict: {ID en la cola: teléfono} de los mensajes cancelados
+        """
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO outbound_holds (prefix, state, created_at) VALUES (?, 'cancelled', ?)",
+                (prefix, time.time())
+            )
+            rows = conn.execute(
+                "SELECT id, phone_number FROM outbound_messages "
+                "WHERE state IN ('pending', 'held') AND dedupe_key >= ? AND dedupe_key < ?",
+                self._prefix_range(prefix)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbound_messages SET state = 'cancelled', claimed_at = NULL WHERE id = ?",
+                [(row['id'],) for row in rows]
+            )
+        return {row['id']: row['phone_number'] for row in rows}
+
+    def get_states(self, queue_ids):
+        """
+        Estado de varios mensajes de la cola.
+
+        Args:
+            queue_ids (list): IDs de la cola
+
+        Returns:
+            dict: {ID: {'state', 'message_id', 'last_error'}}
+        """
+        states = {}
+        conn = get_connection(self.db_path)
+        # Consultar por bloques para no superar el límite de parámetros de SQLite
+        for start in range(0, len(queue_ids), 500):
+            chunk = queue_ids[start:start + 500]
+            cursor = conn.execute(
+                f"SELECT id, state, message_id, last_error FROM outbound_messages "
+                f"WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for row in cursor:
+                states[row['id']] = {
+                    'state': row['state'],
+                    'message_id': row['message_id'],
+                    'last_error': row['last_error']
+                }
+        return states
+
+    def get_stats(self):
+        """
+        Número de mensajes por estado.
+
+        Returns:
+            dict: {estado: mensajes}
+        """
+        cursor = get_connection(self.db_path).execute(
+            'SELECT state, COUNT(*) AS count FROM outbound_messages GROUP BY state'
+        )
+        return {row['state']: row['count'] for row in cursor}
+
+    def get_dead(self, limit=100):
+        """
+        Mensajes fallidos, del más reciente al más antiguo.
+
+        Returns:
+            list: Mensajes fallidos
+        """
+        cursor = get_connection(self.db_path).execute(
+            "SELECT * FROM outbound_messages WHERE state = 'dead' ORDER BY id DESC LIMIT ?", (limit,)
+        )
+        return [self._row_to_dict(row) for row in cursor]
+
+class OutboundDispatcher:
+    """
+    Despachador en segundo plano de la cola de mensajes salientes.
+    """
+
+    def __init__(self, queue, senders, on_sent=None, on_dead=None, workers=OUTBOUND_WORKERS,
+                 rates=None, max_attempts=OUTBOUND_MAX_ATTEMPTS):
+        """
+        Args:
+            queue (OutboundQueue): Cola persistente
+            senders (dict): {canal: función(teléfono, payload) -> (código HTTP, cuerpo JSON)}
+            on_sent (callable, optional): Se llama con (mensaje, ID devuelto) al enviarse un mensaje
+            on_dead (callable, optional): Se llama con (mensaje, error) al darse un mensaje por fallido
+            workers (int): Hilos de envío
+            rates (dict, optional): Mensajes por segundo por canal (por defecto CHANNEL_RATES)
+            max_attempts (int): Intentos antes de dar un mensaje por fallido
+        """
+        self.queue = queue
+        self.senders = senders
+        self.on_sent = on_sent
+        self.on_dead = on_dead
+        self.workers = workers
+        self.max_attempts = max_attempts
+        rates = CHANNEL_RATES if rates is None else rates
+        self.buckets = {channel: TokenBucket(queue, channel, rate) for channel, rate in rates.items()}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, channel, phone_number, payload, content, dedupe_key=None):
+        """
+        Añade un mensaje a la cola y despierta al despachador.
+
+        Returns:
+            int: ID del mensaje en la cola
+        """
+        queue_id = self.queue.enqueue(channel, phone_number, payload, content, dedupe_key)
+        self._wakeup.set()
+        return queue_id
+
+    def enqueue_parts(self, channel, phone_number, parts):
+        """
+        Añade a la cola las partes de un texto dividido y despierta al despachador.
+
+        Returns:
+            list: IDs de las partes en la cola
+        """
+        queue_ids = self.queue.enqueue_parts(channel, phone_number, parts)
+        self._wakeup.set()
+        return queue_ids
+
+    def wake(self):
+        """Avisa al despachador de que hay mensajes nuevos en la cola"""
+        self._wakeup.set()
+
+    def start(self):
+        """Inicia (una sola vez por proceso) el hilo del despachador"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='outbound-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbound-sender')
+        slots = threading.BoundedSemaphore(self.workers)
+        last_release = 0.0
+        while True:
+            try:
+                if time.time() - last_release > 60:
+                    released = self.queue.release_stale()
+                    if released:
+                        print(f"Mensajes salientes devueltos a la cola: {released}")
+                    last_release = time.time()
+
+                # Tomar como mucho tantos mensajes como hilos libres
+                free = 0
+                while slots.acquire(blocking=False):
+                    free += 1
+                messages = self.queue.claim_due(free) if free else []
+                for _ in range(free - len(messages)):
+                    slots.release()
+
+                for message in messages:
+                    executor.submit(self._deliver_and_release, message, slots)
+
+                if not messages:
+                    next_due = self.queue.next_due_at()
+                    timeout = 1.0 if next_due is None else min(max(next_due - time.time(), 0.05), 1.0)
+                    self._wakeup.wait(timeout)
+                    self._wakeup.clear()
+            except Exception as e:
+                print(f"Error en el despachador de mensajes salientes: {e}")
+                time.sleep(1)
+
+    def _deliver_and_release(self, message, slots):
+        try:
+            self.deliver(message)
+        except Exception as e:
+            print(f"Error al enviar el mensaje saliente {message['id']}: {e}")
+            self.queue.mark_retry(message['id'], str(e), retry_delay(message['attempts'] + 1))
+        finally:
+            slots.release()
+            self._wakeup.set()
+
+    def deliver(self, message):
+        """
+        Envía un mensaje tomado de la cola y registra el resultado.
+
+        Args:
+            message (dict): Mensaje de la cola
+        """
+        sender = self.senders.get(message['channel'])
+        bucket = self.buckets.get(message['channel'])
+        if sender is None or bucket is None:
+            self._dead(message, f"Canal desconocido: {message['channel']}")
+            return
+
+        # Sin fichas disponibles el mensaje vuelve a la cola en lugar de ocupar un
+        # hilo esperando, para que un canal lento no frene a los demás
+        wait = bucket.try_acquire()
+        if wait > 0:
+            self.queue.defer(message['id'], wait)
+            return
+
+        try:
+            with EXTERNAL_API_SECONDS.time('dispatcher', message['channel']):
+                status_code, body = sender(message['phone_number'], message['payload'])
+            outcome, detail = RESPONSE_CLASSIFIERS[message['channel']](status_code, body)
+        except Exception as e:
+            # Errores de red: siempre temporales
+            outcome, detail = 'retry', str(e)
+
+        if outcome == 'sent':
+            self.queue.mark_sent(message['id'], detail)
+            self._notify(self.on_sent, message, detail)
+            return
+
+        if outcome == 'fail' or message['attempts'] + 1 >= self.max_attempts:
+            self._dead(message, detail)
+            return
+
+        delay = retry_delay(message['attempts'] + 1)
+        if outcome == 'rate_limited':
+            # Frenar todos los envíos del canal, no solo este mensaje
+            bucket.pause(delay)
+        print(f"Reintento del mensaje saliente {message['id']} a {message['phone_number']} en {delay:.1f}s: {detail}")
+        self.queue.mark_retry(message['id'], detail, delay)
+
+    def _dead(self, message, error):
+        print(f"Mensaje saliente {message['id']} a {message['phone_number']} fallido: {error}")
+        following = self.queue.mark_dead(message['id'], error)
+        self._notify(self.on_dead, message, error)
+        for part in following:
+            self._notify(self.on_dead, part, part['last_error'])
+
+    @staticmethod
+    def _notify(callback, message, detail):
+        """Llama a un aviso sin que su error afecte al estado ya guardado del mensaje"""
+        if callback is None:
+            return
+        try:
+            callback(message, detail)
+        except Exception as e:
+            print(f"Error al registrar el mensaje saliente {message['id']}: {e}")
@@ -0,0 +1,374 @@
+"""
+Estado acotado por remitente para el sistema anti-bot.
+
+Cada número guarda solo las huellas de sus últimos mensajes (en un deque de
+tamaño fijo) y las marcas de tiempo de las respuestas dentro de la ventana de
+límite de frecuencia. Los números se mantienen en orden LRU: los que superan el
+máximo de remitentes o llevan más de ANTI_BOT_IDLE_TTL segundos sin actividad se
+descartan al registrar actividad nueva, así que la memoria no crece con el
+número de remitentes distintos aunque llegue una avalancha de spam.
+
+El backend en memoria es por proceso. Con varios workers, ANTI_BOT_BACKEND=sqlite
+comparte las huellas y los límites de respuestas entre procesos (y reinicios).
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from db import get_connection, transaction, register_migrations, ensure_schema
+from metrics import CACHE_REQUESTS
+
+# Mensajes recientes que se conservan por número para detectar repeticiones
+MESSAGE_HISTORY_SIZE = 10
+
+# Máximo de números con estado en memoria
+ANTI_BOT_MAX_SENDERS = int(os.getenv('ANTI_BOT_MAX_SENDERS', '10000'))
+
+# Segundos sin actividad tras los que se descarta el estado de un número
+ANTI_BOT_IDLE_TTL = int(os.getenv('ANTI_BOT_IDLE_TTL', '3600'))
+
+class SenderState:
+    """Estado anti-bot de un número"""
+
+    __slots__ = ('messages', 'responses', 'last_seen')
+
+    def __init__(self, history_size):
+        self.messages = deque(maxlen=history_size)  # (huella, hora de llegada) de los últimos mensajes
+        self.responses = deque()  # Marcas de tiempo de respuestas dentro de la ventana
+        self.last_seen = 0.0
+
+class SenderStateTable:
+    """
+    Tabla LRU acotada de estados anti-bot por número (backend en memoria, por proceso).
+    """
+
+    def __init__(self, max_senders=ANTI_BOT_MAX_SENDERS, idle_ttl=ANTI_BOT_IDLE_TTL,
+                 history_size=MESSAGE_HISTORY_SIZE):
+        """
+        Args:
+            max_senders (int): Máximo de números con estado
+            idle_ttl (int): Segundos sin actividad tras los que se descarta un número
+            history_size (int): Mensajes recientes por número
+        """
+        self.max_senders = max_senders
+        self.idle_ttl = idle_ttl
+        self.history_size = history_size
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def _touch(self, phone_number, now):
+        """Obtiene (creándolo si es necesario) el estado de un número y lo marca como reciente"""
+        state = self._states.get(phone_number)
+        if state is None:
+            state = self._states[phone_number] = SenderState(self.history_size)
+        else:
+            self._states.move_to_end(phone_number)
+        state.last_seen = now
+        self._evict(now)
+        return state
+
+    def _evict(self, now):
+        """Descarta los números más antiguos si sobran o están inactivos"""
+        idle_before = now - self.idle_ttl
+        while self._states:
+            phone_number, state = next(iter(self._states.items()))
+            if len(self._states) <= self.max_senders and state.last_seen >= idle_before:
+                break
+            del self._states[phone_number]
+
+    def add_message(self, phone_number, fingerprint, now=None):
+        """
+        Registra la huella de un mensaje recibido.
+
+        Args:
+            phone_number (str): Número de teléfono
+            fingerprint (int): Huella de 64 bits del mensaje, o None si es demasiado corto para compararlo
+            now (float, optional): Hora de llegada en segundos Unix
+
+        Returns:
+            list: Pares (huella, hora de llegada) de los mensajes recientes del número
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._touch(phone_number, now)
+            state.messages.append((fingerprint, now))
+            return list(state.messages)
+
+    def recent_messages(self, phone_number):
+        """Pares (huella, hora de llegada) de los mensajes recientes de un número"""
+        with self._lock:
+            state = self._states.get(phone_number)
+            return list(state.messages) if state else []
+
+    @staticmethod
+    def _trim_responses(state, window, now):
+        """Descarta del deque las respuestas que salieron de la ventana deslizante"""
+        window_start = now - window
+        while state.responses and state.responses[0] <= window_start:
+            state.responses.popleft()
+        return len(state.responses)
+
+    def under_limit(self, phone_number, limit, window, now=None):
+        """
+        Indica si un número está por debajo del límite de respuestas, sin registrar nada.
+
+        Args:
+            phone_number (str): Número de teléfono
+            limit (int): Respuestas permitidas en la ventana
+            window (int): Tamaño de la ventana en segundos
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._states.get(phone_number)
+            if state is None:
+                return limit > 0
+            return self._trim_responses(state, window, now) < limit
+
+    def acquire_response(self, phone_number, limit, window, now=None):
+        """
+        Reserva una respuesta si el número no ha alcanzado el límite (comprobación y registro atómicos).
+
+        Returns:
+            bool: True si se puede responder
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._touch(phone_number, now)
+            if self._trim_responses(state, window, now) >= limit:
+                return False
+            state.responses.append(now)
+            return True
+
+class SQLiteSenderState:
+    """
+    Estado anti-bot compartido entre procesos en una base de datos SQLite.
+
+    Las huellas de mensajes y las respuestas se guardan en tablas indexadas por
+    número, y la reserva de respuestas se hace en una transacción BEGIN
+    IMMEDIATE, de modo que el límite se cumple entre todos los workers. Para no
+    consultar la base de datos en cada comprobación previa, cada proceso guarda
+    durante unos segundos el último recuento de cada número y solo vuelve a
+    consultarlo cuando el número se acerca a su límite.
+    """
+
+    # Segundos durante los que se reutiliza el recuento local de respuestas
+    LOCAL_CACHE_TTL = 5
+
+    # Operaciones de escritura entre dos purgas de números inactivos
+    PURGE_EVERY = 1000
+
+    def __init__(self, db_path, idle_ttl=ANTI_BOT_IDLE_TTL, history_size=MESSAGE_HISTORY_SIZE,
+                 max_cached=ANTI_BOT_MAX_SENDERS):
+        """
+        Args:
+            db_path (str): Ruta al archivo SQLite compartido
+            idle_ttl (int): Segundos sin actividad tras los que se purgan los datos de un número
+            history_size (int): Mensajes recientes por número
+            max_cached (int): Máximo de recuentos locales en memoria
+        """
+        self.db_path = db_path
+        self.idle_ttl = idle_ttl
+        self.history_size = history_size
+        self.max_cached = max_cached
+
+        # Recuento local por número: {teléfono: (respuestas, momento de la consulta)}
+        self._cached_counts = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        register_migrations(db_path, [
+            (1, "Tablas de estado anti-bot compartido", self._migration_create_tables),
+            (2, "Huellas opcionales en los mensajes recientes", self._migration_nullable_fingerprint),
+        ])
+
+    def init_db(self):
+        """
+        Aplica las migraciones pendientes.
+
+        Returns:
+            list: Versiones de esquema aplicadas
+        """
+        return ensure_schema(self.db_path)
+
+    def _migration_create_tables(self, conn):
+        """Crea las tablas de huellas de mensajes y de respuestas"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS sender_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            fingerprint INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sender_messages_phone ON sender_messages (phone_number, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sender_messages_created ON sender_messages (created_at)')
+
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS sender_responses (
+            phone_number TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sender_responses_phone ON sender_responses (phone_number, created_at)')
+
+    def _migration_nullable_fingerprint(self, conn):
+        """Permite mensajes sin huella (demasiado cortos para contar como casi duplicados)"""
+        conn.execute('ALTER TABLE sender_messages RENAME TO sender_messages_old')
+        conn.execute('''
+        CREATE TABLE sender_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            fingerprint INTEGER,
+            created_at REAL NOT NULL
+        )
+        ''')
+        conn.execute('''
+        INSERT INTO sender_messages (id, phone_number, fingerprint, created_at)
+        SELECT id, phone_number, fingerprint, created_at FROM sender_messages_old
+        ''')
+        conn.execute('DROP TABLE sender_messages_old')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sender_messages_phone ON sender_messages (phone_number, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_sender_messages_created ON sender_messages (created_at)')
+
+    @staticmethod
+    def _to_signed(fingerprint):
+        """Convierte una huella de 64 bits sin signo al rango de INTEGER de SQLite"""
+        if fingerprint is None:
+            return None
+        return fingerprint - (1 << 64) if fingerprint >= (1 << 63) else fingerprint
+
+    @staticmethod
+    def _to_unsigned(value):
+        if value is None:
+            return None
+        return value + (1 << 64) if value < 0 else value
+
+    def _after_write(self, conn, now):
+        """Purga periódicamente los datos de números inactivos"""
+        with self._lock:
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY:
+                return
+        idle_before = now - self.idle_ttl
+        conn.execute('DELETE FROM sender_messages WHERE created_at < ?', (idle_before,))
+        conn.execute('DELETE FROM sender_responses WHERE created_at < ?', (idle_before,))
+
+    def add_message(self, phone_number, fingerprint, now=None):
+        """
+        Registra la huella de un mensaje recibido.
+
+        Returns:
+            list: Pares (huella, hora de llegada) de los mensajes recientes del número (de todos los procesos)
+        """
+        now = time.time() if now is None else now
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                'INSERT INTO sender_messages (phone_number, fingerprint, created_at) VALUES (?, ?, ?)',
+                (phone_number, self._to_signed(fingerprint), now)
+            )
+            # Conservar solo los últimos mensajes del número
+            conn.execute('''
+            DELETE FROM sender_messages WHERE phone_number = ? AND id NOT IN (
+                SELECT id FROM sender_messages WHERE phone_number = ? ORDER BY id DESC LIMIT ?
+            )
+            ''', (phone_number, phone_number, self.history_size))
+            self._after_write(conn, now)
+        return self.recent_messages(phone_number)
+
+    def recent_messages(self, phone_number):
+        """Pares (huella, hora de llegada) de los mensajes recientes de un número"""
+        cursor = get_connection(self.db_path).cursor()
+        cursor.execute(
+            'SELECT fingerprint, created_at FROM sender_messages WHERE phone_number = ? ORDER BY id DESC LIMIT ?',
+            (phone_number, self.history_size)
+        )
+        return [(self._to_unsigned(row['fingerprint']), row['created_at']) for row in reversed(cursor.fetchall())]
+
+    def _count_responses(self, conn, phone_number, window, now):
+        row = conn.execute(
+            'SELECT COUNT(*) FROM sender_responses WHERE phone_number = ? AND created_at > ?',
+            (phone_number, now - window)
+        ).fetchone()
+        return row[0]
+
+    def _cache_count(self, phone_number, count, now):
+        with self._lock:
+            self._cached_counts.pop(phone_number, None)
+            self._cached_counts[phone_number] = (count, now)
+            while len(self._cached_counts) > self.max_cached:
+                self._cached_counts.popitem(last=False)
+
+    def under_limit(self, phone_number, limit, window, now=None):
+        """
+        Indica si un número está por debajo del límite de respuestas, sin registrar nada.
+
+        Si el recuento local es reciente y el número está claramente por debajo
+        del límite (menos de la mitad) no se consulta la base de datos.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            cached = self._cached_counts.get(phone_number)
+        if cached is not None and now - cached[1] < self.LOCAL_CACHE_TTL and cached[0] < limit // 2:
+            CACHE_REQUESTS.inc('sender_rate_limit', 'hit')
+            return True
+        CACHE_REQUESTS.inc('sender_rate_limit', 'miss')
+
+        count = self._count_responses(get_connection(self.db_path), phone_number, window, now)
+        self._cache_count(phone_number, count, now)
+        return count < limit
+
+    def acquire_response(self, phone_number, limit, window, now=None):
+        """
+        Reserva una respuesta si el número no ha alcanzado el límite en ningún proceso.
+
+        Returns:
+            bool: True si se puede responder
+        """
+        now = time.time() if now is None else now
+        conn = get_connection(self.db_path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM sender_responses WHERE phone_number = ? AND created_at <= ?',
+                (phone_number, now - window)
+            )
+            count = self._count_responses(conn, phone_number, window, now)
+            acquired = count < limit
+            if acquired:
+                conn.execute(
+                    'INSERT INTO sender_responses (phone_number, created_at) VALUES (?, ?)',
+                    (phone_number, now)
+                )
+                count += 1
+            self._after_write(conn, now)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        self._cache_count(phone_number, count, now)
+        return acquired
+
+def create_sender_state(data_dir):
+    """
+    Crea el backend de estado anti-bot configurado en ANTI_BOT_BACKEND.
+
+    'memory' (por defecto) mantiene el estado en cada proceso; 'sqlite' lo
+    comparte entre procesos en data/anti_bot.db (o en ANTI_BOT_DB_PATH).
+
+    Args:
+        data_dir (str): Directorio de datos de la aplicación
+
+    Returns:
+        SenderStateTable | SQLiteSenderState: Backend de estado
+    """
+    backend = os.getenv('ANTI_BOT_BACKEND', 'memory').lower()
+    if backend == 'sqlite':
+        return SQLiteSenderState(os.getenv('ANTI_BOT_DB_PATH', os.path.join(data_dir, 'anti_bot.db')))
+    if backend != 'memory':
+        print(f"ANTI_BOT_BACKEND desconocido '{backend}', se usa el backend en memoria")
+    return SenderStateTable()
@@ -0,0 +1,29 @@
+"""Análisis de bots sobre conversaciones archivadas compactadas"""
+
+import pytest
+
+from bot_analysis import BotAnalysisJob
+from message_handler import MessageHandler
+
+SPAMMER = '5215500000001'
+CUSTOMER = '5215500000002'
+SPAM = 'Gana dinero desde casa, escribe a este número para más información'
+
+@pytest.fixture
+def handler(tmp_path):
+    return MessageHandler(data_dir=str(tmp_path))
+
+def _save_received(handler, phone_number, contents, start=1715760000, step=20):
+    for i, content in enumerate(contents):
+        handler.save_message(phone_number, 'received', 'text', content, timestamp=str(start + i * step))
+
+def test_archived_conversations_use_the_same_rules(handler):
+    _save_received(handler, SPAMMER, [SPAM, SPAM + '!!', SPAM.upper()])
+    _save_received(handler, CUSTOMER, ['detalles tour T001', 'detalles tour T002', 'detalles tour T003',
+                                       'ok', 'ok', 'ok'], step=3600)
+    handler.archive_conversation(SPAMMER)
+    handler.archive_conversation(CUSTOMER)
+
+    detected = BotAnalysisJob(handler, workers=1).run(full=True)
+    assert [bot['phone_number'] for bot in detected] == [SPAMMER]
+    assert detected[0]['reason'] == 'repetition'
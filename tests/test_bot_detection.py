@@ -0,0 +1,57 @@
+"""Detección de bots: comandos habituales que no deben contar como repetición o ritmo"""
+
+import pytest
+
+from bot_detection import scan_messages, message_fingerprint, BOT_MIN_CADENCE_SPAN
+from sender_state import SQLiteSenderState
+
+THRESHOLD = 3
+HISTORY = 10
+
+def _scan(contents, start=1715760000, step=20):
+    return scan_messages([(content, start + i * step) for i, content in enumerate(contents)],
+                         THRESHOLD, HISTORY)
+
+@pytest.mark.parametrize('contents', [
+    ['detalles tour T001', 'detalles tour T002', 'detalles tour T003'],
+    ['vuelos MEX a CUN 2025-05-15', 'vuelos MEX a CUN 2025-05-16', 'vuelos MEX a CUN 2025-05-17'],
+    ['ok', 'ok!', 'Ok'],
+    ['tours', 'tours', 'tours', 'hola', 'hola'],
+])
+def test_command_sequences_are_not_repetition(contents):
+    assert _scan(contents) is None
+
+def test_repeated_spam_is_detected():
+    spam = 'Gana dinero desde casa, escribe a este número para más información'
+    verdict = _scan([spam, spam + '!!', spam.upper()])
+    assert verdict['is_bot'] and verdict['reason'] == 'repetition'
+
+def test_long_spam_with_different_numbers_is_detected():
+    template = 'Oferta exclusiva solo hoy: gana {} pesos desde casa respondiendo encuestas, escribe ya al {}'
+    verdict = _scan([template.format(n, 5500000000 + n) for n in (500, 750, 900)])
+    assert verdict['is_bot'] and verdict['reason'] == 'repetition'
+
+def test_short_messages_have_no_fingerprint():
+    assert message_fingerprint('ok') is None
+    assert message_fingerprint('detalles tour T001') is not None
+
+def test_same_second_burst_is_not_cadence():
+    # Seis fotos enviadas a la vez: todos los intervalos son 0
+    photos = [(f'foto {i}', 1715760000) for i in range(6)]
+    assert scan_messages(photos, THRESHOLD, HISTORY) is None
+
+def test_short_burst_is_not_cadence():
+    # Intervalos regulares pero todo dentro de unos pocos segundos
+    step = BOT_MIN_CADENCE_SPAN / 10
+    assert _scan([f'mensaje número {i}' for i in range(6)], step=step) is None
+
+def test_regular_cadence_is_detected():
+    verdict = _scan([f'pregunta distinta {i}' for i in range(6)], step=10)
+    assert verdict['is_bot'] and verdict['reason'] == 'cadence'
+
+def test_sqlite_state_keeps_messages_without_fingerprint(tmp_path):
+    state = SQLiteSenderState(str(tmp_path / 'sender_state.db'))
+    state.add_message('5215512345678', None, now=1.0)
+    entries = state.add_message('5215512345678', message_fingerprint('detalles tour T001'), now=2.0)
+    assert entries[0] == (None, 1.0)
+    assert entries[1][0] == message_fingerprint('detalles tour T001')
@@ -0,0 +1,62 @@
+"""Pausa y cancelación de campañas con mensajes ya encolados"""
+
+import pytest
+
+from campaigns import CampaignStore, CampaignRunner
+from outbound_dispatcher import OutboundQueue, OutboundDispatcher
+
+PHONES = ['5215500000001', '5215500000002', '5215500000003']
+
+class _Handler:
+    bot_blacklist = set()
+
+@pytest.fixture
+def setup(tmp_path):
+    queue = OutboundQueue(str(tmp_path / 'outbound.db'))
+    sent = []
+    def sender(phone_number, payload):
+        sent.append(phone_number)
+        return 200, {'messages': [{'id': f'wamid.{len(sent)}'}]}
+    dispatcher = OutboundDispatcher(queue, {'whatsapp': sender}, rates={'whatsapp': 1000})
+    store = CampaignStore(str(tmp_path / 'campaigns.db'))
+    runner = CampaignRunner(store, dispatcher, _Handler())
+    campaign_id = store.create('Promo', 'whatsapp', 'text', {'text': 'Hola'}, {}, PHONES)
+    store.set_state(campaign_id, 'running', ('draft',))
+    runner.step(store.get(campaign_id))
+    return queue, dispatcher, store, runner, campaign_id, sent
+
+def _drain(queue, dispatcher):
+    for message in queue.claim_due(100):
+        dispatcher.deliver(message)
+
+def test_pause_holds_queued_messages(setup):
+    queue, dispatcher, store, runner, campaign_id, sent = setup
+    store.set_state(campaign_id, 'paused', ('running',))
+    runner.apply_state(campaign_id, 'paused')
+
+    # Una respuesta normal al mismo destinatario no queda bloqueada por la campaña
+    dispatcher.enqueue('whatsapp', PHONES[0], {'type': 'text', 'text': {'body': 'Respuesta'}}, 'Respuesta')
+    _drain(queue, dispatcher)
+    assert sent == [PHONES[0]]
+    assert queue.get_stats()['held'] == 3
+
+    store.set_state(campaign_id, 'running', ('paused',))
+    runner.apply_state(campaign_id, 'running')
+    _drain(queue, dispatcher)
+    assert sorted(sent[1:]) == PHONES
+    assert runner.step(store.get(campaign_id))
+    assert store.count_by_state(campaign_id) == {'sent': 3}
+
+def test_cancel_drops_queued_messages(setup):
+    queue, dispatcher, store, runner, campaign_id, sent = setup
+    store.set_state(campaign_id, 'cancelled', ('running',))
+    runner.apply_state(campaign_id, 'cancelled')
+    _drain(queue, dispatcher)
+
+    assert sent == []
+    assert queue.get_stats() == {'cancelled': 3}
+    assert store.count_by_state(campaign_id) == {'cancelled': 3}
+
+    # Una pasada que ya estaba en curso tampoco puede encolar mensajes de la campaña
+    queue_id = dispatcher.enqueue('whatsapp', '5215500000009', {}, '', dedupe_key=f'campaign:{campaign_id}:5215500000009')
+    assert queue.get_states([queue_id])[queue_id]['state'] == 'cancelled'
@@ -0,0 +1,51 @@
+"""Paginación de conversaciones con mensajes que comparten marca de tiempo"""
+
+import pytest
+
+from message_handler import MessageHandler
+
+PHONE = '5215512345678'
+
+@pytest.fixture
+def handler(tmp_path):
+    return MessageHandler(data_dir=str(tmp_path))
+
+def _page_through(handler, limit):
+    contents = []
+    before = None
+    while True:
+        page = handler.get_conversation(PHONE, before=before, limit=limit)
+        contents[:0] = [msg['content'] for msg in page['messages']]
+        before = page['next_before']
+        if before is None:
+            return contents
+
+def test_page_boundary_between_equal_timestamps(handler):
+    # Ráfaga de mensajes en el mismo segundo (resolución de los timestamps de WhatsApp)
+    for i in range(7):
+        handler.save_message(PHONE, 'received', 'text', f'm{i}', timestamp='1715760000')
+
+    first = handler.get_conversation(PHONE, limit=3)
+    assert [msg['content'] for msg in first['messages']] == ['m4', 'm5', 'm6']
+
+    assert _page_through(handler, limit=3) == [f'm{i}' for i in range(7)]
+
+def test_pages_keep_every_message_across_mixed_timestamps(handler):
+    timestamps = ['1715760000', '1715760001', '1715760001', '1715760001', '1715760002', '1715760002']
+    for i, timestamp in enumerate(timestamps):
+        handler.save_message(PHONE, 'received', 'text', f'm{i}', timestamp=timestamp)
+
+    for limit in (1, 2, 4):
+        assert _page_through(handler, limit=limit) == [f'm{i}' for i in range(len(timestamps))]
+
+def test_before_in_milliseconds_excludes_that_instant(handler):
+    handler.save_message(PHONE, 'received', 'text', 'old', timestamp='1715760000')
+    handler.save_message(PHONE, 'received', 'text', 'new', timestamp='1715760001')
+
+    page = handler.get_conversation(PHONE, before=1715760001000, limit=10)
+    assert [msg['content'] for msg in page['messages']] == ['old']
+
+def test_invalid_cursor(handler):
+    handler.save_message(PHONE, 'received', 'text', 'hola', timestamp='1715760000')
+    with pytest.raises(ValueError):
+        handler.get_conversation(PHONE, before='abc', limit=10)
@@ -0,0 +1,48 @@
+"""Bandeja de entrada servida desde la tabla de resúmenes"""
+
+from message_handler import MessageHandler
+
+def test_summaries_include_messages_saved_by_other_workers(tmp_path):
+    # Dos instancias sobre el mismo directorio simulan dos workers de gunicorn
+    worker_a = MessageHandler(data_dir=str(tmp_path))
+    worker_b = MessageHandler(data_dir=str(tmp_path))
+
+    worker_a.save_message('5215511111111', 'received', 'text', 'hola', timestamp='1715760000')
+    assert [s['phone_number'] for s in worker_a.get_conversation_summaries()] == ['5215511111111']
+
+    worker_b.save_message('5215522222222', 'received', 'text', 'buenas tardes', timestamp='1715760100')
+    summaries = worker_a.get_conversation_summaries()
+    assert [s['phone_number'] for s in summaries] == ['5215522222222', '5215511111111']
+    assert summaries[0]['preview'] == 'buenas tardes'
+    assert summaries[0]['unread_count'] == 1
+    assert summaries[0]['status'] == 'new'
+
+def test_read_and_archive_are_reflected(tmp_path):
+    handler = MessageHandler(data_dir=str(tmp_path))
+    handler.save_message('5215511111111', 'received', 'text', 'hola', timestamp='1715760000')
+    handler.save_message('5215522222222', 'received', 'text', 'hola', timestamp='1715760100')
+
+    handler.mark_conversation_read('5215511111111')
+    handler.archive_conversation('5215522222222')
+
+    summaries = handler.get_conversation_summaries()
+    assert [(s['phone_number'], s['unread_count']) for s in summaries] == [('5215511111111', 0)]
+    archived = handler.get_conversation_summaries(include_archived=True)
+    assert [s['phone_number'] for s in archived] == ['5215522222222', '5215511111111']
+    assert archived[0]['archived'] is True
+
+def test_filters_see_changes_made_by_other_workers(tmp_path):
+    worker_a = MessageHandler(data_dir=str(tmp_path))
+    worker_b = MessageHandler(data_dir=str(tmp_path))
+    worker_a.save_message('5215511111111', 'received', 'text', 'hola', timestamp='1715760000')
+    worker_a.save_message('5215522222222', 'received', 'text', 'hola', timestamp='1715760100', source='sms')
+    assert worker_a.get_phone_numbers(tag='vip') == []
+
+    worker_b.add_conversation_tag('5215511111111', 'vip')
+    worker_b.set_conversation_status('5215522222222', 'resolved')
+
+    assert [s['phone_number'] for s in worker_a.get_conversation_summaries(tag='vip')] == ['5215511111111']
+    assert [s['phone_number'] for s in worker_a.get_conversation_summaries(status='new')] == ['5215511111111']
+    assert [s['phone_number'] for s in worker_a.get_conversation_summaries(source='sms')] == ['5215522222222']
+    assert worker_a.get_phone_numbers(status='resolved') == ['5215522222222']
+    assert [c['phone_number'] for c in worker_a.get_conversations(tag='vip', status='new')] == ['5215511111111']
@@ -0,0 +1,39 @@
+"""Lecturas del estado de entrega sin escribir el lote en curso"""
+
+import pytest
+
+from delivery_status import DeliveryStatusStore
+
+@pytest.fixture
+def store(tmp_path):
+    # Intervalo largo: los avisos se quedan en memoria durante la prueba
+    store = DeliveryStatusStore(str(tmp_path / 'delivery.db'), flush_interval=60)
+    store.init_db()
+    return store
+
+def _event(message_id, state, ts_ms, error=None):
+    return {'message_id': message_id, 'phone_number': '5215512345678', 'channel': 'whatsapp',
+            'state': state, 'ts_ms': ts_ms, 'error': error}
+
+def test_reads_combine_saved_and_buffered_events(store):
+    store.add_events([_event('wamid.1', 'sent', 1000)])
+    store.flush()
+    store.add_events([_event('wamid.1', 'delivered', 2000), _event('wamid.2', 'sent', 1500)])
+
+    status = store.get_status('wamid.1')
+    assert status['state'] == 'delivered'
+    assert (status['sent_at_ms'], status['delivered_at_ms']) == (1000, 2000)
+    statuses = store.get_statuses(['wamid.1', 'wamid.2', 'wamid.3'])
+    assert {message_id: s['state'] for message_id, s in statuses.items()} == {'wamid.1': 'delivered', 'wamid.2': 'sent'}
+    # Leer no aplica el lote
+    assert store.buffered() == 2
+
+def test_reads_do_not_fail_when_the_flush_would(store, monkeypatch):
+    store.add_events([_event('wamid.1', 'sent', 1000), _event('wamid.1', 'read', 3000)])
+
+    def fail(rows):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(store, '_apply', fail)
+
+    assert store.get_status('wamid.1')['state'] == 'read'
+    assert store.get_metrics(0)['total'] == 0
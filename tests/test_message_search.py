@@ -0,0 +1,41 @@
+"""Indexado de los mensajes existentes fuera de la migración del índice de búsqueda"""
+
+import json
+import os
+
+from message_handler import MessageHandler
+
+PHONE = '5215512345678'
+
+def _write_history(data_dir, phone_number, contents):
+    conversation_dir = os.path.join(data_dir, 'conversations', phone_number)
+    os.makedirs(conversation_dir)
+    messages = [{'direction': 'received', 'type': 'text', 'content': content,
+                 'timestamp': str(1715760000 + i)} for i, content in enumerate(contents)]
+    with open(os.path.join(conversation_dir, 'messages.json'), 'w', encoding='utf-8') as f:
+        json.dump(messages, f)
+
+def test_migration_only_records_the_backfill(tmp_path):
+    _write_history(str(tmp_path), PHONE, ['quiero reservar cancún'])
+    handler = MessageHandler(data_dir=str(tmp_path))
+
+    handler.search_index.init_db()
+    assert handler.search_index.backfill_pending()
+    assert handler.search_index.search('cancún')['results'] == []
+
+    assert handler.search_index.run_backfill(handler.locks)
+    assert not handler.search_index.backfill_pending()
+    result = handler.search_index.search('cancún')
+    assert [r['phone_number'] for r in result['results']] == [PHONE]
+    assert result['indexing'] is False
+
+def test_messages_saved_before_the_backfill_are_not_duplicated(tmp_path):
+    _write_history(str(tmp_path), PHONE, ['hola cancún'])
+    handler = MessageHandler(data_dir=str(tmp_path))
+
+    handler.save_message(PHONE, 'received', 'text', 'precio cancún', timestamp='1715760100')
+    handler._backfill_thread.join()
+    handler.search_index.run_backfill(handler.locks)
+
+    contents = [r['snippet'] for r in handler.search_index.search('cancún')['results']]
+    assert len(contents) == 2
@@ -0,0 +1,20 @@
+"""Suma de las métricas de varios workers a través del directorio compartido"""
+
+import json
+
+from metrics import _Registry
+
+def test_collect_all_adds_other_processes(tmp_path):
+    registry = _Registry()
+    registry.share(str(tmp_path))
+    registry.shard()[('requests_total', ('whatsapp',))] = [2]
+
+    # Valores guardados por otro worker
+    with open(tmp_path / '999999.json', 'w', encoding='utf-8') as f:
+        json.dump([['requests_total', ['whatsapp'], [3]], ['requests_total', ['sms'], [1]]], f)
+
+    totals = registry.collect_all()
+    assert totals[('requests_total', ('whatsapp',))] == [5]
+    assert totals[('requests_total', ('sms',))] == [1]
+    # Los valores propios no cambian al sumar los de los demás
+    assert registry.collect()[('requests_total', ('whatsapp',))] == [2]
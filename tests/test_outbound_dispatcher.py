@@ -0,0 +1,91 @@
+"""Cola de mensajes salientes: límite de frecuencia compartido y orden de las partes"""
+
+import threading
+import time
+
+import pytest
+
+from metrics import REGISTRY, EXTERNAL_API_SECONDS
+from outbound_dispatcher import OutboundQueue, OutboundDispatcher, TokenBucket
+
+PHONE = '5215512345678'
+
+@pytest.fixture
+def queue(tmp_path):
+    return OutboundQueue(str(tmp_path / 'outbound.db'))
+
+def _text(body):
+    return {'type': 'text', 'text': {'body': body}}, body
+
+def test_token_bucket_is_shared_between_processes(queue):
+    # Cada hilo tiene su propia conexión, como un worker distinto
+    acquired = []
+    def worker():
+        bucket = TokenBucket(OutboundQueue(queue.db_path), 'whatsapp', rate=0.001, capacity=3)
+        acquired.extend(wait for wait in (bucket.try_acquire() for _ in range(3)) if wait == 0)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(acquired) == 3
+
+def test_pause_applies_to_every_bucket_of_the_channel(queue):
+    TokenBucket(queue, 'whatsapp', rate=10).pause(30)
+    assert TokenBucket(OutboundQueue(queue.db_path), 'whatsapp', rate=10).try_acquire() > 29
+    assert TokenBucket(queue, 'sms', rate=1).try_acquire() == 0
+
+def test_failed_part_takes_the_rest_of_its_group(queue):
+    responses = {'parte 1': (400, {'error': {'code': 100, 'message': 'Invalid parameter'}})}
+    sent, dead = [], []
+    def sender(phone_number, payload):
+        body = payload['text']['body']
+        sent.append(body)
+        return responses.get(body, (200, {'messages': [{'id': f'wamid.{body}'}]}))
+
+    dispatcher = OutboundDispatcher(queue, {'whatsapp': sender}, on_dead=lambda msg, error: dead.append(msg['id']),
+                                    rates={'whatsapp': 1000})
+    first, second, third = dispatcher.enqueue_parts('whatsapp', PHONE, [_text('parte 1'), _text('parte 2'),
+                                                                         _text('parte 3')])
+    later = dispatcher.enqueue('whatsapp', PHONE, *_text('otro mensaje'))
+
+    for message in queue.claim_due(10):
+        dispatcher.deliver(message)
+    assert sent == ['parte 1']
+    assert dead == [first, second, third]
+
+    # El mensaje siguiente, que no forma parte del grupo, sí se envía
+    for message in queue.claim_due(10):
+        dispatcher.deliver(message)
+    assert sent == ['parte 1', 'otro mensaje']
+
+    # Al reintentar la primera parte vuelve todo el grupo, en orden
+    responses.clear()
+    assert queue.requeue(first)
+    while True:
+        messages = queue.claim_due(10)
+        if not messages:
+            break
+        for message in messages:
+            dispatcher.deliver(message)
+    assert sent[2:] == ['parte 1', 'parte 2', 'parte 3']
+    assert {state['state'] for state in queue.get_states([first, second, third, later]).values()} == {'sent'}
+
+def test_dispatcher_times_the_api_call(queue):
+    def sender(phone_number, payload):
+        time.sleep(0.05)
+        return 200, {'messages': [{'id': 'wamid.1'}]}
+
+    def send_stage():
+        values = REGISTRY.collect().get((EXTERNAL_API_SECONDS.name, ('dispatcher', 'whatsapp')))
+        return (sum(values[:-1]), values[-1]) if values else (0, 0.0)
+
+    dispatcher = OutboundDispatcher(queue, {'whatsapp': sender}, rates={'whatsapp': 1000})
+    count, total = send_stage()
+    dispatcher.enqueue('whatsapp', PHONE, *_text('hola'))
+    for message in queue.claim_due(10):
+        dispatcher.deliver(message)
+    new_count, new_total = send_stage()
+    assert new_count == count + 1
+    assert new_total - total >= 0.05
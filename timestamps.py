@@ -0,0 +1,90 @@
+"""
+Conversión de las marcas de tiempo de los mensajes a un formato común.
+
+Los mensajes guardados mezclan segundos Unix como texto (WhatsApp), enteros
+(SMS de Telnyx) y cadenas ISO 8601 (mensajes enviados desde la aplicación).
+save_message conserva el valor original en 'timestamp' y guarda además el campo
+canónico 'ts_ms' (milisegundos Unix, entero), que es el que se usa para ordenar,
+paginar y filtrar por fechas.
+"""
+
+from datetime import datetime
+
+# A partir de este valor un número se interpreta como milisegundos y no como segundos
+_MILLISECONDS_THRESHOLD = 10 ** 11
+
+def to_epoch_ms(value):
+    """
+    Convierte una marca de tiempo a milisegundos desde la época Unix.
+
+    Args:
+        value (str|int|float): Segundos o milisegundos Unix (número o texto) o fecha ISO 8601
+
+    Returns:
+        int: Milisegundos Unix, o None si el valor no se reconoce
+    """
+    if value is None or isinstance(value, bool):
+        return None
+
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            try:
+                # fromisoformat no acepta el sufijo Z en Python < 3.11
+                dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                return None
+            return int(dt.timestamp() * 1000)
+
+    if isinstance(value, (int, float)):
+        if abs(value) >= _MILLISECONDS_THRESHOLD:
+            return int(value)
+        return int(value * 1000)
+
+    return None
+
+def message_ts_ms(message, default=None):
+    """
+    Milisegundos Unix de un mensaje guardado.
+
+    Usa el campo canónico ts_ms si existe y, en mensajes anteriores a su
+    introducción, convierte la marca de tiempo original.
+
+    Args:
+        message (dict): Mensaje guardado
+        default (int, optional): Valor si la marca de tiempo no se reconoce
+
+    Returns:
+        int: Milisegundos Unix
+    """
+    ts_ms = message.get('ts_ms')
+    if isinstance(ts_ms, int):
+        return ts_ms
+    ts_ms = to_epoch_ms(message.get('timestamp'))
+    return ts_ms if ts_ms is not None else default
+
+def add_ts_ms(messages):
+    """
+    Añade el campo ts_ms a los mensajes que no lo tienen.
+
+    Si una marca de tiempo no se reconoce se usa la del mensaje anterior, para
+    conservar el orden de la conversación.
+
+    Args:
+        messages (list): Mensajes de una conversación, en orden
+
+    Returns:
+        bool: True si se modificó algún mensaje
+    """
+    changed = False
+    previous_ts_ms = 0
+    for message in messages:
+        if not isinstance(message.get('ts_ms'), int):
+            message['ts_ms'] = message_ts_ms(message, default=previous_ts_ms)
+            changed = True
+        previous_ts_ms = message['ts_ms']
+    return changed
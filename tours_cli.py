@@ -0,0 +1,91 @@
+"""
+Herramienta de línea de comandos para importar y exportar el catálogo de tours.
+
+Ejemplos:
+    python tours_cli.py import proveedor.csv --dry-run
+    python tours_cli.py import proveedor.jsonl --format json
+    python tours_cli.py export --format csv -o tours.csv
+"""
+
+import argparse
+import os
+import sys
+
+from tours_db import import_tours, export_tours, iter_tours_from_csv, iter_tours_from_json
+
+def detect_format(path, explicit_format=None):
+    """
+    Determina el formato de un archivo a partir de su extensión.
+
+    Args:
+        path (str): Ruta del archivo
+        explicit_format (str, optional): Formato indicado por el usuario
+
+    Returns:
+        str: 'csv' o 'json'
+    """
+    if explicit_format:
+        return explicit_format
+    extension = os.path.splitext(path)[1].lower()
+    return 'json' if extension in ('.json', '.jsonl', '.ndjson') else 'csv'
+
+def print_report(report):
+    """Muestra el reporte de una importación"""
+    prefix = "[SIMULACIÓN] " if report['dry_run'] else ""
+    for change in report['changes']:
+        if change['action'] == 'update':
+            print(f"{prefix}~ {change['id']}: {', '.join(change['fields'])}")
+        else:
+            print(f"{prefix}+ {change['id'] or '(nuevo ID)'}")
+    for error in report['errors']:
+        print(f"{prefix}! fila {error['row']} ({error['id'] or 'sin ID'}): {'; '.join(error['errors'])}")
+    print(
+        f"{prefix}Nuevos: {report['created']}, actualizados: {report['updated']}, "
+        f"sin cambios: {report['unchanged']}, errores: {len(report['errors'])}"
+    )
+
+def cmd_import(args):
+    """Importa tours desde un archivo CSV o JSON"""
+    import_format = detect_format(args.file, args.format)
+    reader = iter_tours_from_json if import_format == 'json' else iter_tours_from_csv
+
+    with open(args.file, 'r', encoding='utf-8-sig', newline='') as f:
+        report = import_tours(reader(f), dry_run=args.dry_run, batch_size=args.batch_size)
+
+    print_report(report)
+    return 1 if report['errors'] else 0
+
+def cmd_export(args):
+    """Exporta los tours a un archivo o a la salida estándar"""
+    export_format = args.format or (detect_format(args.output) if args.output else 'csv')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            for chunk in export_tours(export_format):
+                f.write(chunk)
+    else:
+        for chunk in export_tours(export_format):
+            sys.stdout.write(chunk)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importación y exportación masiva de tours")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Importar tours desde CSV o JSON")
+    import_parser.add_argument('file', help="Archivo a importar")
+    import_parser.add_argument('--format', choices=['csv', 'json'], help="Formato del archivo (por defecto según la extensión)")
+    import_parser.add_argument('--dry-run', action='store_true', help="Mostrar los cambios sin escribir en la base de datos")
+    import_parser.add_argument('--batch-size', type=int, default=500, help="Filas por transacción")
+    import_parser.set_defaults(func=cmd_import)
+
+    export_parser = subparsers.add_parser('export', help="Exportar tours a CSV o JSON Lines")
+    export_parser.add_argument('--format', choices=['csv', 'json'], help="Formato de salida")
+    export_parser.add_argument('-o', '--output', help="Archivo de salida (por defecto, la salida estándar)")
+    export_parser.set_defaults(func=cmd_export)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,11 @@
 Base de datos de tours y paquetes turísticos usando SQLite.
 """
 
-import sqlite3
 import json
 import os
 
+from db import get_connection, transaction, register_migrations, ensure_schema
+
 # Ruta a la base de datos SQLite
 DB_PATH = os.path.join(os.path.dirname(__file__), 'tours.db')
 
@@ -75,12 +76,19 @@ INITIAL_TOURS = [
 
 def init_db():
     """
-    Inicializa la base de datos y crea las tablas necesarias si no existen.
-    """
-    # Verificar si el archivo de base de datos existe
-    db_exists = os.path.exists(DB_PATH)
+    Inicializa la base de datos aplicando las migraciones pendientes.
+    
+    No es necesario llamarla: el esquema se verifica de forma perezosa la primera
+    vez que el proceso abre una conexión. Se mantiene para inicializar la base de
+    datos explícitamente durante el despliegue (ver migrate.py).
     
-    conn = sqlite3.connect(DB_PATH)
+    Returns:
+        list: Versiones de esquema aplicadas
+    """
+    return ensure_schema(DB_PATH)
+
+def _migration_create_tables(conn):
+    """Crea las tablas de tours y de secuencias si no existen"""
     cursor = conn.cursor()
     
     # Crear tabla de tours si no existe
@@ -99,7 +107,17 @@ def init_db():
     )
     ''')
     
-    # Si la base de datos no existía o la tabla está vacía, cargar los tours iniciales
+    # Crear tabla de secuencias para asignar IDs de forma atómica
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sequences (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''')
+
+def _migration_load_initial_tours(conn):
+    """Carga los tours iniciales si la tabla está vacía"""
+    cursor = conn.cursor()
     cursor.execute('SELECT COUNT(*) FROM tours')
     count = cursor.fetchone()[0]
     
@@ -122,20 +140,15 @@ def init_db():
                 json.dumps(tour['tags'])
             ))
             print(f"Tour añadido: {tour['name']}")
-    
-    conn.commit()
-    conn.close()
-    
-    # Verificar si la inicialización fue exitosa
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM tours')
-    count = cursor.fetchone()[0]
-    print(f"Total de tours en la base de datos: {count}")
-    conn.close()
 
-# Inicializar la base de datos al importar el módulo
-init_db()
+# Migraciones del esquema de tours, en orden de versión
+MIGRATIONS = [
+    (1, "Tablas de tours y secuencias", _migration_create_tables),
+    (2, "Tours iniciales", _migration_load_initial_tours),
+]
+
+# Registrar las migraciones; se aplican al abrir la primera conexión del proceso
+register_migrations(DB_PATH, MIGRATIONS)
 
 def get_all_tours():
     """
@@ -144,9 +157,7 @@ def get_all_tours():
     Returns:
         list: Lista de todos los tours
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection(DB_PATH).cursor()
     
     cursor.execute('SELECT * FROM tours')
     tours_data = cursor.fetchall()
@@ -168,7 +179,6 @@ def get_all_tours():
             'tags': json.loads(tour_dict['tags'])
         })
     
-    conn.close()
     return tours
 
 def search_tours(query):
@@ -182,9 +192,7 @@ def search_tours(query):
         list: Lista de tours que coinciden con la consulta
     """
     query = query.lower()
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection(DB_PATH).cursor()
     
     # Buscar en nombre, descripción y ubicación usando LIKE
     cursor.execute('''
@@ -226,7 +234,6 @@ def search_tours(query):
             if not any(r['id'] == tour_dict['id'] for r in results):
                 results.append(tour_dict)
     
-    conn.close()
     return results
 
 def get_tour_by_id(tour_id):
@@ -239,9 +246,7 @@ def get_tour_by_id(tour_id):
     Returns:
         dict: Tour encontrado o None si no existe
     """
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    cursor = get_connection(DB_PATH).cursor()
     
     cursor.execute('SELECT * FROM tours WHERE id = ?', (tour_id,))
     tour = cursor.fetchone()
@@ -261,10 +266,8 @@ def get_tour_by_id(tour_id):
             'availability': tour_row['availability'],
             'tags': json.loads(tour_row['tags'])
         }
-        conn.close()
         return tour_dict
     
-    conn.close()
     return None
 
 def format_tour_info(tour):
@@ -304,39 +307,29 @@ def add_tour(tour_data):
         bool: True si se añadió correctamente, False en caso contrario
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Generar un nuevo ID si no se proporciona
-        if 'id' not in tour_data or not tour_data['id']:
-            # Obtener el último ID y generar uno nuevo
-            cursor.execute('SELECT id FROM tours ORDER BY id DESC LIMIT 1')
-            last_id = cursor.fetchone()
-            if last_id:
-                # Extraer el número y aumentarlo en 1
-                num = int(last_id[0][1:]) + 1
-                tour_data['id'] = f"T{num:03d}"
-            else:
-                tour_data['id'] = "T001"
-        
-        cursor.execute('''
-        INSERT INTO tours (id, name, description, duration, price, currency, includes, location, availability, tags)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            tour_data['id'],
-            tour_data['name'],
-            tour_data['description'],
-            tour_data['duration'],
-            tour_data['price'],
-            tour_data['currency'],
-            json.dumps(tour_data['includes']),
-            tour_data['location'],
-            tour_data['availability'],
-            json.dumps(tour_data['tags'])
-        ))
+        with transaction(DB_PATH) as conn:
+            cursor = conn.cursor()
+            
+            # Generar un nuevo ID si no se proporciona
+            if 'id' not in tour_data or not tour_data['id']:
+                tour_data['id'] = _allocate_tour_ids(cursor)[0]
+            
+            cursor.execute('''
+            INSERT INTO tours (id, name, description, duration, price, currency, includes, location, availability, tags)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                tour_data['id'],
+                tour_data['name'],
+                tour_data['description'],
+                tour_data['duration'],
+                tour_data['price'],
+                tour_data['currency'],
+                json.dumps(tour_data['includes']),
+                tour_data['location'],
+                tour_data['availability'],
+                json.dumps(tour_data['tags'])
+            ))
         
-        conn.commit()
-        conn.close()
         return True
     except Exception as e:
         print(f"Error al añadir tour: {str(e)}")
@@ -354,36 +347,34 @@ def update_tour(tour_id, tour_data):
         bool: True si se actualizó correctamente, False en caso contrario
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE tours SET 
-            name = ?,
-            description = ?,
-            duration = ?,
-            price = ?,
-            currency = ?,
-            includes = ?,
-            location = ?,
-            availability = ?,
-            tags = ?
-        WHERE id = ?
-        ''', (
-            tour_data['name'],
-            tour_data['description'],
-            tour_data['duration'],
-            tour_data['price'],
-            tour_data['currency'],
-            json.dumps(tour_data['includes']),
-            tour_data['location'],
-            tour_data['availability'],
-            json.dumps(tour_data['tags']),
-            tour_id
-        ))
+        with transaction(DB_PATH) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+            UPDATE tours SET 
+                name = ?,
+                description = ?,
+                duration = ?,
+                price = ?,
+                currency = ?,
+                includes = ?,
+                location = ?,
+                availability = ?,
+                tags = ?
+            WHERE id = ?
+            ''', (
+                tour_data['name'],
+                tour_data['description'],
+                tour_data['duration'],
+                tour_data['price'],
+                tour_data['currency'],
+                json.dumps(tour_data['includes']),
+                tour_data['location'],
+                tour_data['availability'],
+                json.dumps(tour_data['tags']),
+                tour_id
+            ))
         
-        conn.commit()
-        conn.close()
         return cursor.rowcount > 0
     except Exception as e:
         print(f"Error al actualizar tour: {str(e)}")
@@ -400,14 +391,355 @@ def delete_tour(tour_id):
         bool: True si se eliminó correctamente, False en caso contrario
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with transaction(DB_PATH) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM tours WHERE id = ?', (tour_id,))
         
-        cursor.execute('DELETE FROM tours WHERE id = ?', (tour_id,))
-        
-        conn.commit()
-        conn.close()
         return cursor.rowcount > 0
     except Exception as e:
         print(f"Error al eliminar tour: {str(e)}")
         return False
+
+# Importación y exportación masiva del catálogo
+
+# Columnas de la tabla de tours en el orden usado para importar y exportar
+TOUR_FIELDS = ['id', 'name', 'description', 'duration', 'price', 'currency',
+               'includes', 'location', 'availability', 'tags']
+
+# Campos de texto obligatorios en cada fila importada
+REQUIRED_TEXT_FIELDS = ['name', 'description', 'duration', 'currency', 'location', 'availability']
+
+# Número de filas que se escriben en cada transacción durante una importación
+IMPORT_BATCH_SIZE = 500
+
+# Separador de las listas (includes, tags) dentro de una celda CSV
+CSV_LIST_SEPARATOR = '|'
+
+def _parse_list_field(value):
+    """
+    Convierte el valor de un campo de lista (includes, tags) a una lista de cadenas.
+    
+    Acepta listas, arreglos JSON en texto o cadenas separadas por '|' (o por comas
+    si no aparece el separador principal).
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    
+    value = str(value).strip()
+    if not value:
+        return []
+    if value.startswith('['):
+        try:
+            return _parse_list_field(json.loads(value))
+        except json.JSONDecodeError:
+            pass
+    
+    separator = CSV_LIST_SEPARATOR if CSV_LIST_SEPARATOR in value else ','
+    return [item.strip() for item in value.split(separator) if item.strip()]
+
+def validate_tour(raw_tour):
+    """
+    Normaliza y valida una fila de tour procedente de una importación.
+    
+    Args:
+        raw_tour (dict): Fila leída del archivo (CSV o JSON)
+        
+    Returns:
+        tuple: (tour, errores) donde tour es el diccionario normalizado o None
+    """
+    errors = []
+    tour = {}
+    
+    tour_id = str(raw_tour.get('id') or '').strip()
+    tour['id'] = tour_id.upper() if tour_id else None
+    
+    for field in REQUIRED_TEXT_FIELDS:
+        value = str(raw_tour.get(field) or '').strip()
+        if not value:
+            errors.append(f"El campo '{field}' es obligatorio")
+        tour[field] = value
+    
+    try:
+        tour['price'] = float(raw_tour.get('price'))
+        if tour['price'] < 0:
+            errors.append("El precio no puede ser negativo")
+    except (TypeError, ValueError):
+        errors.append(f"Precio inválido: {raw_tour.get('price')!r}")
+    
+    tour['includes'] = _parse_list_field(raw_tour.get('includes'))
+    tour['tags'] = _parse_list_field(raw_tour.get('tags'))
+    
+    if errors:
+        return None, errors
+    return tour, []
+
+def iter_tours_from_csv(stream):
+    """
+    Lee tours de un archivo CSV fila por fila.
+    
+    Args:
+        stream: Archivo de texto abierto con cabecera de columnas
+        
+    Yields:
+        dict: Fila leída del archivo
+    """
+    import csv
+    for row in csv.DictReader(stream):
+        yield row
+
+def iter_tours_from_json(stream):
+    """
+    Lee tours de un archivo JSON (arreglo de objetos) o JSON Lines (un objeto por línea).
+    
+    Args:
+        stream: Archivo de texto abierto
+        
+    Yields:
+        dict: Tour leído del archivo
+    """
+    first_line = stream.readline()
+    while first_line and not first_line.strip():
+        first_line = stream.readline()
+    
+    if first_line.lstrip().startswith('['):
+        # Arreglo JSON: debe cargarse completo
+        for tour in json.loads(first_line + stream.read()):
+            yield tour
+        return
+    
+    # JSON Lines: procesar línea a línea sin cargar el archivo completo
+    line = first_line
+    while line:
+        if line.strip():
+            yield json.loads(line)
+        line = stream.readline()
+
+def _tour_to_params(tour):
+    """Convierte un tour a la tupla de parámetros de la tabla en el orden de TOUR_FIELDS"""
+    return (
+        tour['id'],
+        tour['name'],
+        tour['description'],
+        tour['duration'],
+        tour['price'],
+        tour['currency'],
+        json.dumps(tour['includes']),
+        tour['location'],
+        tour['availability'],
+        json.dumps(tour['tags'])
+    )
+
+def _row_to_tour(row):
+    """Convierte una fila de la tabla (sqlite3.Row) a un diccionario de tour"""
+    tour = dict(row)
+    tour['includes'] = json.loads(tour['includes'])
+    tour['tags'] = json.loads(tour['tags'])
+    return tour
+
+def _format_tour_id(num):
+    """Formatea el número de secuencia de un tour como ID visible (T001, T002, ...)"""
+    return f"T{num:03d}"
+
+def _tour_id_number(tour_id):
+    """Devuelve el número de un ID con formato T###, o None si el ID no sigue ese formato"""
+    if tour_id and tour_id[0] == 'T' and tour_id[1:].isdigit():
+        return int(tour_id[1:])
+    return None
+
+def _allocate_tour_ids(cursor, count=1):
+    """
+    Reserva uno o varios números de la secuencia de tours.
+    
+    El UPDATE toma el bloqueo de escritura de la base de datos, por lo que la
+    reserva es atómica y forma parte de la misma transacción que el INSERT:
+    dos procesos nunca obtienen el mismo número y, si la transacción se revierte,
+    la reserva también se revierte.
+    
+    Args:
+        cursor (sqlite3.Cursor): Cursor de la transacción en curso
+        count (int, optional): Cantidad de IDs a reservar
+        
+    Returns:
+        list: IDs formateados reservados, en orden
+    """
+    # Inicializar la secuencia a partir del mayor ID numérico existente (solo la primera vez)
+    cursor.execute('''
+    INSERT OR IGNORE INTO sequences (name, value)
+    SELECT 'tours', COALESCE(MAX(CAST(SUBSTR(id, 2) AS INTEGER)), 0)
+    FROM tours WHERE id GLOB 'T[0-9]*'
+    ''')
+    cursor.execute("UPDATE sequences SET value = value + ? WHERE name = 'tours'", (count,))
+    cursor.execute("SELECT value FROM sequences WHERE name = 'tours'")
+    last = cursor.fetchone()[0]
+    return [_format_tour_id(num) for num in range(last - count + 1, last + 1)]
+
+def _advance_tour_sequence(cursor, tour_ids):
+    """Avanza la secuencia para que no reasigne IDs escritos explícitamente (importaciones)"""
+    numbers = [num for num in (_tour_id_number(tour_id) for tour_id in tour_ids) if num is not None]
+    if not numbers:
+        return
+    _allocate_tour_ids(cursor, 0)
+    cursor.execute(
+        "UPDATE sequences SET value = MAX(value, ?) WHERE name = 'tours'",
+        (max(numbers),)
+    )
+
+def _apply_import_batch(conn, batch, report, dry_run):
+    """
+    Compara un lote de tours con la base de datos y aplica el upsert en una transacción.
+    
+    Args:
+        conn (sqlite3.Connection): Conexión abierta
+        batch (list): Tours validados del lote
+        report (dict): Reporte acumulado de la importación
+        dry_run (bool): Si es True, solo calcula las diferencias
+    """
+    cursor = conn.cursor()
+    
+    # Cargar de una sola vez los tours existentes del lote
+    ids = [tour['id'] for tour in batch if tour['id']]
+    existing = {}
+    if ids:
+        placeholders = ', '.join('?' for _ in ids)
+        cursor.execute(f'SELECT * FROM tours WHERE id IN ({placeholders})', ids)
+        existing = {row['id']: _row_to_tour(row) for row in cursor.fetchall()}
+    
+    to_write = []
+    without_id = []
+    for tour in batch:
+        current = existing.get(tour['id'])
+        
+        if current is None:
+            report['created'] += 1
+            if tour['id']:
+                report['changes'].append({'id': tour['id'], 'action': 'create'})
+                to_write.append(tour)
+            else:
+                without_id.append(tour)
+            continue
+        
+        changed_fields = [field for field in TOUR_FIELDS if current[field] != tour[field]]
+        if changed_fields:
+            report['updated'] += 1
+            report['changes'].append({'id': tour['id'], 'action': 'update', 'fields': changed_fields})
+            to_write.append(tour)
+        else:
+            report['unchanged'] += 1
+    
+    if dry_run:
+        report['changes'].extend({'id': None, 'action': 'create'} for _ in without_id)
+        return
+    
+    update_columns = ', '.join(f"{field} = excluded.{field}" for field in TOUR_FIELDS if field != 'id')
+    upsert_sql = f'''
+    INSERT INTO tours ({', '.join(TOUR_FIELDS)})
+    VALUES ({', '.join('?' for _ in TOUR_FIELDS)})
+    ON CONFLICT(id) DO UPDATE SET {update_columns}
+    '''
+    cursor.executemany(upsert_sql, [_tour_to_params(tour) for tour in to_write])
+    _advance_tour_sequence(cursor, [tour['id'] for tour in to_write])
+    
+    # Asignar IDs de la secuencia a las filas que no lo traían, en la misma transacción
+    if without_id:
+        for tour, tour_id in zip(without_id, _allocate_tour_ids(cursor, len(without_id))):
+            tour['id'] = tour_id
+            report['changes'].append({'id': tour_id, 'action': 'create'})
+        cursor.executemany(upsert_sql, [_tour_to_params(tour) for tour in without_id])
+    
+    conn.commit()
+
+def import_tours(rows, dry_run=False, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Importa tours en lotes con semántica de upsert sobre el ID.
+    
+    Las filas con un ID existente actualizan el tour, las filas con un ID nuevo
+    (o sin ID) lo crean. Cada lote se escribe en una sola transacción.
+    
+    Args:
+        rows (iterable): Filas a importar (diccionarios)
+        dry_run (bool, optional): Si es True, solo calcula las diferencias sin escribir
+        batch_size (int, optional): Número de filas por transacción
+        
+    Returns:
+        dict: Reporte con los contadores created, updated, unchanged, la lista
+        de cambios y los errores de validación por fila
+    """
+    report = {
+        'dry_run': dry_run,
+        'created': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'changes': [],
+        'errors': []
+    }
+    
+    conn = get_connection(DB_PATH)
+    
+    try:
+        batch = []
+        seen_ids = set()
+        for row_number, raw_tour in enumerate(rows, start=1):
+            tour, errors = validate_tour(raw_tour)
+            if tour and tour['id']:
+                if tour['id'] in seen_ids:
+                    errors = [f"ID duplicado en el archivo: {tour['id']}"]
+                seen_ids.add(tour['id'])
+            
+            if errors:
+                report['errors'].append({'row': row_number, 'id': raw_tour.get('id'), 'errors': errors})
+                continue
+            
+            batch.append(tour)
+            if len(batch) >= batch_size:
+                _apply_import_batch(conn, batch, report, dry_run)
+                batch = []
+        
+        if batch:
+            _apply_import_batch(conn, batch, report, dry_run)
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return report
+
+def export_tours(export_format='csv'):
+    """
+    Exporta todos los tours fila por fila.
+    
+    Args:
+        export_format (str, optional): 'csv' o 'json' (JSON Lines)
+        
+    Yields:
+        str: Fragmentos de texto del archivo exportado
+    """
+    import csv
+    import io
+    
+    # Cursor propio: la exportación puede intercalarse con otras consultas del mismo hilo
+    cursor = get_connection(DB_PATH).cursor()
+    try:
+        # Ordenar por longitud y luego por texto para que T1000 quede después de T999
+        cursor.execute(f"SELECT {', '.join(TOUR_FIELDS)} FROM tours ORDER BY LENGTH(id), id")
+        
+        if export_format == 'json':
+            for row in cursor:
+                yield json.dumps(_row_to_tour(row), ensure_ascii=False) + '\n'
+            return
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(TOUR_FIELDS)
+        for row in cursor:
+            tour = _row_to_tour(row)
+            tour['includes'] = CSV_LIST_SEPARATOR.join(tour['includes'])
+            tour['tags'] = CSV_LIST_SEPARATOR.join(tour['tags'])
+            writer.writerow([tour[field] for field in TOUR_FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+        if buffer.getvalue():
+            yield buffer.getvalue()
+    finally:
+        cursor.close()
@@ -2,21 +2,241 @@
 Módulo para gestionar usuarios y autenticación.
 """
 
-import sqlite3
 import os
 import hashlib
 import secrets
 import json
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as HashTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 
+from db import get_connection, transaction, register_migrations, ensure_schema
+from metrics import CACHE_REQUESTS
+
 # Ruta a la base de datos SQLite
 DB_PATH = os.path.join(os.path.dirname(__file__), 'users.db')
 
+# Segundos que una sesión verificada permanece en la caché del proceso
+SESSION_CACHE_TTL = int(os.getenv('SESSION_CACHE_TTL', '30'))
+
+# Número máximo de sesiones en la caché (se descartan las menos usadas)
+SESSION_CACHE_MAX_SIZE = int(os.getenv('SESSION_CACHE_MAX_SIZE', '1024'))
+
+# Intervalo (en segundos) entre dos pasadas del barrido de sesiones expiradas
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', '300'))
+
+# Sesiones expiradas eliminadas por transacción durante el barrido
+SESSION_SWEEP_BATCH_SIZE = 500
+
+# Máximo de sesiones simultáneas por usuario (se eliminan las usadas hace más tiempo)
+MAX_SESSIONS_PER_USER = int(os.getenv('MAX_SESSIONS_PER_USER', '5'))
+
+class SessionCache:
+    """
+    Caché LRU acotada de sesiones verificadas, con expiración por entrada.
+    
+    Evita consultar la base de datos en cada petición autenticada. Las entradas
+    caducan tras SESSION_CACHE_TTL segundos (o antes, si la sesión expira) y se
+    invalidan explícitamente al cerrar sesión o modificar el usuario.
+    """
+    
+    def __init__(self, max_size=SESSION_CACHE_MAX_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token -> (expira_en, datos de sesión)
+        self._lock = threading.Lock()
+    
+    def get(self, session_token):
+        """Devuelve una copia de los datos de la sesión o None si no está o caducó"""
+        with self._lock:
+            entry = self._entries.get(session_token)
+            if entry is None:
+                CACHE_REQUESTS.inc('session', 'miss')
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[session_token]
+                CACHE_REQUESTS.inc('session', 'miss')
+                return None
+            self._entries.move_to_end(session_token)
+            CACHE_REQUESTS.inc('session', 'hit')
+            return dict(entry[1])
+    
+    def put(self, session_token, session_data, session_expires_at):
+        """
+        Guarda una sesión verificada.
+        
+        Args:
+            session_token (str): Token de sesión
+            session_data (dict): Datos devueltos por verify_session
+            session_expires_at (datetime): Expiración de la sesión en la base de datos
+        """
+        remaining = (session_expires_at - datetime.now()).total_seconds()
+        ttl = min(self.ttl, remaining)
+        if ttl <= 0:
+            return
+        
+        with self._lock:
+            self._entries[session_token] = (time.monotonic() + ttl, dict(session_data))
+            self._entries.move_to_end(session_token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, session_token):
+        """Elimina una sesión de la caché"""
+        with self._lock:
+            self._entries.pop(session_token, None)
+    
+    def invalidate_user(self, user_id):
+        """Elimina todas las sesiones de un usuario de la caché"""
+        user_id = int(user_id)
+        with self._lock:
+            tokens = [token for token, (_, data) in self._entries.items() if data['id'] == user_id]
+            for token in tokens:
+                del self._entries[token]
+    
+    def clear(self):
+        """Vacía la caché"""
+        with self._lock:
+            self._entries.clear()
+
+# Caché de sesiones compartida por todos los hilos del proceso
+session_cache = SessionCache()
+
+# Procesos dedicados a calcular hashes de contraseñas (0 = calcular en el hilo de la petición)
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+
+# Máximo de hashes en curso o en espera; por encima se rechaza la petición
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', '8'))
+
+# Segundos máximos de espera por un hash
+PASSWORD_HASH_TIMEOUT = 10
+
+# Límites de intentos de inicio de sesión: (intentos, ventana en segundos)
+LOGIN_LIMIT_PER_IP = (int(os.getenv('LOGIN_MAX_ATTEMPTS_PER_IP', '20')), 300)
+LOGIN_LIMIT_PER_USERNAME = (int(os.getenv('LOGIN_MAX_FAILURES_PER_USERNAME', '5')), 900)
+
+class PasswordHasherBusy(Exception):
+    """Se alcanzó el límite de hashes de contraseñas en curso"""
+
+def _pbkdf2(password, salt):
+    """Calcula PBKDF2-SHA256 con 100,000 iteraciones (se ejecuta en el pool de procesos)"""
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        password.encode('utf-8'),
+        salt.encode('utf-8'),
+        100000
+    ).hex()
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(max(PASSWORD_HASH_QUEUE_LIMIT, 1))
+
+def _get_hash_pool():
+    """Obtiene el pool de procesos para hashes, creándolo en el primer uso"""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS)
+        return _hash_pool
+
+def _reset_hash_pool():
+    """Descarta un pool de procesos que dejó de funcionar"""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown(wait=False)
+        _hash_pool = None
+
+class LoginThrottle:
+    """
+    Limita los intentos de inicio de sesión por IP y por nombre de usuario.
+    
+    Se consulta antes de calcular ningún hash, de modo que un ataque de fuerza
+    bruta o de relleno de credenciales se rechaza sin consumir CPU. Por IP se
+    cuentan todos los intentos; por usuario, solo los fallidos.
+    """
+    
+    # Número de claves a partir del cual se descartan las inactivas
+    MAX_TRACKED_KEYS = 10000
+    
+    def __init__(self, ip_limit=LOGIN_LIMIT_PER_IP, username_limit=LOGIN_LIMIT_PER_USERNAME):
+        self.ip_limit = ip_limit
+        self.username_limit = username_limit
+        self._attempts_by_ip = defaultdict(deque)
+        self._failures_by_username = defaultdict(deque)
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _retry_after(timestamps, limit, now):
+        """Descarta intentos fuera de la ventana y devuelve los segundos de espera (0 si no hay bloqueo)"""
+        max_attempts, window = limit
+        while timestamps and timestamps[0] <= now - window:
+            timestamps.popleft()
+        if len(timestamps) >= max_attempts:
+            return int(timestamps[0] + window - now) + 1
+        return 0
+    
+    def check(self, username, ip_address):
+        """
+        Verifica si se permite un nuevo intento y lo registra para la IP.
+        
+        Returns:
+            int: 0 si se permite, o los segundos que faltan para poder reintentar
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(self._attempts_by_ip) + len(self._failures_by_username) > self.MAX_TRACKED_KEYS:
+                self._prune(now)
+            retry_after = max(
+                self._retry_after(self._attempts_by_ip[ip_address], self.ip_limit, now),
+                self._retry_after(self._failures_by_username[username], self.username_limit, now)
+            )
+            if retry_after:
+                return retry_after
+            self._attempts_by_ip[ip_address].append(now)
+            return 0
+    
+    def record_result(self, username, success):
+        """Registra el resultado de un intento para el nombre de usuario"""
+        with self._lock:
+            if success:
+                self._failures_by_username.pop(username, None)
+            else:
+                self._failures_by_username[username].append(time.monotonic())
+    
+    def _prune(self, now):
+        """Elimina las claves sin intentos recientes para acotar la memoria"""
+        for counters, limit in ((self._attempts_by_ip, self.ip_limit),
+                                (self._failures_by_username, self.username_limit)):
+            for key in [key for key, timestamps in counters.items()
+                        if not timestamps or timestamps[-1] <= now - limit[1]]:
+                del counters[key]
+
+# Limitador de intentos de inicio de sesión del proceso
+login_throttle = LoginThrottle()
+
+# Hilo de barrido de sesiones expiradas (uno por proceso)
+_session_sweeper = None
+_session_sweeper_lock = threading.Lock()
+
 def init_db():
     """
-    Inicializa la base de datos de usuarios y crea las tablas necesarias si no existen.
+    Inicializa la base de datos de usuarios aplicando las migraciones pendientes.
+    
+    No es necesario llamarla: el esquema se verifica de forma perezosa la primera
+    vez que el proceso abre una conexión. Se mantiene para inicializar la base de
+    datos explícitamente durante el despliegue (ver migrate.py).
+    
+    Returns:
+        list: Versiones de esquema aplicadas
     """
-    conn = sqlite3.connect(DB_PATH)
+    return ensure_schema(DB_PATH)
+
+def _migration_create_tables(conn):
+    """Crea las tablas de usuarios y sesiones si no existen"""
     cursor = conn.cursor()
     
     # Crear tabla de usuarios si no existe
@@ -47,6 +267,10 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users (id)
     )
     ''')
+
+def _migration_default_admin(conn):
+    """Crea un usuario administrador por defecto si no existe ninguno"""
+    cursor = conn.cursor()
     
     # Verificar si hay algún usuario administrador
     cursor.execute('SELECT COUNT(*) FROM users WHERE role = "admin"')
@@ -54,42 +278,78 @@ def init_db():
     
     # Si no hay usuarios administradores, crear uno por defecto
     if count == 0:
-        # Crear un usuario administrador por defecto
-        create_user(
-            username="admin",
-            password="admin123",  # Esta contraseña debe cambiarse después del primer inicio de sesión
-            email="admin@example.com",
-            role="admin"
-        )
+        # Esta contraseña debe cambiarse después del primer inicio de sesión.
+        # Se calcula en el propio proceso: la migración tiene abierta una
+        # transacción de escritura y no debe crear el pool de procesos con ella
+        salt = secrets.token_hex(16)
+        password_hash = _pbkdf2("admin123", salt)
+        cursor.execute('''
+        INSERT INTO users (username, password_hash, salt, email, role, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', ("admin", password_hash, salt, "admin@example.com", "admin", datetime.now().isoformat()))
         print("Usuario administrador creado con éxito.")
         print("Usuario: admin")
         print("Contraseña: admin123")
         print("¡IMPORTANTE! Cambie esta contraseña después del primer inicio de sesión.")
-    
-    conn.commit()
-    conn.close()
+
+def _migration_session_indexes(conn):
+    """Añade la última fecha de uso de cada sesión y los índices de sesiones"""
+    cursor = conn.cursor()
+    cursor.execute('ALTER TABLE sessions ADD COLUMN last_used_at TEXT')
+    cursor.execute('UPDATE sessions SET last_used_at = created_at')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_last_used ON sessions (user_id, last_used_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)')
+
+# Migraciones del esquema de usuarios, en orden de versión
+MIGRATIONS = [
+    (1, "Tablas de usuarios y sesiones", _migration_create_tables),
+    (2, "Administrador por defecto", _migration_default_admin),
+    (3, "Índices de sesiones y última fecha de uso", _migration_session_indexes),
+]
+
+# Registrar las migraciones; se aplican al abrir la primera conexión del proceso
+register_migrations(DB_PATH, MIGRATIONS)
 
 def hash_password(password, salt=None):
     """
     Genera un hash seguro para la contraseña utilizando PBKDF2.
     
+    El cálculo se delega a un pool de procesos acotado para no ocupar los hilos
+    que atienden el webhook. Si el pool está saturado se lanza PasswordHasherBusy.
+    
     Args:
         password (str): Contraseña a hashear
         salt (str, optional): Salt para el hash. Si no se proporciona, se genera uno nuevo.
         
     Returns:
         tuple: (password_hash, salt)
+        
+    Raises:
+        PasswordHasherBusy: Si se alcanzó PASSWORD_HASH_QUEUE_LIMIT o el hash no
+            terminó en PASSWORD_HASH_TIMEOUT segundos
     """
     if salt is None:
         salt = secrets.token_hex(16)
     
-    # Usar PBKDF2 con SHA-256, 100,000 iteraciones
-    key = hashlib.pbkdf2_hmac(
-        'sha256',
-        password.encode('utf-8'),
-        salt.encode('utf-8'),
-        100000
-    ).hex()
+    if PASSWORD_HASH_WORKERS <= 0:
+        return _pbkdf2(password, salt), salt
+    
+    # Rechazar de inmediato si ya hay demasiados hashes en curso, en lugar de
+    # acumular hilos de Flask esperando
+    if not _hash_slots.acquire(blocking=False):
+        raise PasswordHasherBusy("Demasiadas verificaciones de contraseña en curso")
+    
+    try:
+        # Usar PBKDF2 con SHA-256, 100,000 iteraciones, en un proceso dedicado
+        try:
+            key = _get_hash_pool().submit(_pbkdf2, password, salt).result(timeout=PASSWORD_HASH_TIMEOUT)
+        except BrokenProcessPool:
+            _reset_hash_pool()
+            key = _pbkdf2(password, salt)
+        except HashTimeoutError:
+            raise PasswordHasherBusy("El cálculo del hash de la contraseña tardó demasiado")
+    finally:
+        _hash_slots.release()
     
     return key, salt
 
@@ -105,32 +365,35 @@ def create_user(username, password, email, role="user"):
         
     Returns:
         int: ID del usuario creado o None si hubo un error
+        
+    Raises:
+        PasswordHasherBusy: Si el pool de hashes está saturado
     """
     try:
         # Generar hash y salt para la contraseña
         password_hash, salt = hash_password(password)
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Insertar el nuevo usuario
-        cursor.execute('''
-        INSERT INTO users (username, password_hash, salt, email, role, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            username,
-            password_hash,
-            salt,
-            email,
-            role,
-            datetime.now().isoformat()
-        ))
-        
-        user_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        with transaction(DB_PATH) as conn:
+            cursor = conn.cursor()
+            
+            # Insertar el nuevo usuario
+            cursor.execute('''
+            INSERT INTO users (username, password_hash, salt, email, role, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (
+                username,
+                password_hash,
+                salt,
+                email,
+                role,
+                datetime.now().isoformat()
+            ))
+            
+            user_id = cursor.lastrowid
         
         return user_id
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         print(f"Error al crear usuario: {str(e)}")
         return None
@@ -145,11 +408,12 @@ def verify_user(username, password):
         
     Returns:
         dict: Datos del usuario si las credenciales son correctas, None en caso contrario
+        
+    Raises:
+        PasswordHasherBusy: Si el pool de hashes está saturado
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = get_connection(DB_PATH).cursor()
         
         # Buscar el usuario por nombre de usuario
         cursor.execute('SELECT * FROM users WHERE username = ? AND is_active = 1', (username,))
@@ -164,21 +428,21 @@ def verify_user(username, password):
             
             if password_hash == user_dict['password_hash']:
                 # Actualizar último inicio de sesión
-                cursor.execute(
-                    'UPDATE users SET last_login = ? WHERE id = ?',
-                    (datetime.now().isoformat(), user_dict['id'])
-                )
-                conn.commit()
+                with transaction(DB_PATH) as conn:
+                    conn.execute(
+                        'UPDATE users SET last_login = ? WHERE id = ?',
+                        (datetime.now().isoformat(), user_dict['id'])
+                    )
                 
                 # Eliminar campos sensibles
                 user_dict.pop('password_hash', None)
                 user_dict.pop('salt', None)
                 
-                conn.close()
                 return user_dict
         
-        conn.close()
         return None
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         print(f"Error al verificar usuario: {str(e)}")
         return None
@@ -199,28 +463,37 @@ def create_session(user_id, ip_address=None, user_agent=None):
         # Generar token de sesión
         session_token = secrets.token_hex(32)
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         # Establecer fechas de creación y expiración
         created_at = datetime.now()
         expires_at = created_at + timedelta(days=1)  # La sesión expira en 1 día
         
-        # Insertar la nueva sesión
-        cursor.execute('''
-        INSERT INTO sessions (user_id, session_token, created_at, expires_at, ip_address, user_agent)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            session_token,
-            created_at.isoformat(),
-            expires_at.isoformat(),
-            ip_address,
-            user_agent
-        ))
-        
-        conn.commit()
-        conn.close()
+        with transaction(DB_PATH) as conn:
+            # Insertar la nueva sesión
+            conn.execute('''
+            INSERT INTO sessions (user_id, session_token, created_at, expires_at, ip_address, user_agent, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                user_id,
+                session_token,
+                created_at.isoformat(),
+                expires_at.isoformat(),
+                ip_address,
+                user_agent,
+                created_at.isoformat()
+            ))
+            
+            # Respetar el máximo de sesiones por usuario eliminando las usadas hace más tiempo
+            evicted = conn.execute('''
+            SELECT id, session_token FROM sessions
+            WHERE user_id = ?
+            ORDER BY last_used_at DESC
+            LIMIT -1 OFFSET ?
+            ''', (user_id, MAX_SESSIONS_PER_USER)).fetchall()
+            if evicted:
+                conn.executemany('DELETE FROM sessions WHERE id = ?', [(row['id'],) for row in evicted])
+        
+        for row in evicted:
+            session_cache.invalidate(row['session_token'])
         
         return session_token
     except Exception as e:
@@ -238,13 +511,19 @@ def verify_session(session_token):
         dict: Datos del usuario si la sesión es válida, None en caso contrario
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        # Consultar primero la caché del proceso
+        session_data = session_cache.get(session_token)
+        if session_data is not None:
+            return session_data
         
-        # Buscar la sesión
+        cursor = get_connection(DB_PATH).cursor()
+        
+        # Buscar la sesión (columnas explícitas para que 'id' sea el del usuario)
         cursor.execute('''
-        SELECT s.*, u.* FROM sessions s
+        SELECT u.id, u.username, u.email, u.role, u.created_at, u.last_login, u.is_active,
+               s.user_id, s.session_token, s.created_at AS session_created_at,
+               s.expires_at, s.ip_address, s.user_agent
+        FROM sessions s
         JOIN users u ON s.user_id = u.id
         WHERE s.session_token = ? AND u.is_active = 1
         ''', (session_token,))
@@ -255,27 +534,79 @@ def verify_session(session_token):
             # Convertir a diccionario
             session_data = dict(result)
             
-            # Verificar si la sesión ha expirado
+            # Verificar si la sesión ha expirado (las expiradas se eliminan en el barrido periódico)
             expires_at = datetime.fromisoformat(session_data['expires_at'])
             
             if expires_at > datetime.now():
-                # Eliminar campos sensibles
-                session_data.pop('password_hash', None)
-                session_data.pop('salt', None)
-                
-                conn.close()
+                # Registrar el uso (como mucho una vez por TTL de la caché) para el desalojo LRU
+                with transaction(DB_PATH) as conn:
+                    conn.execute(
+                        'UPDATE sessions SET last_used_at = ? WHERE session_token = ?',
+                        (datetime.now().isoformat(), session_token)
+                    )
+                session_cache.put(session_token, session_data, expires_at)
                 return session_data
-            else:
-                # La sesión ha expirado, eliminarla
-                cursor.execute('DELETE FROM sessions WHERE session_token = ?', (session_token,))
-                conn.commit()
         
-        conn.close()
         return None
     except Exception as e:
         print(f"Error al verificar sesión: {str(e)}")
         return None
 
+def purge_expired_sessions(batch_size=SESSION_SWEEP_BATCH_SIZE):
+    """
+    Elimina las sesiones expiradas en lotes, cada uno en su propia transacción.
+    
+    Usar lotes pequeños evita mantener el bloqueo de escritura mientras se
+    borran miles de filas, de modo que los inicios de sesión no esperan.
+    
+    Args:
+        batch_size (int, optional): Sesiones eliminadas por transacción
+        
+    Returns:
+        int: Número de sesiones eliminadas
+    """
+    total = 0
+    try:
+        now = datetime.now().isoformat()
+        while True:
+            with transaction(DB_PATH) as conn:
+                cursor = conn.execute('''
+                DELETE FROM sessions WHERE id IN (
+                    SELECT id FROM sessions WHERE expires_at <= ? LIMIT ?
+                )
+                ''', (now, batch_size))
+            total += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return total
+    except Exception as e:
+        print(f"Error al purgar sesiones expiradas: {str(e)}")
+        return total
+
+def _sweep_sessions_forever(interval):
+    """Bucle del hilo de barrido de sesiones expiradas"""
+    while True:
+        time.sleep(interval)
+        purge_expired_sessions()
+
+def start_session_sweeper(interval=SESSION_SWEEP_INTERVAL):
+    """
+    Inicia (una sola vez por proceso) el hilo que elimina periódicamente las sesiones expiradas.
+    
+    Args:
+        interval (int, optional): Segundos entre dos pasadas
+    """
+    global _session_sweeper
+    with _session_sweeper_lock:
+        if _session_sweeper is not None and _session_sweeper.is_alive():
+            return
+        _session_sweeper = threading.Thread(
+            target=_sweep_sessions_forever,
+            args=(interval,),
+            name='session-sweeper',
+            daemon=True
+        )
+        _session_sweeper.start()
+
 def invalidate_session(session_token):
     """
     Invalida una sesión (logout).
@@ -287,15 +618,11 @@ def invalidate_session(session_token):
         bool: True si se invalidó correctamente, False en caso contrario
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Eliminar la sesión
-        cursor.execute('DELETE FROM sessions WHERE session_token = ?', (session_token,))
-        
-        conn.commit()
-        conn.close()
+        with transaction(DB_PATH) as conn:
+            # Eliminar la sesión
+            conn.execute('DELETE FROM sessions WHERE session_token = ?', (session_token,))
         
+        session_cache.invalidate(session_token)
         return True
     except Exception as e:
         print(f"Error al invalidar sesión: {str(e)}")
@@ -312,11 +639,12 @@ def change_password(user_id, current_password, new_password):
         
     Returns:
         bool: True si se cambió correctamente, False en caso contrario
+        
+    Raises:
+        PasswordHasherBusy: Si el pool de hashes está saturado
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = get_connection(DB_PATH).cursor()
         
         # Buscar el usuario
         cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
@@ -333,22 +661,22 @@ def change_password(user_id, current_password, new_password):
                 # Generar nuevo hash y salt para la nueva contraseña
                 new_hash, new_salt = hash_password(new_password)
                 
-                # Actualizar la contraseña
-                cursor.execute(
-                    'UPDATE users SET password_hash = ?, salt = ? WHERE id = ?',
-                    (new_hash, new_salt, user_id)
-                )
-                
-                # Invalidar todas las sesiones existentes
-                cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-                
-                conn.commit()
-                conn.close()
+                with transaction(DB_PATH) as conn:
+                    # Actualizar la contraseña
+                    conn.execute(
+                        'UPDATE users SET password_hash = ?, salt = ? WHERE id = ?',
+                        (new_hash, new_salt, user_id)
+                    )
+                    
+                    # Invalidar todas las sesiones existentes
+                    conn.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
                 
+                session_cache.invalidate_user(user_id)
                 return True
         
-        conn.close()
         return False
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         print(f"Error al cambiar contraseña: {str(e)}")
         return False
@@ -361,9 +689,7 @@ def get_all_users():
         list: Lista de usuarios
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = get_connection(DB_PATH).cursor()
         
         cursor.execute('SELECT id, username, email, role, created_at, last_login, is_active FROM users')
         users_data = cursor.fetchall()
@@ -372,7 +698,6 @@ def get_all_users():
         for user in users_data:
             users.append(dict(user))
         
-        conn.close()
         return users
     except Exception as e:
         print(f"Error al obtener usuarios: {str(e)}")
@@ -389,15 +714,11 @@ def get_user_by_id(user_id):
         dict: Datos del usuario o None si no existe
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        cursor = get_connection(DB_PATH).cursor()
         
         cursor.execute('SELECT id, username, email, role, created_at, last_login, is_active FROM users WHERE id = ?', (user_id,))
         user = cursor.fetchone()
         
-        conn.close()
-        
         if user:
             return dict(user)
         return None
@@ -452,16 +773,13 @@ def update_user(user_id, username=None, email=None, role=None, is_active=None):
         # Añadir el ID del usuario a los parámetros
         params.append(user_id)
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Ejecutar la consulta
-        query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ?"
-        cursor.execute(query, params)
-        
-        conn.commit()
-        conn.close()
+        with transaction(DB_PATH) as conn:
+            # Ejecutar la consulta
+            query = f"UPDATE users SET {', '.join(update_fields)} WHERE id = ?"
+            conn.execute(query, params)
         
+        # Los datos en caché (rol, estado) ya no son válidos
+        session_cache.invalidate_user(user_id)
         return True
     except Exception as e:
         print(f"Error al actualizar usuario: {str(e)}")
@@ -479,33 +797,27 @@ def delete_user(user_id):
     """
     try:
         # No permitir eliminar el último administrador
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Verificar si es el último administrador
-        cursor.execute('SELECT COUNT(*) FROM users WHERE role = "admin"')
-        admin_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT role FROM users WHERE id = ?', (user_id,))
-        user_role = cursor.fetchone()
-        
-        if user_role and user_role[0] == 'admin' and admin_count <= 1:
-            conn.close()
-            return False  # No se puede eliminar el último administrador
-        
-        # Eliminar las sesiones del usuario
-        cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-        
-        # Eliminar el usuario
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        
-        conn.commit()
-        conn.close()
+        with transaction(DB_PATH) as conn:
+            cursor = conn.cursor()
+            
+            # Verificar si es el último administrador
+            cursor.execute('SELECT COUNT(*) FROM users WHERE role = "admin"')
+            admin_count = cursor.fetchone()[0]
+            
+            cursor.execute('SELECT role FROM users WHERE id = ?', (user_id,))
+            user_role = cursor.fetchone()
+            
+            if user_role and user_role[0] == 'admin' and admin_count <= 1:
+                return False  # No se puede eliminar el último administrador
+            
+            # Eliminar las sesiones del usuario
+            cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            
+            # Eliminar el usuario
+            cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
         
+        session_cache.invalidate_user(user_id)
         return True
     except Exception as e:
         print(f"Error al eliminar usuario: {str(e)}")
         return False
-
-# Inicializar la base de datos al importar el módulo
-init_db()